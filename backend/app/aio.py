@@ -0,0 +1,118 @@
+"""
+Helpers for the async request path served by server/asgi.py.
+
+DRF's @api_view only wraps synchronous views, so the Plaid-bound endpoints are
+plain Django async views decorated with async_api_view, which checks the method
+and the session user the way @permission_classes([IsAuthenticated]) does.
+
+The Plaid SDK and the ORM calls made while syncing are blocking, so they run on
+a dedicated thread pool (ASYNC_IO_THREADS threads) through sync_to_async with
+thread_sensitive=False. The event loop only waits on them, which lets one ASGI
+process hold hundreds of link and sync requests that are waiting on Plaid, where
+a WSGI worker thread would be tied up by each of them. How many Plaid calls are
+actually in flight is still capped by the client's rate limits and adaptive
+concurrency (app/plaid_client.py).
+"""
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import JsonResponse
+
+from app import sync
+from app.plaid_client import client
+
+logger = logging.getLogger(__name__)
+
+ASYNC_IO_THREADS = int(os.getenv('ASYNC_IO_THREADS', 64))
+# Seconds an inline item sync may run before it stops with the pages committed so far
+INLINE_SYNC_TIMEOUT = 60
+
+executor = ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS, thread_name_prefix='aio')
+
+
+def run_blocking(func, *args, **kwargs):
+    """Await func(*args, **kwargs) on the I/O thread pool.
+
+    Pool threads are not request threads, so Django's request_finished handler
+    never sees their connections; close_old_connections applies CONN_MAX_AGE to
+    them after every call instead.
+    """
+    def call():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(call, thread_sensitive=False, executor=executor)()
+
+
+def plaid_call(endpoint, request):
+    """Await a call to one of the rate-limited Plaid client's endpoints."""
+    return run_blocking(getattr(client, endpoint), request)
+
+
+def is_asgi(request):
+    """Whether the request is being served by server/asgi.py; takes a Django or DRF request."""
+    # Only ASGIRequest has a scope; DRF's Request passes attribute lookups through to it
+    return hasattr(request, 'scope')
+
+
+def request_data(request):
+    """The JSON or form body of a request, as DRF's request.data would read it."""
+    if request.content_type == 'application/json':
+        return json.loads(request.body or b'{}')
+    return request.POST
+
+
+def async_api_view(methods):
+    """Allow `methods` to an async view and require a logged-in session user.
+
+    The user is loaded with request.auser() and set on request.user, since the
+    lazy request.user of AuthenticationMiddleware cannot be resolved in async code.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({
+                    'detail': f'Method "{request.method}" not allowed.'
+                }, status=405)
+            user = await request.auser()
+            if not user.is_authenticated:
+                return JsonResponse({
+                    'detail': 'Authentication credentials were not provided.'
+                }, status=403)
+            request.user = user
+            try:
+                return await view(request, *args, **kwargs)
+            except json.JSONDecodeError as e:
+                return JsonResponse({
+                    'detail': f'JSON parse error - {e}'
+                }, status=400)
+        return wrapper
+    return decorator
+
+
+async def sync_item(access_token, user, timeout=INLINE_SYNC_TIMEOUT):
+    """Run sync.sync_item for one item on the I/O pool. Returns (summary, error message)."""
+    try:
+        return await run_blocking(sync.sync_item, access_token, user, timeout=timeout), None
+    except sync.SyncError as e:
+        logger.error('Error in transaction sync', extra={'plaid_error': e.error})
+        return None, str(e)
+    except sync.SyncTimeout as e:
+        logger.warning('Transaction sync timed out: %s', e)
+        return None, str(e)
+    except Exception as e:
+        logger.exception('Error processing access token')
+        return None, f'{e.__class__.__name__}: {e}'
+
+
+async def sync_items(user, access_tokens, timeout=INLINE_SYNC_TIMEOUT):
+    """Sync all of the given items concurrently; results are in access_tokens order."""
+    return await asyncio.gather(*(sync_item(access_token, user, timeout=timeout) for access_token in access_tokens))
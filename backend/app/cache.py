@@ -0,0 +1,194 @@
+"""
+Per-user response cache for read endpoints.
+
+Cache keys combine the endpoint, the user, the user's data_version and the full
+request path, plus the negotiated format and content coding for views that
+depend on the Accept headers (see app/payloads.py). Every committed sync bumps data_version (db.bump_data_version),
+so stale entries are never read again and simply age out. The ETag is derived
+from the same key, which lets a client's If-None-Match be answered with a 304
+without touching the cache or the database.
+
+The backend is configured with settings.RESPONSE_CACHE:
+
+- LRUCacheBackend keeps responses in process memory, bounded by their count
+  and their total size.
+- DjangoCacheBackend stores them in one of settings.CACHES, shared between
+  processes.
+"""
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.module_loading import import_string
+
+from app import instrumentation
+
+
+class LRUCacheBackend:
+    """Thread-safe in-process LRU holding at most `max_entries` responses and `max_bytes` of content.
+
+    Responses larger than `max_entry_bytes` are not cached, so one large export
+    or page cannot evict everything else.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, max_entry_bytes=2 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(key, value):
+        """Approximate bytes an entry holds: a cached response's content, type and headers, or a plain value's size."""
+        if not isinstance(value, tuple):
+            return len(key) + sys.getsizeof(value)
+        content_type, content = value[:2]
+        headers = value[2] if len(value) > 2 else {}
+        return len(key) + len(content_type) + len(content) + sum(len(h) + len(v) for h, v in headers.items())
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def set(self, key, value):
+        size = self.entry_size(key, value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_entry_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class DjangoCacheBackend:
+    """Stores responses in a Django cache so every worker process shares them."""
+
+    def __init__(self, alias='default', timeout=3600):
+        self.alias = alias
+        self.timeout = timeout
+
+    def get(self, key):
+        return caches[self.alias].get(key)
+
+    def set(self, key, value):
+        caches[self.alias].set(key, value, self.timeout)
+
+    def clear(self):
+        caches[self.alias].clear()
+
+
+class CacheStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+    def incr(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_ratio'] = counters['hits'] / lookups if lookups else 0.0
+        return counters
+
+
+stats = CacheStats()
+
+
+@instrumentation.registry.register_collector
+def cache_metric_lines():
+    counters = stats.snapshot()
+    lines = ['# HELP response_cache_requests_total Cached read endpoint lookups by result', '# TYPE response_cache_requests_total counter']
+    lines += [f'response_cache_requests_total{{result="{name}"}} {counters[name]}' for name in ('hits', 'misses', 'not_modified')]
+    return lines
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            config = getattr(settings, 'RESPONSE_CACHE', {})
+            backend_class = import_string(config.get('BACKEND', 'app.cache.LRUCacheBackend'))
+            _backend = backend_class(**config.get('OPTIONS', {}))
+        return _backend
+
+
+# Response headers stored with the content, needed to replay it
+CACHED_HEADERS = ('Content-Encoding', 'Vary')
+
+
+def cache_key(namespace, request, variant=None):
+    user = request.user
+    key = f'response:{namespace}:{user.pk}:{user.data_version}:{request.get_full_path()}'
+    return f'{key}:{variant(request)}' if variant is not None else key
+
+
+def etag_for(key):
+    return '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+
+
+def cached_response(namespace, variant=None):
+    """Cache a read view's successful responses per user and data version.
+
+    Wrap the plain view function (inside @api_view / @permission_classes) so the
+    request is already authenticated. Only 200 responses are cached. For views
+    whose response depends on request headers, variant(request) names the
+    representation asked for (e.g. payloads.variant) and becomes part of the key.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = cache_key(namespace, request, variant)
+            etag = etag_for(key)
+
+            if etag in request.headers.get('If-None-Match', ''):
+                stats.incr('not_modified')
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+
+            backend = get_backend()
+            entry = backend.get(key)
+            if entry is not None:
+                stats.incr('hits')
+                content_type, content, headers = entry
+                response = HttpResponse(content, content_type=content_type)
+                for header, value in headers.items():
+                    response[header] = value
+            else:
+                stats.incr('misses')
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200 or getattr(response, 'streaming', False):
+                    return response
+                headers = {header: response[header] for header in CACHED_HEADERS if response.has_header(header)}
+                backend.set(key, (response['Content-Type'], response.content, headers))
+
+            response['ETag'] = etag
+            # Browsers must revalidate, which turns repeat loads into cheap 304s
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
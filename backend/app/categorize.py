@@ -0,0 +1,249 @@
+"""
+User-defined categorization rules.
+
+A user's enabled CategoryRules are compiled into a CategoryMatcher:
+
+- rules naming a merchant are indexed by normalized merchant name, so a
+  transaction is only checked against its own merchant's rules and the rules
+  that name no merchant;
+- all description patterns are joined into one regex that is searched first,
+  so a description no rule mentions is rejected with a single search (unless a
+  pattern refers to a group by number, which joining would renumber);
+- the rules left after the merchant, description and payment_channel checks
+  are memoized per (merchant, description, payment_channel), leaving only the
+  amount bounds to test for repeated transactions.
+
+Rules are tried in priority order (highest first, then oldest) and the first
+one that matches sets transaction_type. Transactions no rule matches keep
+plaid_category.
+"""
+import logging
+import re
+from array import array
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import Value
+
+import app.db_methods as db
+from app import rollups, snapshot
+from app.models import CategoryRule, Transaction
+
+logger = logging.getLogger(__name__)
+
+SYNC_BATCH_SIZE = getattr(settings, 'SYNC_BATCH_SIZE', 1000)
+# Distinct (merchant, description, payment_channel) outcomes kept per matcher
+CANDIDATE_CACHE_SIZE = 100000
+# Backreferences (\1, (?P=name)) and conditionals ((?(1)...)) refer to groups that
+# joining patterns into one regex renumbers or duplicates
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+RULE_FIELDS = ['category', 'merchant_name', 'description_pattern', 'min_amount', 'max_amount', 'payment_channel', 'priority', 'enabled']
+
+
+def normalize(value):
+    return ' '.join(value.split()).casefold() if value else ''
+
+
+class CompiledRule:
+    def __init__(self, order, rule):
+        self.order = order
+        self.category = rule.category
+        self.pattern = re.compile(rule.description_pattern, re.IGNORECASE) if rule.description_pattern else None
+        self.payment_channel = normalize(rule.payment_channel)
+        self.min_amount = rule.min_amount
+        self.max_amount = rule.max_amount
+
+
+class CategoryMatcher:
+    def __init__(self, rules):
+        self.rules = []
+        self.generic = []
+        by_merchant = defaultdict(list)
+        for rule in rules:
+            try:
+                compiled = CompiledRule(len(self.rules), rule)
+            except re.error as e:
+                logger.warning('Skipping category rule with invalid pattern', extra={'rule_id': rule.id, 'error': str(e)})
+                continue
+            self.rules.append(compiled)
+            if rule.merchant_name:
+                by_merchant[normalize(rule.merchant_name)].append(compiled)
+            else:
+                self.generic.append(compiled)
+        # Each merchant's rules merged with the merchant-less ones, in priority order
+        self.by_merchant = {
+            merchant: sorted(merchant_rules + self.generic, key=lambda r: r.order)
+            for merchant, merchant_rules in by_merchant.items()
+        }
+
+        patterns = [r.pattern.pattern for r in self.rules if r.pattern]
+        try:
+            if patterns and not any(GROUP_REFERENCE.search(p) for p in patterns):
+                self.any_pattern = re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE)
+            else:
+                # Every rule's own pattern is still searched
+                self.any_pattern = None
+        except re.error:
+            # e.g. a pattern with inline global flags, which only compiles on its own
+            self.any_pattern = None
+        self.candidates = {}
+        self.uses_amount = any(r.min_amount is not None or r.max_amount is not None for r in self.rules)
+
+    def candidate_rules(self, merchant_name, description, payment_channel):
+        key = (merchant_name, description, payment_channel)
+        candidates = self.candidates.get(key)
+        if candidates is None:
+            rules = self.by_merchant.get(normalize(merchant_name), self.generic)
+            description = description or ''
+            description_hit = self.any_pattern is None or self.any_pattern.search(description) is not None
+            channel = normalize(payment_channel)
+            candidates = tuple(
+                (r.min_amount, r.max_amount, r.category)
+                for r in rules
+                if (not r.payment_channel or r.payment_channel == channel)
+                and (r.pattern is None or (description_hit and r.pattern.search(description)))
+            )
+            if len(self.candidates) >= CANDIDATE_CACHE_SIZE:
+                self.candidates.clear()
+            self.candidates[key] = candidates
+        return candidates
+
+    def categorize(self, merchant_name, description, payment_channel, amount, default):
+        """Category of the first matching rule, or `default` when none matches."""
+        if not self.rules:
+            return default
+        for min_amount, max_amount, category in self.candidate_rules(merchant_name, description, payment_channel):
+            if (min_amount is None or amount >= min_amount) and (max_amount is None or amount <= max_amount):
+                return category
+        return default
+
+
+def matcher_for(user):
+    return CategoryMatcher(list(CategoryRule.objects.filter(user=user, enabled=True)))
+
+
+def nested_quantifier(pattern):
+    """Whether a repeated group itself contains a repeat, as in (a+)+ or (\\w*x)*.
+
+    Such patterns can backtrack exponentially on a near-miss description, and
+    Python's re has no timeout. A scan of the pattern text: escapes and character
+    classes are skipped, and `?` is not counted as a repeat.
+    """
+    stack = [False]
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '[':
+            # A ']' right after '[' or '[^' is a literal
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif c == '(':
+            stack.append(False)
+        elif c == ')' and len(stack) > 1:
+            inner = stack.pop()
+            repeated = pattern[i + 1:i + 2] in ('*', '+', '{')
+            if inner and repeated:
+                return True
+            stack[-1] = stack[-1] or inner or repeated
+        elif c in '*+{':
+            stack[-1] = True
+        i += 1
+    return False
+
+
+def validate_rule(data):
+    """Clean CategoryRule field values from a request, raising ValueError when they are invalid."""
+    values = {}
+    for field in RULE_FIELDS:
+        if field in data:
+            values[field] = data[field]
+    if 'category' in values and not values['category']:
+        raise ValueError('category is required')
+    for field in ('merchant_name', 'description_pattern', 'payment_channel'):
+        if field in values:
+            values[field] = (values[field] or '').strip()
+    if values.get('description_pattern'):
+        pattern = values['description_pattern']
+        max_length = CategoryRule._meta.get_field('description_pattern').max_length
+        if len(pattern) > max_length:
+            raise ValueError(f'description_pattern is longer than {max_length} characters')
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f'Invalid description_pattern: {e}')
+        if nested_quantifier(pattern):
+            raise ValueError('Invalid description_pattern: a repeated group may not contain a repeat, e.g. (a+)+')
+    for field in ('min_amount', 'max_amount'):
+        if field not in values:
+            continue
+        if values[field] in (None, ''):
+            values[field] = None
+        else:
+            try:
+                values[field] = Decimal(str(values[field])).quantize(Decimal('0.01'))
+            except InvalidOperation:
+                raise ValueError(f'Invalid {field}: {values[field]}')
+    if values.get('min_amount') is not None and values.get('max_amount') is not None and values['min_amount'] > values['max_amount']:
+        raise ValueError('min_amount is greater than max_amount')
+    if 'priority' in values:
+        try:
+            values['priority'] = int(values['priority'])
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid priority: {values['priority']}")
+    if 'enabled' in values:
+        values['enabled'] = values['enabled'] not in (False, 'false', '0', 0)
+    return values
+
+
+def has_condition(rule):
+    return bool(rule.merchant_name or rule.description_pattern or rule.payment_channel
+                or rule.min_amount is not None or rule.max_amount is not None)
+
+
+def recategorize(user):
+    """Re-apply the user's rules to every stored transaction.
+
+    Rows are streamed as tuples and only those whose category changes are
+    written, with one UPDATE per category and batch of ids. Returns the number of
+    transactions scanned and changed.
+    """
+    matcher = matcher_for(user)
+    # Converting amounts to Decimal is half the cost of the scan, so skip it when no rule needs them
+    amount_column = 'amount' if matcher.uses_amount else Value(0)
+    rows = Transaction.objects.filter(account__user=user).values_list(
+        'id', 'merchant_name', 'description', 'payment_channel', amount_column, 'plaid_category', 'transaction_type'
+    )
+    changes = defaultdict(lambda: array('q'))
+    scanned = 0
+    for pk, merchant_name, description, payment_channel, amount, plaid_category, transaction_type in rows.iterator(chunk_size=10000):
+        scanned += 1
+        category = matcher.categorize(merchant_name, description, payment_channel, amount, plaid_category or transaction_type)
+        if category != transaction_type:
+            changes[category].append(pk)
+
+    changed = 0
+    months = set()
+    with db_transaction.atomic():
+        for category, ids in changes.items():
+            for start in range(0, len(ids), SYNC_BATCH_SIZE):
+                batch = Transaction.objects.filter(id__in=ids[start:start + SYNC_BATCH_SIZE].tolist())
+                months |= rollups.months_spanned(batch)
+                changed += batch.update(transaction_type=category)
+        if changed:
+            rollups.refresh_months(user, months)
+            db.bump_data_version(user)
+    if changed and snapshot.enabled():
+        # Categories changed in place, which an incremental refresh does not see
+        snapshot.refresh(user, rebuild=True)
+    logger.info('Recategorized transactions', extra={'user_id': user.pk, 'changed': changed, 'scanned': scanned})
+    return {'scanned': scanned, 'changed': changed}
@@ -2,14 +2,24 @@ import base64
 import os
 import datetime as dt
 import json
+import logging
 import time
 from datetime import date, timedelta, datetime
 import uuid
+from decimal import Decimal
+from django.conf import settings
+from django.db import connection, transaction as db_transaction
+from django.db.models import F, Q
 from django.utils import timezone
-from django.utils.dateparse import parse_datetime
+from django.utils.dateparse import parse_date, parse_datetime
 
 from app.models import User, Account, Transaction, SavingsGoal, Paycheck, MonthlySpending, Cursor
+from app import categorize, merchants, rollups
+from app.instrumentation import span
 
+logger = logging.getLogger(__name__)
+
+@span('db_methods.update_accounts')
 def update_accounts(user, access_token, accounts):
     for acc in accounts:
         if (acc['type'] != 'credit' or acc['type'] != 'loan'):
@@ -25,132 +35,334 @@ def update_accounts(user, access_token, accounts):
                 },
             )
 
+@span('db_methods.update_cursor')
 def update_cursor(user, access_token, cursor):
     # update or create cursor where user and access_id match
     Cursor.objects.update_or_create(
         user=user,
         access_token=access_token,
-        defaults={'cursor': cursor},
+        defaults={'cursor': cursor, 'synced_at': timezone.now()},
     )
 
+@span('db_methods.record_item')
+def record_item(user, access_token, item_id):
+    # Webhooks name the item, not the access token; keep the mapping next to the cursor
+    Cursor.objects.update_or_create(
+        access_token=access_token,
+        defaults={'user': user, 'item_id': item_id},
+    )
+
+@span('db_methods.update_transactions')
 def update_transactions(user, transactions):
     # Initialize accounts dictionary for caching Account objects
     accounts = {}
-    add_transactions(transactions['added'], accounts, user)
-    modify_transactions(transactions['modified'], accounts, user)
-    remove_transactions(transactions['removed'])
+    # Months the changed rows sit in before the change, plus the months they move into,
+    # are the only MonthlySpending buckets this page can affect
+    touched_months = rollups.months_of_stored(
+        [t['transaction_id'] for t in transactions['modified']] + removed_transaction_ids(transactions['removed'])
+    )
+    touched_months |= {
+        rollups.month_of(transaction_datetime(t)) for t in transactions['added'] + transactions['modified']
+    }
+
+    added = add_transactions(transactions['added'], accounts, user)
+    modified = modify_transactions(transactions['modified'], accounts, user)
+    removed = remove_transactions(transactions['removed'])
+    rollups.refresh_months(user, touched_months)
+    return {'added': added, 'modified': modified, 'removed': removed}
+
+@span('db_methods.apply_sync_page')
+def apply_sync_page(user, access_token, response):
+    """Apply one /transactions/sync page (accounts, transactions and cursor) atomically.
+
+    The cursor is written last inside the same database transaction, so it only
+    advances if everything else in the page commits. A failed or retried page is
+    replayed from the previous cursor, and the conflict-tolerant writes make that
+    replay harmless.
+    """
+    with db_transaction.atomic():
+        update_accounts(user, access_token, response['accounts'])
+        summary = update_transactions(user, response)
+        update_cursor(user, access_token, response['next_cursor'])
+        bump_data_version(user)
+    return summary
+
+@span('db_methods.bump_data_version')
+def bump_data_version(user):
+    """Invalidate the user's cached read responses by moving to a new data version."""
+    User.objects.filter(pk=user.pk).update(data_version=F('data_version') + 1)
     
 def get_account_transactions(account, start_date, end_date):
     return Transaction.objects.filter(account=account, datetime__gte=start_date, datetime__lte=end_date).order_by('datetime')
 
-def add_transactions(transactions_data, accounts, user):
-    """Add new transactions to the database."""
+FEED_DEFAULT_LIMIT = 100
+FEED_MAX_LIMIT = 500
+
+def encode_feed_cursor(transaction):
+    """Encode the (datetime, id) keyset position of a transaction as an opaque token."""
+    position = json.dumps([transaction.datetime.isoformat(), transaction.id])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+def decode_feed_cursor(token):
+    """Decode a feed cursor back into (datetime, id). Raises ValueError if it is malformed."""
     try:
-        # Filter out non-expense transactions (only keep positive amounts)
-        expense_transactions = [t for t in transactions_data if t.get('amount', 0) > 0]
-        
-        # Get any account IDs we don't have cached yet
-        missing_account_ids = {t['account_id'] for t in expense_transactions} - accounts.keys()
-        if missing_account_ids:
-            new_accounts = Account.objects.filter(account_id__in=missing_account_ids)
-            # Update our accounts cache with the new accounts
-            accounts.update({acc.account_id: acc for acc in new_accounts})
-        
+        padded = token + '=' * (-len(token) % 4)
+        iso_datetime, transaction_pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        cursor_datetime = parse_datetime(iso_datetime)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+    if cursor_datetime is None or not isinstance(transaction_pk, int):
+        raise ValueError(f"Invalid cursor: {token}")
+    return cursor_datetime, transaction_pk
+
+def parse_feed_bound(value, end=False):
+    """Parse a start/end filter given as a date or datetime string into an aware datetime.
+
+    A bare date used as an end bound covers the whole day, so the returned value is
+    the (exclusive) start of the following day.
+    """
+    try:
+        day = parse_date(value)
+        bound = None if day else parse_datetime(value)
+    except ValueError:
+        day = bound = None
+    if day is not None:
+        if end:
+            day += timedelta(days=1)
+        bound = datetime.combine(day, datetime.min.time())
+    if bound is None:
+        raise ValueError(f"Invalid date: {value}")
+    return timezone.make_aware(bound) if timezone.is_naive(bound) else bound
+
+@span('db_methods.get_transaction_feed')
+def get_transaction_feed(user, cursor=None, limit=FEED_DEFAULT_LIMIT, start=None, end=None, account_id=None, transaction_type=None):
+    """Return one page of a user's transactions, newest first, and the cursor for the next page.
+
+    Runs a single query across all of the user's accounts and paginates on
+    (datetime, id) so each page costs the same no matter how deep the user scrolls.
+    """
+    limit = max(1, min(limit, FEED_MAX_LIMIT))
+    transactions = Transaction.objects.filter(account__user=user).select_related('account')
+
+    if start is not None:
+        transactions = transactions.filter(datetime__gte=start)
+    if end is not None:
+        transactions = transactions.filter(datetime__lt=end)
+    if account_id:
+        transactions = transactions.filter(account__account_id=account_id)
+    if transaction_type:
+        transactions = transactions.filter(transaction_type=transaction_type)
+    if cursor:
+        cursor_datetime, cursor_pk = decode_feed_cursor(cursor)
+        transactions = transactions.filter(
+            Q(datetime__lt=cursor_datetime) | Q(datetime=cursor_datetime, id__lt=cursor_pk)
+        )
+
+    # Fetch one extra row to find out whether another page exists
+    page = list(transactions.order_by('-datetime', '-id')[:limit + 1])
+    next_cursor = encode_feed_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+# Rows written per INSERT/UPDATE statement when applying a sync page
+SYNC_BATCH_SIZE = getattr(settings, 'SYNC_BATCH_SIZE', 1000)
+MODIFIED_FIELDS = ['amount', 'description', 'merchant_name', 'merchant', 'datetime', 'transaction_type', 'plaid_category', 'payment_channel']
+
+def transaction_datetime(transaction):
+    """Return a timezone aware datetime for a Plaid transaction dict."""
+    if transaction.get('datetime') is None:
+        # Convert date to datetime at midnight in the current timezone
+        date_obj = transaction['date']
+        if isinstance(date_obj, str):
+            date_obj = datetime.strptime(date_obj, '%Y-%m-%d').date()
+        return timezone.make_aware(datetime.combine(date_obj, datetime.min.time()))
+    # Parse datetime string (the Plaid client may already hand us a datetime) and ensure it's timezone aware
+    dt_obj = transaction['datetime']
+    if isinstance(dt_obj, str):
+        dt_obj = parse_datetime(dt_obj)
+    return timezone.make_aware(dt_obj) if timezone.is_naive(dt_obj) else dt_obj
+
+def transaction_fields(transaction):
+    """Map a Plaid transaction dict onto Transaction field values (excluding account)."""
+    return {
+        'amount': Decimal(str(transaction['amount'])).quantize(Decimal('0.01')),
+        'description': transaction.get('description', ''),
+        'merchant_name': transaction.get('merchant_name'),
+        'datetime': transaction_datetime(transaction),
+        'plaid_category': transaction.get('personal_finance_category', 'UNCATEGORIZED').get('primary', 'UNCATEGORIZED'),
+        'payment_channel': transaction.get('payment_channel', 'OTHER'),
+    }
+
+def stored_fields(transaction, matcher, merchant_ids):
+    """transaction_fields() plus transaction_type from the user's CategoryRules and the resolved merchant."""
+    fields = transaction_fields(transaction)
+    fields['transaction_type'] = matcher.categorize(
+        fields['merchant_name'], fields['description'], fields['payment_channel'], fields['amount'], fields['plaid_category']
+    )
+    fields['merchant_id'] = merchant_ids.get(fields['merchant_name'])
+    return fields
+
+def cache_accounts(transactions_data, accounts, user):
+    """Load the user's Account objects referenced by the transactions that are not already cached.
+
+    Accounts of other users are never matched, so a transaction naming one is
+    skipped rather than stored under someone else's account.
+    """
+    missing_account_ids = {t['account_id'] for t in transactions_data} - accounts.keys()
+    if missing_account_ids:
+        new_accounts = Account.objects.filter(user=user, account_id__in=missing_account_ids)
+        # Update our accounts cache with the new accounts
+        accounts.update({acc.account_id: acc for acc in new_accounts})
+
+@span('db_methods.add_transactions')
+def add_transactions(transactions_data, accounts, user):
+    """Add new transactions to the database and return how many rows were inserted.
+
+    Transactions already stored for the same account are skipped, so replaying a
+    page never creates duplicates. Errors propagate so the surrounding sync page
+    rolls back.
+    """
+    # Filter out non-expense transactions (only keep positive amounts)
+    expense_transactions = [t for t in transactions_data if t.get('amount', 0) > 0]
+    cache_accounts(expense_transactions, accounts, user)
+    matcher = categorize.matcher_for(user)
+    
+    added = 0
+    for start in range(0, len(expense_transactions), SYNC_BATCH_SIZE):
+        batch = expense_transactions[start:start + SYNC_BATCH_SIZE]
+        merchant_ids = merchants.resolve([t.get('merchant_name') for t in batch])
+        existing = set(
+            Transaction.objects.filter(transaction_id__in=[t['transaction_id'] for t in batch])
+            .values_list('transaction_id', 'account_id')
+        )
+
         transactions = []
-        for transaction in expense_transactions:
+        for transaction in batch:
             # Get the account object from our mapping
             account = accounts.get(transaction['account_id'])
             if not account:
-                print(f"Account not found for transaction {transaction['transaction_id']}")
+                logger.warning('Account not found for transaction', extra={'transaction_id': transaction['transaction_id']})
+                continue
+            if (transaction['transaction_id'], account.id) in existing:
                 continue
-            
-            # Handle datetime with proper timezone awareness
-            if transaction.get('datetime') is None:
-                # Convert date to datetime at midnight in the current timezone
-                date_obj = transaction['date']
-                if isinstance(date_obj, str):
-                    date_obj = datetime.strptime(date_obj, '%Y-%m-%d').date()
-                transaction_datetime = timezone.make_aware(datetime.combine(date_obj, datetime.min.time()))
-            else:
-                # Parse datetime string and ensure it's timezone aware
-                dt_obj = parse_datetime(transaction['datetime'])
-                transaction_datetime = timezone.make_aware(dt_obj) if timezone.is_naive(dt_obj) else dt_obj
+            # Keep duplicates within the page itself out of the insert too
+            existing.add((transaction['transaction_id'], account.id))
                 
             # Create transaction object
             transaction_obj = Transaction(
                 transaction_id=transaction['transaction_id'],
                 account=account,
-                amount=transaction['amount'],
-                description=transaction.get('description', ''),
-                merchant_name=transaction.get('merchant_name'),
-                datetime=transaction_datetime,
-                transaction_type=transaction.get('personal_finance_category', 'UNCATEGORIZED').get('primary', 'UNCATEGORIZED'),
-                payment_channel=transaction.get('payment_channel', 'OTHER')
+                **stored_fields(transaction, matcher, merchant_ids),
             )
             transactions.append(transaction_obj)
 
-        # Bulk create transactions
-        print(f"Adding {len(transactions)} transactions")
-        Transaction.objects.bulk_create(transactions)
-        return True
-    except Exception as e:
-        print(f"Error adding transactions: {str(e)}")
-        return False
+        # ignore_conflicts covers rows inserted by a concurrent sync of the same item
+        Transaction.objects.bulk_create(transactions, batch_size=SYNC_BATCH_SIZE, ignore_conflicts=True)
+        added += len(transactions)
+
+    logger.info('Added transactions', extra={'added': added, 'skipped': len(expense_transactions) - added})
+    return added
 
+@span('db_methods.modify_transactions')
 def modify_transactions(transactions_data, accounts, user):
-    """Modify existing transactions in the database."""
-    try:
-        # Filter out non-expense transactions (only keep positive amounts)
-        expense_transactions = [t for t in transactions_data if t.get('amount', 0) > 0]
-        
-        # Get any account IDs we don't have cached yet
-        missing_account_ids = {t['account_id'] for t in expense_transactions} - accounts.keys()
-        if missing_account_ids:
-            new_accounts = Account.objects.filter(account_id__in=missing_account_ids)
-            # Update our accounts cache with the new accounts
-            accounts.update({acc.account_id: acc for acc in new_accounts})
-        
-        for transaction in expense_transactions:
+    """Modify existing transactions in the database.
+
+    The user's existing rows are fetched with one transaction_id__in query per
+    batch and only rows whose values actually changed are written back. Modified transactions we
+    have never stored are inserted. Returns a dict of added/updated/unchanged counts.
+    """
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0}
+    # Filter out non-expense transactions (only keep positive amounts)
+    expense_transactions = [t for t in transactions_data if t.get('amount', 0) > 0]
+    cache_accounts(expense_transactions, accounts, user)
+    matcher = categorize.matcher_for(user)
+
+    for start in range(0, len(expense_transactions), SYNC_BATCH_SIZE):
+        batch = expense_transactions[start:start + SYNC_BATCH_SIZE]
+        merchant_ids = merchants.resolve([t.get('merchant_name') for t in batch])
+        # Only this user's rows; the same transaction_id may be stored under several accounts
+        existing, elsewhere = {}, {}
+        for row in Transaction.objects.filter(account__user=user, transaction_id__in=[t['transaction_id'] for t in batch]):
+            existing[(row.transaction_id, row.account_id)] = row
+            elsewhere.setdefault(row.transaction_id, []).append(row)
+
+        new_rows, changed_rows, moved_rows = [], [], []
+        for transaction in batch:
             account = accounts.get(transaction['account_id'])
-            if not account:
-                print(f"Account not found for transaction {transaction['transaction_id']}")
+            if not account or account.user_id != user.pk:
+                logger.warning('Account not found for transaction', extra={'transaction_id': transaction['transaction_id']})
                 continue
-                
-            # Handle datetime with proper timezone awareness
-            if transaction.get('datetime') is None:
-                # Convert date to datetime at midnight in the current timezone
-                date_obj = transaction['date']
-                if isinstance(date_obj, str):
-                    date_obj = datetime.strptime(date_obj, '%Y-%m-%d').date()
-                transaction_datetime = timezone.make_aware(datetime.combine(date_obj, datetime.min.time()))
-            else:
-                # Parse datetime string and ensure it's timezone aware
-                dt_obj = parse_datetime(transaction['datetime'])
-                transaction_datetime = timezone.make_aware(dt_obj) if timezone.is_naive(dt_obj) else dt_obj
-                
-            Transaction.objects.filter(
-                transaction_id=transaction['transaction_id']
-            ).update(
-                account=account,
-                amount=transaction['amount'],
-                description=transaction.get('description', ''),
-                merchant_name=transaction.get('merchant_name'),
-                datetime=transaction_datetime,
-                transaction_type=transaction.get('personal_finance_category', 'UNCATEGORIZED').get('primary', 'UNCATEGORIZED'),
-                payment_channel=transaction.get('payment_channel', 'OTHER')
+
+            fields = stored_fields(transaction, matcher, merchant_ids)
+            row = existing.get((transaction['transaction_id'], account.id))
+            if row is None:
+                # Not under this account: it moved here from another of the user's accounts, if any
+                candidates = [r for r in elsewhere.get(transaction['transaction_id'], ()) if r.account_id != account.id]
+                row = candidates[0] if candidates else None
+                if row is not None:
+                    elsewhere[transaction['transaction_id']].remove(row)
+                    del existing[(row.transaction_id, row.account_id)]
+                    existing[(row.transaction_id, account.id)] = row
+            if row is None:
+                new_rows.append(Transaction(transaction_id=transaction['transaction_id'], account=account, **fields))
+                continue
+            if row.account_id == account.id and all(getattr(row, f) == v for f, v in fields.items()):
+                counts['unchanged'] += 1
+                continue
+            moved = row.account_id != account.id
+            row.account = account
+            for field, value in fields.items():
+                setattr(row, field, value)
+            (moved_rows if moved else changed_rows).append(row)
+
+        write_modified_transactions(new_rows, changed_rows, moved_rows)
+        counts['added'] += len(new_rows)
+        counts['updated'] += len(changed_rows) + len(moved_rows)
+
+    logger.info('Modified transactions', extra=counts)
+    return counts
+
+@span('db_methods.write_modified_transactions')
+def write_modified_transactions(new_rows, changed_rows, moved_rows):
+    """Write one batch of modified transactions using set-based statements."""
+    if connection.features.supports_update_conflicts_with_target:
+        # INSERT ... ON CONFLICT (transaction_id, account_id) DO UPDATE handles inserts
+        # and in-place updates in a single statement per batch
+        upserts = new_rows + changed_rows
+        if upserts:
+            Transaction.objects.bulk_create(
+                upserts,
+                batch_size=SYNC_BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=['transaction_id', 'account'],
+                update_fields=MODIFIED_FIELDS,
             )
-        return True
-    except Exception as e:
-        print(f"Error modifying transactions: {str(e)}")
-        return False
+    else:
+        Transaction.objects.bulk_create(new_rows, batch_size=SYNC_BATCH_SIZE, ignore_conflicts=True)
+        moved_rows = changed_rows + moved_rows
+    # A row that moved to another account cannot be matched on the conflict target
+    if moved_rows:
+        Transaction.objects.bulk_update(moved_rows, ['account'] + MODIFIED_FIELDS, batch_size=SYNC_BATCH_SIZE)
+
+def removed_transaction_ids(transactions):
+    # Plaid sends removed transactions as {'transaction_id': ..., 'account_id': ...} dicts
+    return [t['transaction_id'] if isinstance(t, dict) else t for t in transactions]
 
+@span('db_methods.remove_transactions')
 def remove_transactions(transactions):
-    print('removing transactions')
-    Transaction.objects.filter(transaction_id__in=transactions).delete()
+    """Delete removed transactions and return how many rows were deleted."""
+    transaction_ids = removed_transaction_ids(transactions)
+    removed = 0
+    for start in range(0, len(transaction_ids), SYNC_BATCH_SIZE):
+        batch = transaction_ids[start:start + SYNC_BATCH_SIZE]
+        removed += Transaction.objects.filter(transaction_id__in=batch).delete()[0]
+    logger.info('Removed transactions', extra={'removed': removed})
+    return removed
 
+@span('db_methods.get_cursor')
 def get_cursor(access_token):
     try:
         cursor = Cursor.objects.get(access_token=access_token)
-        return cursor.cursor
+        # An item recorded at exchange has no cursor until its first sync
+        return cursor.cursor or None
     except Cursor.DoesNotExist:
         return None
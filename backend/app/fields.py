@@ -0,0 +1,194 @@
+"""
+Model fields that store money and repeated labels compactly.
+
+CentsField keeps an amount as a BigInteger number of cents. Python code sees
+the Decimal with two places a DecimalField would give it, so model attributes,
+filters (amount__gt=0), values_list and Sum() all read and take exact Decimals,
+while rows are narrower and the database sums integers.
+
+LookupField is dictionary encoding for a label repeated on many rows, like a
+category or a payment channel: each distinct name gets a row in a lookup table
+and the column holds that row's small-int code. Python code again sees names;
+codes are translated on the way in and out by a per-process Lookup cache, and a
+name is added to the table the first time a row is saved with it. GROUP BY on
+the column groups by code and the names are filled in afterwards.
+
+Code using these columns through a raw cursor (app/snapshot.py,
+app/payloads.py, app/statements.py) deals in the stored values: cents, and
+codes it maps to names with LookupNames or field.lookup.
+"""
+import threading
+from decimal import Decimal, InvalidOperation
+
+from django import forms
+from django.apps import apps
+from django.core import exceptions
+from django.db import connection, models, transaction
+from django.db.models.signals import post_migrate
+
+CENT = Decimal('0.01')
+# What LookupField filters compare against for a name that has no code
+UNKNOWN_CODE = -1
+
+
+class CentsField(models.BigIntegerField):
+    """An amount of money stored as integer cents and exposed as a two-place Decimal."""
+
+    description = 'Amount of money stored in cents'
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else Decimal(value).scaleb(-2)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Decimal) and value.as_tuple().exponent == -2:
+            return value
+        try:
+            # Floats go through repr, so 12.3 is 12.30 rather than 12.2999...
+            return Decimal(str(value) if isinstance(value, float) else value).quantize(CENT)
+        except (InvalidOperation, TypeError, ValueError):
+            raise exceptions.ValidationError(
+                self.error_messages['invalid'], code='invalid', params={'value': value},
+            )
+
+    def get_prep_value(self, value):
+        value = models.Field.get_prep_value(self, value)
+        if value is None:
+            return None
+        return int(self.to_python(value).scaleb(2))
+
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{'form_class': forms.DecimalField, 'decimal_places': 2, **kwargs})
+
+
+class Lookup:
+    """Two-way cache between the names and codes of one lookup table.
+
+    Only committed rows are cached, since a rollback also removes the rows its
+    transaction added and a cached code would then dangle. Inside a transaction
+    a name or code missing from the cache is looked up in the table, which
+    shows that transaction's own rows, and cached once it commits; a rollback
+    discards the on_commit callback with the transaction or savepoint.
+    """
+
+    def __init__(self, model_label):
+        self.model_label = model_label
+        self.codes = {}
+        self.names = {}
+        self.lock = threading.Lock()
+
+    @property
+    def model(self):
+        return apps.get_model(self.model_label)
+
+    def confirm(self, added):
+        with self.lock:
+            for name, code in added.items():
+                self.codes[name] = code
+                self.names[code] = name
+
+    def confirm_on_commit(self, added):
+        if connection.in_atomic_block:
+            transaction.on_commit(lambda: self.confirm(added))
+        else:
+            self.confirm(added)
+
+    def clear(self):
+        with self.lock:
+            self.codes = {}
+            self.names = {}
+
+    def find(self, **filters):
+        """(name, code) of the row matching filters, or None; cached once committed."""
+        row = self.model.objects.filter(**filters).values_list('name', 'id').first()
+        if row is not None:
+            self.confirm_on_commit({row[0]: row[1]})
+        return row
+
+    def code(self, name, create=False):
+        """The code of `name`, adding it to the table with create; None for unknown names."""
+        code = self.codes.get(name)
+        if code is None:
+            row = self.find(name=name)
+            code = None if row is None else row[1]
+        if code is None and create:
+            code = self.add(name)
+        return code
+
+    def name(self, code):
+        if code is None:
+            return None
+        name = self.names.get(code)
+        if name is None:
+            row = self.find(id=code)
+            name = None if row is None else row[0]
+        return name
+
+    def add(self, name):
+        row, _ = self.model.objects.get_or_create(name=name)
+        self.confirm_on_commit({name: row.pk})
+        return row.pk
+
+
+lookups = {}
+
+
+def clear_lookups(**kwargs):
+    # migrate and flush can recreate or empty the lookup tables, so codes cached before them may be stale
+    for lookup in lookups.values():
+        lookup.clear()
+
+
+post_migrate.connect(clear_lookups)
+
+
+class LookupField(models.SmallIntegerField):
+    """A name stored as the small-int code of its row in `lookup_model`, which has a unique `name`."""
+
+    description = 'Name stored as a code into a lookup table'
+
+    def __init__(self, lookup_model, *args, **kwargs):
+        self.lookup_model = lookup_model
+        self.lookup = lookups.setdefault(lookup_model, Lookup(lookup_model))
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        return name, path, [self.lookup_model, *args], kwargs
+
+    def from_db_value(self, value, expression, connection):
+        return self.lookup.name(value)
+
+    def to_python(self, value):
+        if isinstance(value, int):
+            return self.lookup.name(value)
+        return value
+
+    def get_prep_value(self, value):
+        value = models.Field.get_prep_value(self, value)
+        if value is None or isinstance(value, int):
+            return value
+        code = self.lookup.code(str(value))
+        # An unknown name matches no rows. None would, since Django turns `= None` into
+        # IS NULL; codes start at 1, so -1 never matches.
+        return UNKNOWN_CODE if code is None else code
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        # Values being saved, including bulk_update's, arrive unprepared; lookups were prepared above
+        if not prepared and isinstance(value, str):
+            value = self.lookup.code(value, create=True)
+        return super().get_db_prep_value(value, connection, prepared)
+
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{'form_class': forms.CharField, **kwargs})
+
+
+class LookupNames(dict):
+    """{code: name} of a LookupField, filled in as codes are looked up; for rows read with a raw cursor."""
+
+    def __init__(self, field):
+        super().__init__()
+        self.lookup = field.lookup
+
+    def __missing__(self, code):
+        name = self[code] = self.lookup.name(code)
+        return name
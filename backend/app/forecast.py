@@ -0,0 +1,278 @@
+"""
+Cash-flow forecasting: projected daily balances and savings goal attainment.
+
+A forecast starts from the user's cash balance (bank accounts less credit card
+balances) and adds, day by day over the horizon:
+
+- income: the detected paycheck streams on their expected dates, or the average
+  daily income of recent Paycheck rows when no stream has been detected;
+- recurring expenses: every active expense RecurringStream on its expected dates;
+- everything else: a day of spending drawn at random from the user's recent
+  history, from days falling on the same weekday, with the rows belonging to
+  recurring streams taken out so they are not counted twice. Inflows (negative
+  amounts, e.g. refunds and deposits) are left out too: income is counted from
+  paychecks and income streams above.
+
+All scenarios are drawn at once as a (scenarios, days) NumPy array, and the
+spending history is read from the user's columnar snapshot (app/snapshot.py),
+so a forecast costs a few array operations and no scan of the ledger.
+Responses are cached on data_version (see app/cache.py), which every sync
+bumps, and the random draws are seeded from the user and data_version so a
+forecast does not change between syncs.
+
+The snapshot has no descriptions, so the two history readers can disagree on
+rows without a merchant: the ledger reader only takes out those whose
+description matches a description-grouped stream, while the snapshot reader
+takes out any of them close to such a stream's amount. The snapshot's history
+is then a little lower than the ledger's.
+
+Goals are evaluated independently: a goal is reached in a scenario once the
+money saved since today covers target_amount - current_amount.
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from django.db.models import FloatField, Sum
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from app import recurring, snapshot
+from app.models import Account, Paycheck, RecurringStream, SavingsGoal, Transaction
+
+# Days of spending history the daily distribution is drawn from
+HISTORY_DAYS = 180
+# Below this much history every day is drawn from the whole history, not its weekday
+MIN_WEEKDAY_HISTORY = 28
+DEFAULT_MONTHS = 6
+MAX_MONTHS = 24
+DEFAULT_SCENARIOS = 500
+MAX_SCENARIOS = 5000
+PERCENTILES = [10, 50, 90]
+CASH_ACCOUNT_TYPES = ['bank', 'depository']
+CREDIT_ACCOUNT_TYPES = ['credit_card', 'credit']
+
+
+def starting_balance(user):
+    balances = dict(
+        Account.objects.filter(user=user).values('account_type').annotate(total=Sum('balance')).values_list('account_type', 'total')
+    )
+    cash = sum(balances.get(t) or 0 for t in CASH_ACCOUNT_TYPES)
+    owed = sum(balances.get(t) or 0 for t in CREDIT_ACCOUNT_TYPES)
+    return float(cash - owed)
+
+
+def in_stream(stream_amounts, key, amount):
+    for average in stream_amounts.get(key, ()):
+        if abs(amount - average) <= average * recurring.AMOUNT_GAP:
+            return True
+    return False
+
+
+def database_spending(user, expense_streams, since, today):
+    """(day ordinals, amounts) of the non-recurring spending from since up to today, read row by row."""
+    stream_amounts = {}
+    for stream in expense_streams:
+        stream_amounts.setdefault(stream.group_key, []).append(float(stream.average_amount))
+
+    days, amounts = [], []
+    description_keys = {}
+    # Looked up once; timezone.localdate() fetches the current timezone for every row
+    tz = timezone.get_current_timezone()
+    # amount is stored in cents; the database converts it to float dollars
+    rows = Transaction.objects.filter(
+        account__user=user,
+        datetime__gte=timezone.make_aware(datetime.combine(since, datetime.min.time())),
+        datetime__lt=timezone.make_aware(datetime.combine(today, datetime.min.time())),
+        amount__gt=0,
+    ).values_list('datetime', Cast('amount', FloatField()) / 100, 'merchant_id', 'description')
+    for stored_at, amount, merchant_id, description in rows.iterator(chunk_size=5000):
+        if stream_amounts and in_stream(stream_amounts, recurring.group_key(merchant_id, description, description_keys), amount):
+            continue
+        days.append(stored_at.astimezone(tz).toordinal())
+        amounts.append(amount)
+    return np.asarray(days, dtype=np.int64), np.asarray(amounts, dtype=np.float64)
+
+
+def snapshot_spending(user, expense_streams, since, today):
+    """database_spending over the user's columnar snapshot.
+
+    The snapshot has no descriptions, so rows without a merchant are matched to
+    description-grouped streams on amount alone.
+    """
+    ledger = snapshot.load(user)
+    days = ledger.day.astype(np.int64) + snapshot.EPOCH_ORDINAL
+    mask = (days >= since.toordinal()) & (days < today.toordinal()) & (ledger.cents > 0)
+    days, amounts, merchant = days[mask], ledger.cents[mask] / 100, ledger.merchant[mask]
+    recurring_rows = np.zeros(len(days), dtype=bool)
+    for stream in expense_streams:
+        average = float(stream.average_amount)
+        rows = merchant == (stream.merchant_id if stream.group_key.startswith('merchant:') else -1)
+        recurring_rows |= rows & (np.abs(amounts - average) <= average * recurring.AMOUNT_GAP)
+    return days[~recurring_rows], amounts[~recurring_rows]
+
+
+def spending_history(user, expense_streams, today):
+    """Daily totals of non-recurring spending over the last HISTORY_DAYS, oldest first.
+
+    Returns (totals, first day ordinal); empty when the user has no recent transactions.
+    """
+    since = today - timedelta(days=HISTORY_DAYS)
+    if snapshot.enabled():
+        days, amounts = snapshot_spending(user, expense_streams, since, today)
+    else:
+        days, amounts = database_spending(user, expense_streams, since, today)
+    if not len(days):
+        return np.zeros(0), today.toordinal()
+
+    # Days without spending count too, from the first day with any
+    first = int(days.min())
+    totals = np.bincount(days - first, weights=amounts, minlength=today.toordinal() - first)
+    return totals, first
+
+
+def draw_spending(history, first_day, days, scenarios, rng):
+    """(scenarios, len(days)) array of daily spending drawn from history, matching weekdays when possible."""
+    if not len(history):
+        return np.zeros((scenarios, len(days)))
+    if len(history) < MIN_WEEKDAY_HISTORY:
+        return history[rng.integers(0, len(history), size=(scenarios, len(days)))]
+
+    # Group history days by weekday; a draw for weekday w picks uniformly within its group
+    history_weekdays = (first_day + np.arange(len(history))) % 7
+    by_weekday = np.argsort(history_weekdays, kind='stable')
+    counts = np.bincount(history_weekdays, minlength=7)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    weekdays = days % 7
+    picks = offsets[weekdays] + (rng.random((scenarios, len(days))) * counts[weekdays]).astype(np.int64)
+    return history[by_weekday[picks]]
+
+
+def scheduled(streams, start, end):
+    """Daily totals of the streams' expected occurrences from start through end."""
+    totals = np.zeros((end - start).days + 1)
+    for expected, stream in recurring.upcoming(streams, start, end):
+        totals[(expected - start).days] += float(stream.average_amount)
+    return totals
+
+
+def goal_outcome(goal, saved, start, horizon):
+    """Probability of reaching a goal and the median date it is reached, from cumulative savings paths."""
+    needed = float(goal.target_amount - goal.current_amount)
+    result = goal.to_dict()
+    if needed <= 0:
+        result.update({'probability': 1.0, 'expected_date': start.isoformat()})
+        return result
+
+    last = horizon - 1
+    if goal.deadline is not None:
+        last = min(last, (goal.deadline - start).days)
+    if last < 0:
+        result.update({'probability': 0.0, 'expected_date': None})
+        return result
+
+    reached = saved >= needed
+    ever = reached.any(axis=1)
+    first_day = np.where(ever, reached.argmax(axis=1), horizon)
+    probability = float((first_day <= last).mean())
+    # The median is only a date when at least half the scenarios get there within the horizon
+    median = np.median(first_day)
+    result.update({
+        'probability': round(probability, 3),
+        'expected_date': (start + timedelta(days=int(median))).isoformat() if median < horizon else None,
+    })
+    return result
+
+
+def forecast(user, months=DEFAULT_MONTHS, scenarios=DEFAULT_SCENARIOS, today=None):
+    """Project the user's balance over the next `months` months in `scenarios` random scenarios."""
+    today = today or timezone.localdate()
+    end = today + relativedelta(months=months)
+    days = np.arange(today.toordinal(), end.toordinal() + 1)
+    horizon = len(days)
+
+    streams = list(RecurringStream.objects.filter(user=user, is_active=True))
+    expenses = [s for s in streams if s.kind == RecurringStream.KIND_EXPENSE]
+    income_streams = [s for s in streams if s.kind == RecurringStream.KIND_INCOME]
+
+    income = scheduled(income_streams, today, end)
+    if not income_streams:
+        recent = Paycheck.objects.filter(user=user, date__gte=today - timedelta(days=HISTORY_DAYS), date__lte=today)
+        income += float(recent.aggregate(total=Sum('total_amount'))['total'] or 0) / HISTORY_DAYS
+    bills = scheduled(expenses, today, end)
+    history, first_day = spending_history(user, expenses, today)
+
+    rng = np.random.default_rng([user.pk, user.data_version])
+    spending = draw_spending(history, first_day, days, scenarios, rng)
+    # saved[s, d]: money saved from today through day d in scenario s
+    saved = np.cumsum(income - bills - spending, axis=1)
+    balance = starting_balance(user)
+    bands = np.percentile(saved, PERCENTILES, axis=0) + balance
+
+    goals = SavingsGoal.objects.filter(user=user).order_by('deadline', 'id')
+    return {
+        'start': today.isoformat(),
+        'end': end.isoformat(),
+        'scenarios': scenarios,
+        'history_days': len(history),
+        'starting_balance': round(balance, 2),
+        'expected_income': round(float(income.sum()), 2),
+        'expected_bills': round(float(bills.sum()), 2),
+        'expected_spending': round(float(spending.sum(axis=1).mean()), 2),
+        'ending_balance': {f'p{p}': round(float(band[-1]), 2) for p, band in zip(PERCENTILES, bands)},
+        # Share of scenarios in which the balance drops below zero at some point
+        'overdraft_probability': round(float(((saved + balance).min(axis=1) < 0).mean()), 3),
+        'balance': {f'p{p}': np.round(band, 2).tolist() for p, band in zip(PERCENTILES, bands)},
+        'goals': [goal_outcome(goal, saved, today, horizon) for goal in goals],
+    }
+
+
+def parse_amount(value, field):
+    try:
+        amount = Decimal(str(value))
+        # NaN and Infinity parse, but break every comparison and sum after them
+        if not amount.is_finite():
+            raise InvalidOperation
+        return amount.quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f'Invalid {field}: {value}')
+
+
+def parse_date(value, field):
+    try:
+        return datetime.strptime(str(value), '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f'Invalid {field}: {value}, expected YYYY-MM-DD')
+
+
+def validate_goal(data):
+    """Clean SavingsGoal field values from a request, raising ValueError when they are invalid."""
+    values = {}
+    if 'name' in data:
+        values['name'] = (data['name'] or '').strip()[:255]
+        if not values['name']:
+            raise ValueError('name is required')
+    for field in ('target_amount', 'current_amount'):
+        if field in data:
+            values[field] = parse_amount(data[field], field)
+            if values[field] < 0:
+                raise ValueError(f'{field} must not be negative')
+    if 'deadline' in data:
+        values['deadline'] = parse_date(data['deadline'], 'deadline') if data['deadline'] else None
+    return values
+
+
+def validate_paycheck(data):
+    """Clean Paycheck field values from a request, raising ValueError when they are invalid."""
+    values = {}
+    if 'total_amount' in data:
+        values['total_amount'] = parse_amount(data['total_amount'], 'total_amount')
+    if 'date' in data:
+        values['date'] = parse_date(data['date'], 'date')
+    if 'breakdown' in data:
+        breakdown = data['breakdown'] or {}
+        if not isinstance(breakdown, dict):
+            raise ValueError('breakdown must be an object')
+        values['breakdown'] = {str(k): float(parse_amount(v, f'breakdown.{k}')) for k, v in breakdown.items()}
+    return values
@@ -0,0 +1,357 @@
+"""
+Request metrics, timing spans, structured logs and opt-in profiling.
+
+InstrumentationMiddleware times every request and attributes to it the
+database queries (counted by an execute wrapper installed on every connection)
+and Plaid calls (counted by app/plaid_client.py) made while serving it, in
+whichever thread they run. Per endpoint it records:
+
+- http_request_duration_seconds, a latency histogram;
+- http_request_db_queries_total / http_request_db_seconds_total;
+- http_request_plaid_calls_total / http_request_plaid_seconds_total.
+
+span() times a block or function into span_duration_seconds; the db_methods
+functions are wrapped in spans. Everything is rendered in the Prometheus text
+format by render(), served at /metrics. Metrics live in process memory, so each
+server process reports its own.
+
+With settings.PROFILE_REQUESTS on, a request carrying ?profile=1 (or an
+X-Profile: 1 header) runs under cProfile and the stats are written to
+settings.PROFILE_DIR, named in the X-Profile-File response header. For an
+async view only the event loop thread is profiled, not the blocking calls it
+hands to app/aio.py's thread pool.
+"""
+import bisect
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Attributes every LogRecord has; anything else on a record came from `extra`
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{format_labels(self.labels, key)} {value}' for key, value in values]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # Functions returning extra exposition lines, e.g. the Plaid client's counters
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collector in self.collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Time to serve a request', ('endpoint', 'method', 'status')
+)
+request_db_queries = registry.counter(
+    'http_request_db_queries_total', 'Database queries run while serving requests', ('endpoint',)
+)
+request_db_seconds = registry.counter(
+    'http_request_db_seconds_total', 'Time spent in database queries while serving requests', ('endpoint',)
+)
+request_plaid_calls = registry.counter(
+    'http_request_plaid_calls_total', 'Plaid API calls made while serving requests', ('endpoint',)
+)
+request_plaid_seconds = registry.counter(
+    'http_request_plaid_seconds_total', 'Time spent in Plaid API calls while serving requests', ('endpoint',)
+)
+span_duration = registry.histogram('span_duration_seconds', 'Time spent in instrumented functions', ('span',))
+render = registry.render
+
+
+class RequestStats:
+    """What one request has spent so far. Shared by every thread working for the request."""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.plaid_calls = 0
+        self.plaid_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add_query(self, seconds):
+        with self.lock:
+            self.db_queries += 1
+            self.db_seconds += seconds
+
+    def add_plaid_call(self, seconds):
+        with self.lock:
+            self.plaid_calls += 1
+            self.plaid_seconds += seconds
+
+
+# asgiref copies context into the threads sync_to_async runs on, so this follows the request there
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Connection execute wrapper counting queries against the current request."""
+    stats = current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(time.perf_counter() - started)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_wrapper)
+
+
+def record_plaid_call(seconds):
+    """Count a Plaid API call against the current request, if there is one."""
+    stats = current_request.get()
+    if stats is not None:
+        stats.add_plaid_call(seconds)
+
+
+@contextmanager
+def span(name):
+    """Time a block, or a function when used as a decorator, into span_duration_seconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_duration.observe(time.perf_counter() - started, name)
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds the id of the request being served, if any, to log records."""
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            stats = current_request.get()
+            record.request_id = stats.request_id if stats is not None else None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any `extra` fields passed to the log call."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, dt_timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_FIELDS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+profile_lock = threading.Lock()
+
+
+def wants_profile(request):
+    return getattr(settings, 'PROFILE_REQUESTS', False) and (
+        request.GET.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+    )
+
+
+def start_profile(request):
+    # One profiler at a time: Python allows a single active profiler per process from 3.12
+    if not wants_profile(request) or not profile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler):
+    profiler.disable()
+    profile_lock.release()
+
+
+def save_profile(profiler, request, response, stats):
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    path = os.path.join(settings.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint_name(request)}-{stats.request_id}.prof")
+    profiler.dump_stats(path)
+    response['X-Profile-File'] = path
+    logger.info('Profiled request', extra={'profile_file': path})
+
+
+def endpoint_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.view_name or match.route
+
+
+class InstrumentationMiddleware:
+    """Times each request and records its database and Plaid work. Goes first in MIDDLEWARE."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats, token, started = self.start()
+        profiler = start_profile(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+            if profiler is not None:
+                stop_profile(profiler)
+        if profiler is not None:
+            save_profile(profiler, request, response, stats)
+        return self.finish(request, response, stats, started)
+
+    async def __acall__(self, request):
+        stats, token, started = self.start()
+        profiler = start_profile(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+            if profiler is not None:
+                stop_profile(profiler)
+        if profiler is not None:
+            save_profile(profiler, request, response, stats)
+        return self.finish(request, response, stats, started)
+
+    def start(self):
+        stats = RequestStats(uuid.uuid4().hex[:12])
+        return stats, current_request.set(stats), time.perf_counter()
+
+    def finish(self, request, response, stats, started):
+        elapsed = time.perf_counter() - started
+        endpoint = endpoint_name(request)
+        request_duration.observe(elapsed, endpoint, request.method, response.status_code)
+        request_db_queries.inc(endpoint, amount=stats.db_queries)
+        request_db_seconds.inc(endpoint, amount=stats.db_seconds)
+        request_plaid_calls.inc(endpoint, amount=stats.plaid_calls)
+        request_plaid_seconds.inc(endpoint, amount=stats.plaid_seconds)
+
+        response['Server-Timing'] = (
+            f'total;dur={elapsed * 1000:.1f}, db;dur={stats.db_seconds * 1000:.1f}, plaid;dur={stats.plaid_seconds * 1000:.1f}'
+        )
+        response['X-Request-ID'] = stats.request_id
+        logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+            'request_id': stats.request_id,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 2),
+            'db_queries': stats.db_queries,
+            'db_ms': round(stats.db_seconds * 1000, 2),
+            'plaid_calls': stats.plaid_calls,
+            'plaid_ms': round(stats.plaid_seconds * 1000, 2),
+        })
+        return response
@@ -0,0 +1,234 @@
+"""
+Background jobs backed by the app_job table.
+
+Handlers are registered by kind with @register (see app/tasks.py) and jobs are
+enqueued with enqueue(). The backend is chosen by settings.JOB_BACKEND:
+
+- DatabaseBackend (default) stores the job and leaves it for
+  `manage.py run_jobs` workers to pick up.
+- ImmediateBackend stores the job and runs it inline, which is handy when
+  developing without a worker.
+"""
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from app.models import Job
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+# Seconds before a failed job is retried, doubled on every attempt
+RETRY_BASE_DELAY = 10
+
+
+def register(kind):
+    """Decorator registering a job handler. Handlers receive the Job and return a JSON-able result."""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+class DatabaseBackend:
+    def enqueue(self, kind, user=None, payload=None, delay=0, dedupe_key='', max_attempts=3):
+        while True:
+            if dedupe_key:
+                existing = Job.objects.filter(dedupe_key=dedupe_key, status=Job.STATUS_QUEUED).first()
+                if existing is not None:
+                    return existing
+            try:
+                with transaction.atomic():
+                    return Job.objects.create(
+                        kind=kind,
+                        user=user,
+                        payload=payload or {},
+                        run_at=timezone.now() + timedelta(seconds=delay),
+                        dedupe_key=dedupe_key,
+                        max_attempts=max_attempts,
+                    )
+            except IntegrityError:
+                # unique_queued_job_dedupe_key: another enqueue queued the same job after
+                # our check. Look again; it may have been claimed in the meantime.
+                if not dedupe_key:
+                    raise
+
+
+class ImmediateBackend(DatabaseBackend):
+    def enqueue(self, kind, user=None, payload=None, delay=0, dedupe_key='', max_attempts=3):
+        job = super().enqueue(kind, user, payload, 0, dedupe_key, max_attempts)
+        if job.status == Job.STATUS_QUEUED:
+            Job.objects.filter(pk=job.pk).update(
+                status=Job.STATUS_RUNNING, locked_at=timezone.now(), locked_by='immediate', attempts=F('attempts') + 1
+            )
+            job.refresh_from_db()
+            run_job(job)
+        return job
+
+
+def get_backend():
+    return import_string(getattr(settings, 'JOB_BACKEND', 'app.jobs.DatabaseBackend'))()
+
+
+def enqueue(kind, user=None, delay=0, dedupe_key='', max_attempts=3, **payload):
+    """Queue a job of the given kind and return its Job row."""
+    if kind not in HANDLERS:
+        # Handlers live in app.tasks; make sure they are registered
+        import app.tasks  # noqa: F401
+    if kind not in HANDLERS:
+        raise ValueError(f"No job handler registered for {kind}")
+    return get_backend().enqueue(kind, user, payload, delay, dedupe_key, max_attempts)
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lock_timeout():
+    return getattr(settings, 'JOB_LOCK_TIMEOUT', 600)
+
+
+def retry_at(attempts):
+    return timezone.now() + timedelta(seconds=RETRY_BASE_DELAY * 2 ** (attempts - 1))
+
+
+def requeue_stale_jobs():
+    """Recover jobs whose worker died mid-run (lock older than JOB_LOCK_TIMEOUT).
+
+    The lost run counts as an attempt, which was taken when the job was claimed:
+    a job with attempts left goes back on the queue with the usual backoff, and
+    one that has used them all, e.g. because it keeps crashing its worker, fails.
+    """
+    cutoff = timezone.now() - timedelta(seconds=lock_timeout())
+    requeued = 0
+    for job in Job.objects.filter(status=Job.STATUS_RUNNING, locked_at__lt=cutoff):
+        stale = Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING, locked_at=job.locked_at)
+        error = 'Worker lost while running the job'
+        if job.attempts < job.max_attempts:
+            try:
+                with transaction.atomic():
+                    requeued += stale.update(
+                        status=Job.STATUS_QUEUED, run_at=retry_at(job.attempts), locked_at=None, locked_by='',
+                        error=error, updated_at=timezone.now(),
+                    )
+                continue
+            except IntegrityError:
+                error = superseded(error, job)
+        if stale.update(
+            status=Job.STATUS_FAILED, locked_at=None, locked_by='', error=error, updated_at=timezone.now(),
+        ):
+            logger.error('Job %s (%s) failed: %s', job.pk, job.kind, error)
+    return requeued
+
+
+def superseded(error, job):
+    """`error` for a job that cannot be retried because an identical job is already queued."""
+    queued = Job.objects.filter(dedupe_key=job.dedupe_key, status=Job.STATUS_QUEUED).values_list('pk', flat=True).first()
+    return f"{error}; job {queued} is queued to run it again"
+
+
+def claim_next_job(worker=None):
+    """Atomically claim the next due job for this worker, or return None if the queue is empty."""
+    worker = worker or worker_id()
+    due = Job.objects.filter(status=Job.STATUS_QUEUED, run_at__lte=timezone.now()).order_by('run_at', 'id')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = due.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            job.status = Job.STATUS_RUNNING
+            job.locked_at = timezone.now()
+            job.locked_by = worker
+            job.attempts += 1
+            job.save(update_fields=['status', 'locked_at', 'locked_by', 'attempts', 'updated_at'])
+            return job
+
+    # Without SKIP LOCKED (e.g. SQLite), claim optimistically: only one worker's
+    # conditional UPDATE can move a given row out of the queued state
+    for job_id in due.values_list('id', flat=True)[:10]:
+        claimed = Job.objects.filter(pk=job_id, status=Job.STATUS_QUEUED).update(
+            status=Job.STATUS_RUNNING, locked_at=timezone.now(), locked_by=worker, attempts=F('attempts') + 1
+        )
+        if claimed:
+            return Job.objects.get(pk=job_id)
+    return None
+
+
+@contextmanager
+def heartbeat(job, interval=None):
+    """Refresh the job's locked_at every `interval` seconds (a third of JOB_LOCK_TIMEOUT) while the block runs.
+
+    A long job then keeps its lock, and only a job whose worker died stops
+    beating and is picked up by requeue_stale_jobs().
+    """
+    interval = interval or lock_timeout() / 3
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                try:
+                    Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING, locked_by=job.locked_by).update(
+                        locked_at=timezone.now()
+                    )
+                except Exception:
+                    logger.exception('Heartbeat of job %s failed', job.pk)
+        finally:
+            # The thread has its own connection
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, name=f'job-{job.pk}-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_job(job):
+    """Run a claimed job, recording its result or scheduling a retry on failure.
+
+    The attempt was counted when the job was claimed. A failure is logged with
+    its traceback; the job only keeps the exception's class and message, since
+    Job.to_dict() shows it to the user.
+    """
+    if job.kind not in HANDLERS:
+        import app.tasks  # noqa: F401
+
+    try:
+        handler = HANDLERS[job.kind]
+        with heartbeat(job):
+            job.result = handler(job)
+        job.status = Job.STATUS_SUCCEEDED
+        job.error = ''
+    except Exception as e:
+        logger.exception('Job %s (%s) failed on attempt %s of %s', job.pk, job.kind, job.attempts, job.max_attempts)
+        job.error = f"{e.__class__.__name__}: {e}"
+        if job.attempts < job.max_attempts:
+            job.status = Job.STATUS_QUEUED
+            job.run_at = retry_at(job.attempts)
+        else:
+            job.status = Job.STATUS_FAILED
+    job.locked_at = None
+    job.locked_by = ''
+    try:
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        # The same job was enqueued again while this one ran; that run replaces the retry
+        job.status = Job.STATUS_FAILED
+        job.error = superseded(job.error, job)
+        job.save()
+    return job
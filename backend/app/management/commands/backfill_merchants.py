@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+from django.db.models import F
+from app.models import User, Transaction
+from app import merchants, snapshot
+import time
+
+class Command(BaseCommand):
+    help = 'Links transactions stored before merchant resolution to their Merchant'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        pending = Transaction.objects.filter(merchant__isnull=True, merchant_name__isnull=False).exclude(merchant_name='')
+        last_id = 0
+        linked = 0
+        while True:
+            # Keyset batches, so no read cursor stays open while the same rows are updated
+            batch = list(pending.filter(id__gt=last_id).order_by('id').values_list('id', 'merchant_name')[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            with db_transaction.atomic():
+                merchant_ids = merchants.resolve([name for _, name in batch])
+                rows = [Transaction(id=pk, merchant_id=merchant_ids[name]) for pk, name in batch if name in merchant_ids]
+                Transaction.objects.bulk_update(rows, ['merchant'], batch_size=500)
+            linked += len(rows)
+
+        if linked:
+            # Merchant analytics are cached per data version
+            User.objects.update(data_version=F('data_version') + 1)
+            # Snapshots hold merchant ids and are rebuilt on next use
+            snapshot.clear()
+        self.stdout.write(
+            self.style.SUCCESS(f'Linked {linked} transactions to merchants in {time.monotonic() - started:.1f}s')
+        )
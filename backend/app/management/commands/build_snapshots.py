@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import User
+from app import snapshot
+import time
+
+class Command(BaseCommand):
+    help = 'Rebuilds the columnar transaction snapshots analytics and forecasts read'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only rebuild this username\'s snapshot')
+
+    def handle(self, *args, **options):
+        if not snapshot.enabled():
+            raise CommandError('SNAPSHOT_DIR is not set')
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(username=options['user'])
+
+        started = time.monotonic()
+        user_count = row_count = 0
+        for user in users.iterator():
+            row_count += len(snapshot.refresh(user, rebuild=True))
+            user_count += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Built snapshots of {row_count} transactions for {user_count} users in {time.monotonic() - started:.1f}s'
+            )
+        )
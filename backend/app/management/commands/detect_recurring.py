@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from app.models import User
+from app import recurring
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Re-detects recurring charges, subscriptions and paychecks for every user (run nightly by refresh_transactions.sh)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only detect streams for this username')
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(username=options['user'])
+
+        started = time.monotonic()
+        user_count = stream_count = failures = 0
+        for user in users.iterator():
+            try:
+                streams = recurring.refresh_streams(user)
+            except Exception as e:
+                failures += 1
+                logger.error(f'Recurring detection failed for user {user.username}: {e}')
+                continue
+            user_count += 1
+            stream_count += streams
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Detected {stream_count} recurring streams for {user_count} users '
+                f'({failures} failed) in {time.monotonic() - started:.1f}s'
+            )
+        )
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import User
+from app import statements
+import time
+
+class Command(BaseCommand):
+    help = 'Imports CSV or OFX bank statements into one account of a user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Statement files to import')
+        parser.add_argument('--user', required=True, help='Username owning the account')
+        parser.add_argument('--account', required=True, help='account_id to import into; created if the user has none with that id')
+        parser.add_argument('--account-name', help='Name for a newly created account')
+        parser.add_argument('--institution', help='Institution for a newly created account')
+        parser.add_argument('--format', choices=statements.FORMATS, help='Statement format (defaults to the file extension)')
+        parser.add_argument('--date-format', help='strptime format of CSV dates, e.g. %%d/%%m/%%Y')
+        parser.add_argument('--expenses-positive', action='store_true', help='CSV amounts are already positive for money spent')
+        parser.add_argument('--batch-size', type=int, default=statements.IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['user']}")
+        account = statements.statement_account(
+            user, options['account'], name=options['account_name'], institution=options['institution']
+        )
+
+        for path in options['paths']:
+            started = time.monotonic()
+            try:
+                statement_format = statements.detect_format(path, options['format'])
+                with open(path, encoding='utf-8-sig', errors='replace', newline='') as stream:
+                    records = statements.parse_statement(
+                        stream,
+                        statement_format,
+                        date_format=options['date_format'],
+                        expenses_negative=not options['expenses_positive'],
+                    )
+                    summary = statements.import_statement(user, account, records, batch_size=options['batch_size'])
+            except statements.StatementError as e:
+                raise CommandError(f'{path}: {e}')
+
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{path}: imported {summary['imported']} of {summary['rows']} rows "
+                    f"({summary['duplicates']} duplicates, {summary['skipped_income']} income) "
+                    f"in {elapsed:.1f}s, {summary['rows'] / elapsed if elapsed else 0:.0f} rows/s"
+                )
+            )
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from app.models import User
+from app import rollups
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Rebuilds the MonthlySpending rollups from the transaction ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only rebuild rollups for this username')
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(username=options['user'])
+
+        started = time.monotonic()
+        total_months = 0
+        for user in users.iterator():
+            months = rollups.rebuild(user)
+            total_months += months
+            logger.info(f"Rebuilt {months} months for user: {user.username}")
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Rebuilt {total_months} monthly rollups for {users.count()} users in {time.monotonic() - started:.1f}s'
+            )
+        )
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from app.models import User
+from app import categorize
+import time
+
+class Command(BaseCommand):
+    help = "Re-applies users' category rules to their stored transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only recategorize transactions of this username')
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(username=options['user'])
+
+        started = time.monotonic()
+        scanned = changed = 0
+        for user in users.iterator():
+            summary = categorize.recategorize(user)
+            scanned += summary['scanned']
+            changed += summary['changed']
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Recategorized {changed} of {scanned} transactions in {elapsed:.1f}s '
+                f'({scanned / elapsed if elapsed else 0:.0f} rows/s)'
+            )
+        )
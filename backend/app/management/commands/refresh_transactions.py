@@ -1,52 +1,104 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from django.core.management.base import BaseCommand
-from app.models import User, Account
-from app.db_methods import refresh_transactions_for_account
+from django.db import connection
+from app.models import User, Account, Cursor
+from app import sync
 from django.utils import timezone
+from datetime import timedelta
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
 class Command(BaseCommand):
-    help = 'Refreshes transactions for all accounts of all users'
+    help = 'Refreshes transactions for every linked Plaid item, syncing items in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Number of items synced concurrently')
+        parser.add_argument('--timeout', type=float, default=120, help='Seconds allowed per item before it is abandoned')
+        parser.add_argument('--user', help='Only refresh items belonging to this username')
+        parser.add_argument(
+            '--stale-hours', type=float,
+            help='Skip items synced within this many hours, e.g. because a webhook reported their changes'
+        )
 
-    def handle(self, *args, **kwargs):
+    def refresh_item(self, access_token, user, timeout):
+        started = time.monotonic()
+        try:
+            summary = sync.sync_item(access_token, user, timeout=timeout)
+            return summary, None, time.monotonic() - started
+        except Exception as e:
+            return None, e, time.monotonic() - started
+        finally:
+            # Each worker thread has its own database connection
+            connection.close()
+
+    def handle(self, *args, **options):
         start_time = timezone.now()
         logger.info(f"Starting transaction refresh at {start_time}")
-        
-        try:
-            # Get all users
-            users = User.objects.all()
-            total_accounts = 0
-            successful_refreshes = 0
-            
-            for user in users:
-                logger.info(f"Processing accounts for user: {user.name}")
-                accounts = Account.objects.filter(user=user)
-                
-                for account in accounts:
-                    total_accounts += 1
-                    try:
-                        refresh_transactions_for_account(account)
-                        successful_refreshes += 1
-                        logger.info(f"Successfully refreshed transactions for account: {account.name}")
-                    except Exception as e:
-                        logger.error(f"Error refreshing transactions for account {account.name}: {str(e)}")
-            
-            end_time = timezone.now()
-            duration = end_time - start_time
-            
-            logger.info(f"Transaction refresh completed at {end_time}")
-            logger.info(f"Duration: {duration}")
-            logger.info(f"Processed {total_accounts} accounts, {successful_refreshes} successful refreshes")
-            
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'Successfully refreshed transactions for {successful_refreshes}/{total_accounts} accounts'
-                )
+
+        # Plaid syncs per item (access token), so sync each one once however many accounts it has
+        accounts = Account.objects.exclude(access_token=Account.MANUAL_ACCESS_TOKEN)
+        if options['user']:
+            accounts = accounts.filter(user__username=options['user'])
+        items = dict(accounts.values_list('access_token', 'user_id').distinct())
+        if options['stale_hours'] is not None:
+            fresh = set(
+                Cursor.objects.filter(synced_at__gte=timezone.now() - timedelta(hours=options['stale_hours']))
+                .values_list('access_token', flat=True)
             )
-            
-        except Exception as e:
-            logger.error(f"Fatal error during transaction refresh: {str(e)}")
-            self.stdout.write(
-                self.style.ERROR(f'Error refreshing transactions: {str(e)}')
-            ) 
\ No newline at end of file
+            items = {access_token: user_id for access_token, user_id in items.items() if access_token not in fresh}
+        users = User.objects.in_bulk(set(items.values()))
+
+        latencies = []
+        failures = Counter()
+        totals = Counter()
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                executor.submit(self.refresh_item, access_token, users[user_id], options['timeout']): access_token
+                for access_token, user_id in items.items()
+            }
+            for future in as_completed(futures):
+                summary, error, latency = future.result()
+                latencies.append(latency)
+                if error is not None:
+                    failures[error.__class__.__name__] += 1
+                    logger.error(f"Error refreshing item {futures[future][-6:]}: {error}")
+                    continue
+                totals.update(summary)
+
+        elapsed = time.monotonic() - started
+        latencies.sort()
+        succeeded = len(items) - sum(failures.values())
+
+        logger.info(f"Transaction refresh completed at {timezone.now()}")
+        self.stdout.write(
+            f'Items: {len(items)} ({succeeded} succeeded, {sum(failures.values())} failed) '
+            f'in {elapsed:.1f}s with {options["workers"]} workers'
+        )
+        self.stdout.write(
+            f'Throughput: {len(items) / elapsed if elapsed else 0:.2f} items/s, '
+            f'{totals["pages"] / elapsed if elapsed else 0:.2f} pages/s'
+        )
+        self.stdout.write(
+            f'Item latency: p50 {percentile(latencies, 50):.2f}s, p90 {percentile(latencies, 90):.2f}s, '
+            f'p99 {percentile(latencies, 99):.2f}s, max {latencies[-1] if latencies else 0:.2f}s'
+        )
+        self.stdout.write(
+            f'Rows: {totals["added"]} added, {totals["updated"]} updated, {totals["removed"]} removed, '
+            f'{totals["restarts"]} pagination restarts'
+        )
+        for error_name, count in failures.most_common():
+            self.stdout.write(self.style.ERROR(f'  {error_name}: {count} items'))
+
+        style = self.style.SUCCESS if not failures else self.style.WARNING
+        self.stdout.write(style(f'Successfully refreshed transactions for {succeeded}/{len(items)} items'))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from plaid.model.item_webhook_update_request import ItemWebhookUpdateRequest
+from app.models import Account, User
+from app.plaid_client import client, PLAID_WEBHOOK_URL
+import app.db_methods as db
+import plaid
+
+class Command(BaseCommand):
+    help = 'Points every linked Plaid item at PLAID_WEBHOOK_URL and records its item_id for incoming webhooks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only register items belonging to this username')
+
+    def handle(self, *args, **options):
+        if not PLAID_WEBHOOK_URL:
+            raise CommandError('PLAID_WEBHOOK_URL is not set')
+        accounts = Account.objects.exclude(access_token=Account.MANUAL_ACCESS_TOKEN)
+        if options['user']:
+            accounts = accounts.filter(user__username=options['user'])
+        items = dict(accounts.values_list('access_token', 'user_id').distinct())
+        users = User.objects.in_bulk(set(items.values()))
+
+        registered = 0
+        for access_token, user_id in items.items():
+            request = ItemWebhookUpdateRequest(access_token=access_token, webhook=PLAID_WEBHOOK_URL)
+            try:
+                response = client.item_webhook_update(request)
+            except plaid.ApiException as e:
+                self.stdout.write(self.style.ERROR(f'Item {access_token[-6:]}: {e.body}'))
+                continue
+            db.record_item(users[user_id], access_token, response.item.item_id)
+            registered += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Registered {PLAID_WEBHOOK_URL} for {registered}/{len(items)} items'))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from app import jobs
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (token exchanges, transaction syncs)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--burst', action='store_true', help='Exit once the queue is empty instead of polling')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Seconds to wait between polls of an empty queue')
+        parser.add_argument('--max-jobs', type=int, default=0, help='Exit after running this many jobs (0 = no limit)')
+
+    def handle(self, *args, **options):
+        worker = jobs.worker_id()
+        processed = 0
+        self.stdout.write(f'Worker {worker} started')
+
+        while not options['max_jobs'] or processed < options['max_jobs']:
+            close_old_connections()
+            requeued = jobs.requeue_stale_jobs()
+            if requeued:
+                logger.warning(f"Requeued {requeued} stale jobs")
+
+            job = jobs.claim_next_job(worker)
+            if job is None:
+                if options['burst']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            started = time.monotonic()
+            job = jobs.run_job(job)
+            processed += 1
+            message = f'Job {job.id} ({job.kind}) {job.status} in {time.monotonic() - started:.2f}s'
+            if job.status == job.STATUS_SUCCEEDED:
+                self.stdout.write(self.style.SUCCESS(message))
+            else:
+                self.stdout.write(self.style.ERROR(f'{message}: {job.error.splitlines()[0]}'))
+
+        self.stdout.write(f'Worker {worker} processed {processed} jobs')
@@ -0,0 +1,113 @@
+"""
+Resolves free-text merchant names to Merchant rows.
+
+Every spelling seen is stored once as a MerchantAlias, so resolving a known name
+is a single lookup. A new spelling is normalized (store numbers, payment
+processor prefixes, domains and legal suffixes removed) and attached to the
+Merchant with that key, creating it if needed; "AMAZON MKTPLACE" and
+"Amazon.com" both end up on the "amazon" merchant.
+
+Resolved aliases are kept in a bounded in-process LRU, so syncing a page only
+queries the database for names this process has not seen recently.
+"""
+import re
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+
+from app.cache import CacheStats, LRUCacheBackend
+from app.models import Merchant, MerchantAlias
+
+PROCESSOR_PREFIX = re.compile(r'^(?:sq|tst|sp|pp|paypal|py|ckc|bt|in)\s*\*\s*')
+REFERENCE_SUFFIX = re.compile(r'\*\S*$')
+DOMAIN = re.compile(r'\.(?:com|net|org|co)\b')
+NON_WORD = re.compile(r'[^a-z0-9&]+')
+NOISE_WORDS = {'inc', 'llc', 'ltd', 'co', 'corp', 'mktp', 'mktplace', 'marketplace', 'store', 'stores', 'us', 'usa', 'online'}
+# Abbreviations payment networks commonly use for the same merchant
+KEY_ALIASES = {
+    'amzn': 'amazon',
+    'wm supercenter': 'walmart',
+    'wal mart': 'walmart',
+}
+
+
+def alias_of(name):
+    return ' '.join(name.split()).casefold()[:255]
+
+
+def merchant_key(name):
+    """Normalized key merchant names are grouped on."""
+    key = alias_of(name)
+    key = PROCESSOR_PREFIX.sub('', key)
+    key = REFERENCE_SUFFIX.sub('', key)
+    key = DOMAIN.sub('', key).replace("'", '')
+    # Store numbers and references have several digits; "7-Eleven" keeps its 7
+    words = [w for w in NON_WORD.sub(' ', key).split() if w not in NOISE_WORDS and sum(c.isdigit() for c in w) < 3]
+    key = ' '.join(words) or alias_of(name)
+    return KEY_ALIASES.get(key, key)
+
+
+class MerchantResolver:
+    def __init__(self, max_entries=10000):
+        self.cache = LRUCacheBackend(max_entries)
+        self.stats = CacheStats()
+
+    def resolve(self, names):
+        """Map each non-empty merchant name to its Merchant id, creating merchants as needed."""
+        result = {}
+        missing = {}
+        for name in set(names):
+            if not name or not name.strip():
+                continue
+            alias = alias_of(name)
+            merchant_id = self.cache.get(alias)
+            if merchant_id is None:
+                self.stats.incr('misses')
+                missing.setdefault(alias, []).append(name)
+            else:
+                self.stats.incr('hits')
+                result[name] = merchant_id
+        if not missing:
+            return result
+
+        found = self.load({alias: names[0] for alias, names in missing.items()})
+        for alias, alias_names in missing.items():
+            for name in alias_names:
+                result[name] = found[alias]
+        # Only cache ids once they are committed; a rolled back page must not leave
+        # ids of merchants that were never stored behind
+        db_transaction.on_commit(lambda: [self.cache.set(alias, found[alias]) for alias in missing])
+        return result
+
+    def load(self, names):
+        """Merchant ids for {alias: name}, creating merchants and aliases that do not exist yet."""
+        found = dict(MerchantAlias.objects.filter(alias__in=list(names)).values_list('alias', 'merchant_id'))
+        new = {alias: name for alias, name in names.items() if alias not in found}
+        if not new:
+            return found
+
+        keys = {alias: merchant_key(name) for alias, name in new.items()}
+        names_by_key = {}
+        for alias, key in keys.items():
+            names_by_key.setdefault(key, new[alias].strip()[:255])
+        # ignore_conflicts: another worker may be creating the same merchants and aliases
+        Merchant.objects.bulk_create(
+            [Merchant(key=key, name=name) for key, name in names_by_key.items()], ignore_conflicts=True
+        )
+        merchant_ids = dict(Merchant.objects.filter(key__in=list(names_by_key)).values_list('key', 'id'))
+        MerchantAlias.objects.bulk_create(
+            [MerchantAlias(alias=alias, merchant_id=merchant_ids[key]) for alias, key in keys.items()],
+            ignore_conflicts=True,
+        )
+        found.update(MerchantAlias.objects.filter(alias__in=list(new)).values_list('alias', 'merchant_id'))
+        return found
+
+    def clear(self):
+        self.cache.clear()
+
+
+resolver = MerchantResolver(getattr(settings, 'MERCHANT_CACHE_SIZE', 10000))
+
+
+def resolve(names):
+    return resolver.resolve(names)
@@ -0,0 +1,61 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:37
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min
+
+
+def remove_duplicate_rows(apps, schema_editor):
+    # Re-synced pages used to insert the same transaction more than once; keep the
+    # oldest copy so the unique constraints below can be created.
+    Transaction = apps.get_model('app', 'Transaction')
+    duplicates = (
+        Transaction.objects.values('transaction_id', 'account')
+        .annotate(keep_id=Min('id'), copies=Count('id'))
+        .filter(copies__gt=1)
+    )
+    for row in duplicates.iterator():
+        Transaction.objects.filter(
+            transaction_id=row['transaction_id'], account=row['account']
+        ).exclude(id=row['keep_id']).delete()
+
+    # Keep the most recently written cursor for each access token
+    Cursor = apps.get_model('app', 'Cursor')
+    duplicates = (
+        Cursor.objects.values('access_token')
+        .annotate(keep_id=Max('id'), copies=Count('id'))
+        .filter(copies__gt=1)
+    )
+    for row in duplicates.iterator():
+        Cursor.objects.filter(access_token=row['access_token']).exclude(id=row['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='account',
+            name='account_id',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(fields=['user', 'access_token'], name='account_user_access_token'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['account', 'datetime'], name='transaction_account_datetime'),
+        ),
+        migrations.RunPython(remove_duplicate_rows, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cursor',
+            constraint=models.UniqueConstraint(fields=('access_token',), name='unique_cursor_access_token'),
+        ),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(fields=('transaction_id', 'account'), name='unique_transaction_per_account'),
+        ),
+    ]
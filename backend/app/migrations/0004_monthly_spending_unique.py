@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_job'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='monthlyspending',
+            constraint=models.UniqueConstraint(fields=('user', 'year', 'month'), name='unique_monthly_spending_per_month'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def copy_plaid_category(apps, schema_editor):
+    # Until now transaction_type held Plaid's category unchanged
+    Transaction = apps.get_model('app', 'Transaction')
+    Transaction.objects.update(plaid_category=models.F('transaction_type'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_user_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='plaid_category',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='transaction_type',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.RunPython(copy_plaid_category, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='CategoryRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=100)),
+                ('merchant_name', models.CharField(blank=True, default='', max_length=255)),
+                ('description_pattern', models.CharField(blank=True, default='', max_length=255)),
+                ('min_amount', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('max_amount', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('payment_channel', models.CharField(blank=True, default='', max_length=255)),
+                ('priority', models.IntegerField(default=0)),
+                ('enabled', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-priority', 'id'],
+            },
+        ),
+    ]
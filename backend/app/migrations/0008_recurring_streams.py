@@ -0,0 +1,42 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_merchants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringStream',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('expense', 'Expense'), ('income', 'Income')], default='expense', max_length=10)),
+                ('group_key', models.CharField(max_length=255)),
+                ('amount_band', models.IntegerField()),
+                ('name', models.CharField(max_length=255)),
+                ('frequency', models.CharField(choices=[('weekly', 'Weekly'), ('biweekly', 'Biweekly'), ('monthly', 'Monthly'), ('annual', 'Annual')], max_length=20)),
+                ('interval_days', models.FloatField()),
+                ('average_amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('last_amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('first_date', models.DateField()),
+                ('last_date', models.DateField()),
+                ('next_date', models.DateField()),
+                ('occurrences', models.IntegerField()),
+                ('confidence', models.FloatField()),
+                ('is_active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('merchant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.merchant')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'next_date'], name='recurring_user_next_date')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'group_key', 'amount_band'), name='unique_recurring_stream')],
+            },
+        ),
+    ]
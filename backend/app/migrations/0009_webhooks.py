@@ -0,0 +1,41 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_recurring_streams'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cursor',
+            name='item_id',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='cursor',
+            name='synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('webhook_type', models.CharField(max_length=100)),
+                ('webhook_code', models.CharField(max_length=100)),
+                ('item_id', models.CharField(blank=True, default='', max_length=255)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('ignored', 'Ignored'), ('unknown_item', 'Unknown item')], max_length=20)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.job')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['fingerprint', 'received_at'], name='webhook_fingerprint_received'), models.Index(fields=['item_id', 'received_at'], name='webhook_item_received')],
+            },
+        ),
+    ]
@@ -0,0 +1,160 @@
+# Generated by Django 5.1.4 on 2026-10-18 21:05
+#
+# Money columns become integer cents and Transaction's category and payment
+# channel columns become codes into the new Category and PaymentChannel tables.
+# Each column is converted through a temporary one: add it, fill it from the old
+# column, drop the old column and rename the new one into its place.
+
+from decimal import Decimal
+
+import app.fields
+from django.db import migrations, models
+from django.db.models import BigIntegerField, F, OuterRef, Subquery
+from django.db.models.functions import Cast, Round
+
+# (model, field, definition before this migration)
+MONEY_FIELDS = [
+    ('account', 'balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+    ('transaction', 'amount', models.DecimalField(decimal_places=2, max_digits=12)),
+    ('savingsgoal', 'target_amount', models.DecimalField(decimal_places=2, max_digits=12)),
+    ('savingsgoal', 'current_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+    ('paycheck', 'total_amount', models.DecimalField(decimal_places=2, max_digits=12)),
+]
+# (Transaction field, lookup model, definition before this migration)
+CODE_FIELDS = [
+    ('transaction_type', 'Category', models.CharField(max_length=100)),
+    ('plaid_category', 'Category', models.CharField(blank=True, default='', max_length=100)),
+    ('payment_channel', 'PaymentChannel', models.CharField(blank=True, max_length=255, null=True)),
+]
+
+
+def nullable(field):
+    _, _, args, kwargs = field.deconstruct()
+    return field.__class__(*args, **{**kwargs, 'null': True})
+
+
+def encode(apps, schema_editor):
+    for model_name, name, _ in MONEY_FIELDS:
+        model = apps.get_model('app', model_name)
+        model.objects.update(**{f'{name}_cents': Cast(Round(F(name) * 100), BigIntegerField())})
+
+    Transaction = apps.get_model('app', 'Transaction')
+    for name, lookup_name, _ in CODE_FIELDS:
+        lookup = apps.get_model('app', lookup_name)
+        names = set(Transaction.objects.exclude(**{f'{name}__isnull': True}).values_list(name, flat=True).distinct())
+        names -= set(lookup.objects.values_list('name', flat=True))
+        lookup.objects.bulk_create([lookup(name=n) for n in sorted(names)])
+        Transaction.objects.update(**{
+            f'{name}_code': Subquery(lookup.objects.filter(name=OuterRef(name)).values('id')[:1]),
+        })
+
+
+def decode(apps, schema_editor):
+    for model_name, name, _ in MONEY_FIELDS:
+        model = apps.get_model('app', model_name)
+        model.objects.update(**{name: F(f'{name}_cents') * Decimal('0.01')})
+
+    Transaction = apps.get_model('app', 'Transaction')
+    for name, lookup_name, _ in CODE_FIELDS:
+        lookup = apps.get_model('app', lookup_name)
+        Transaction.objects.update(**{
+            name: Subquery(lookup.objects.filter(id=OuterRef(f'{name}_code')).values('name')[:1]),
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_webhooks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PaymentChannel',
+            fields=[
+                ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        *[
+            migrations.AddField(model_name=model_name, name=f'{name}_cents', field=models.BigIntegerField(null=True))
+            for model_name, name, _ in MONEY_FIELDS
+        ],
+        *[
+            migrations.AddField(model_name='transaction', name=f'{name}_code', field=models.SmallIntegerField(null=True))
+            for name, _, _ in CODE_FIELDS
+        ],
+        # Nullable, so that when migrating backwards the old columns can be added back before decode() fills them
+        *[
+            migrations.AlterField(model_name=model_name, name=name, field=nullable(field))
+            for model_name, name, field in MONEY_FIELDS
+        ],
+        *[
+            migrations.AlterField(model_name='transaction', name=name, field=nullable(field))
+            for name, _, field in CODE_FIELDS
+        ],
+        migrations.RunPython(encode, decode),
+        *[
+            operation
+            for model_name, name, _ in MONEY_FIELDS
+            for operation in (
+                migrations.RemoveField(model_name=model_name, name=name),
+                migrations.RenameField(model_name=model_name, old_name=f'{name}_cents', new_name=name),
+            )
+        ],
+        *[
+            operation
+            for name, _, _ in CODE_FIELDS
+            for operation in (
+                migrations.RemoveField(model_name='transaction', name=name),
+                migrations.RenameField(model_name='transaction', old_name=f'{name}_code', new_name=name),
+            )
+        ],
+        migrations.AlterField(
+            model_name='account',
+            name='balance',
+            field=app.fields.CentsField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='amount',
+            field=app.fields.CentsField(),
+        ),
+        migrations.AlterField(
+            model_name='savingsgoal',
+            name='target_amount',
+            field=app.fields.CentsField(),
+        ),
+        migrations.AlterField(
+            model_name='savingsgoal',
+            name='current_amount',
+            field=app.fields.CentsField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='paycheck',
+            name='total_amount',
+            field=app.fields.CentsField(),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='transaction_type',
+            field=app.fields.LookupField('app.Category'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='plaid_category',
+            field=app.fields.LookupField('app.Category', blank=True, default=''),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='payment_channel',
+            field=app.fields.LookupField('app.PaymentChannel', blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 21:40
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_queued_jobs(apps, schema_editor):
+    # Concurrent enqueues could each insert a queued job for the same key; the
+    # oldest one does the work of all of them
+    Job = apps.get_model('app', 'Job')
+    duplicates = (
+        Job.objects.filter(status='queued').exclude(dedupe_key='')
+        .values('dedupe_key')
+        .annotate(keep_id=Min('id'), copies=Count('id'))
+        .filter(copies__gt=1)
+    )
+    for row in duplicates.iterator():
+        Job.objects.filter(dedupe_key=row['dedupe_key'], status='queued').exclude(id=row['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_cents_and_lookup_codes'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_queued_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'queued'), models.Q(('dedupe_key', ''), _negated=True)), fields=('dedupe_key',), name='unique_queued_job_dedupe_key'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.4 on 2026-10-18 21:50
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_events(apps, schema_editor):
+    # Keep the latest delivery of each fingerprint, which is what the dedupe window is measured from
+    WebhookEvent = apps.get_model('app', 'WebhookEvent')
+    duplicates = (
+        WebhookEvent.objects.values('fingerprint')
+        .annotate(keep_id=Max('id'), copies=Count('id'))
+        .filter(copies__gt=1)
+    )
+    for row in duplicates.iterator():
+        WebhookEvent.objects.filter(fingerprint=row['fingerprint']).exclude(id=row['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_job_dedupe_constraint'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_events, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='webhookevent',
+            name='webhook_fingerprint_received',
+        ),
+        migrations.AlterField(
+            model_name='webhookevent',
+            name='fingerprint',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
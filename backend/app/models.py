@@ -1,9 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser, Group, Permission
+from django.utils import timezone
+
+from app.fields import CentsField, LookupField
 
 # Create your models here.
 class User(AbstractUser):
     name = models.CharField(max_length=255, blank=True)
+    # Bumped whenever the user's synced data changes; keys the read endpoint cache
+    data_version = models.PositiveIntegerField(default=0)
     
     # Fix reverse accessor clashes
     groups = models.ManyToManyField(
@@ -35,44 +40,219 @@ class Cursor(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     access_token = models.CharField(max_length=255)
     cursor = models.CharField(max_length=255)
+    # Plaid's id for the item, which is all a webhook names; recorded at token exchange
+    item_id = models.CharField(max_length=255, blank=True, default='', db_index=True)
+    synced_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['access_token'], name='unique_cursor_access_token'),
+        ]
 
 class Account(models.Model):
+    # Accounts filled from imported statements have no Plaid item to sync
+    MANUAL_ACCESS_TOKEN = ''
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    account_id = models.CharField(max_length=255)
+    account_id = models.CharField(max_length=255, db_index=True)
     access_token = models.CharField(max_length=255)
     name = models.CharField(max_length=255)
     account_type = models.CharField(max_length=50, choices=[('bank', 'Bank'), ('credit_card', 'Credit Card'), ('loan', 'Loan'), ('investment', 'Investment')])
-    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    balance = CentsField(default=0)
     institution = models.CharField(max_length=255, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'access_token'], name='account_user_access_token'),
+        ]
+
+    def to_dict(self):
+        return {
+            'account_id': self.account_id,
+            'name': self.name,
+            'account_type': self.account_type,
+            'balance': float(self.balance),
+            'institution': self.institution,
+        }
+
+class Merchant(models.Model):
+    # Normalized merchant name; spellings that normalize alike share one Merchant
+    key = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+        }
+
+class MerchantAlias(models.Model):
+    # A merchant_name as received (whitespace-collapsed, casefolded). Point an alias at
+    # another Merchant to merge spellings normalization does not catch.
+    alias = models.CharField(max_length=255, unique=True)
+    merchant = models.ForeignKey(Merchant, on_delete=models.CASCADE, related_name='aliases')
+
+class Category(models.Model):
+    # Lookup table behind Transaction.transaction_type and plaid_category (see app/fields.py)
+    id = models.SmallAutoField(primary_key=True)
+    name = models.CharField(max_length=100, unique=True)
+
+class PaymentChannel(models.Model):
+    # Lookup table behind Transaction.payment_channel
+    id = models.SmallAutoField(primary_key=True)
+    name = models.CharField(max_length=255, unique=True)
+
 class Transaction(models.Model):
     transaction_id = models.CharField(max_length=255)
     account = models.ForeignKey(Account, on_delete=models.CASCADE)
     datetime = models.DateTimeField()
-    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    # Stored in cents, read and written as a two-place Decimal
+    amount = CentsField()
     description = models.TextField(blank=True, null=True)
-    transaction_type = models.CharField(max_length=10,)
+    # Category names are stored as Category codes, read and written as names
+    transaction_type = LookupField('app.Category')
+    # Category as Plaid (or the imported statement) reported it, before CategoryRules are applied
+    plaid_category = LookupField('app.Category', blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
-    merchant_id = models.CharField(max_length=255, blank=True, null=True)
+    # Canonical merchant resolved from merchant_name (see app/merchants.py)
+    merchant = models.ForeignKey('Merchant', on_delete=models.SET_NULL, null=True, blank=True)
+    # The name exactly as Plaid or the statement gave it, kept next to merchant:
+    # CategoryRule.merchant_name matches it, backfill_merchants links rows stored
+    # without a merchant from it, and the API, exports and payloads return it.
+    # Many raw names share one Merchant, so it cannot be rebuilt from the foreign key.
     merchant_name = models.CharField(max_length=255, blank=True, null=True)
-    payment_channel = models.CharField(max_length=255, blank=True, null=True)
+    payment_channel = LookupField('app.PaymentChannel', blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            # transaction_id leads so the same index also serves the transaction_id
+            # lookups done by modify_transactions and remove_transactions
+            models.UniqueConstraint(fields=['transaction_id', 'account'], name='unique_transaction_per_account'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'datetime'], name='transaction_account_datetime'),
+        ]
+
+class CategoryRule(models.Model):
+    """A user-defined rule assigning `category` to matching transactions.
+
+    Every condition that is set must hold. Higher priority wins; see app/categorize.py.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    category = models.CharField(max_length=100)
+    # Case-insensitive exact match on the transaction's merchant_name
+    merchant_name = models.CharField(max_length=255, blank=True, default='')
+    # Regular expression searched (case-insensitively) in the description
+    description_pattern = models.CharField(max_length=255, blank=True, default='')
+    min_amount = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+    max_amount = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+    payment_channel = models.CharField(max_length=255, blank=True, default='')
+    priority = models.IntegerField(default=0)
+    enabled = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-priority', 'id']
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'category': self.category,
+            'merchant_name': self.merchant_name,
+            'description_pattern': self.description_pattern,
+            'min_amount': float(self.min_amount) if self.min_amount is not None else None,
+            'max_amount': float(self.max_amount) if self.max_amount is not None else None,
+            'payment_channel': self.payment_channel,
+            'priority': self.priority,
+            'enabled': self.enabled,
+        }
 
+class RecurringStream(models.Model):
+    """A recurring charge (or paycheck) detected by app/recurring.py."""
+    KIND_EXPENSE = 'expense'
+    KIND_INCOME = 'income'
+    FREQUENCY_CHOICES = [('weekly', 'Weekly'), ('biweekly', 'Biweekly'), ('monthly', 'Monthly'), ('annual', 'Annual')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, default=KIND_EXPENSE, choices=[(KIND_EXPENSE, 'Expense'), (KIND_INCOME, 'Income')])
+    # What the transactions were grouped on: 'merchant:<id>', 'description:<key>' or 'paycheck'
+    group_key = models.CharField(max_length=255)
+    # Rounded log of the typical amount; separates e.g. two subscriptions at one merchant
+    amount_band = models.IntegerField()
+    merchant = models.ForeignKey(Merchant, on_delete=models.SET_NULL, null=True, blank=True)
+    name = models.CharField(max_length=255)
+    frequency = models.CharField(max_length=20, choices=FREQUENCY_CHOICES)
+    interval_days = models.FloatField()
+    average_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    last_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    first_date = models.DateField()
+    last_date = models.DateField()
+    next_date = models.DateField()
+    occurrences = models.IntegerField()
+    # Share of the intervals that fit the frequency
+    confidence = models.FloatField()
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'group_key', 'amount_band'], name='unique_recurring_stream'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'next_date'], name='recurring_user_next_date'),
+        ]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'name': self.name,
+            'merchant_id': self.merchant_id,
+            'frequency': self.frequency,
+            'interval_days': round(self.interval_days, 1),
+            'average_amount': float(self.average_amount),
+            'last_amount': float(self.last_amount),
+            'first_date': self.first_date.isoformat(),
+            'last_date': self.last_date.isoformat(),
+            'next_date': self.next_date.isoformat(),
+            'occurrences': self.occurrences,
+            'confidence': round(self.confidence, 2),
+            'is_active': self.is_active,
+        }
 
 class SavingsGoal(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
-    target_amount = models.DecimalField(max_digits=12, decimal_places=2)
-    current_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    target_amount = CentsField()
+    current_amount = CentsField(default=0)
     deadline = models.DateField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'target_amount': float(self.target_amount),
+            'current_amount': float(self.current_amount),
+            'deadline': self.deadline.isoformat() if self.deadline else None,
+        }
+
 class Paycheck(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    total_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    total_amount = CentsField()
     date = models.DateField()
     breakdown = models.JSONField(default=dict)  # Example: {"401k": 200, "ESPP": 100, "Taxes": 500}
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'total_amount': float(self.total_amount),
+            'date': self.date.isoformat(),
+            'breakdown': self.breakdown,
+        }
+
 
 class MonthlySpending(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -86,3 +266,89 @@ class MonthlySpending(models.Model):
     amount_spent_transportation = models.DecimalField(max_digits=12, decimal_places=2)
     amount_spent_misc = models.DecimalField(max_digits=12, decimal_places=2)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'year', 'month'], name='unique_monthly_spending_per_month'),
+        ]
+
+    def to_dict(self):
+        return {
+            'year': self.year,
+            'month': self.month,
+            'amount_saved': float(self.amount_saved),
+            'amount_spent': float(self.amount_spent),
+            'amount_income': float(self.amount_income),
+            'amount_spent_food': float(self.amount_spent_food),
+            'amount_spent_utilities': float(self.amount_spent_utilities),
+            'amount_spent_transportation': float(self.amount_spent_transportation),
+            'amount_spent_misc': float(self.amount_spent_misc),
+        }
+
+
+class Job(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    kind = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, default=STATUS_QUEUED, choices=[(STATUS_QUEUED, 'Queued'), (STATUS_RUNNING, 'Running'), (STATUS_SUCCEEDED, 'Succeeded'), (STATUS_FAILED, 'Failed')])
+    # Jobs with the same key are coalesced while one of them is still queued; at most one can be
+    dedupe_key = models.CharField(max_length=255, blank=True, default='')
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=255, blank=True, default='')
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at'),
+            models.Index(fields=['dedupe_key', 'status'], name='job_dedupe_key_status'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedupe_key'],
+                condition=models.Q(status='queued') & ~models.Q(dedupe_key=''),
+                name='unique_queued_job_dedupe_key',
+            ),
+        ]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat(),
+        }
+
+
+class WebhookEvent(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_IGNORED = 'ignored'
+    STATUS_UNKNOWN_ITEM = 'unknown_item'
+
+    webhook_type = models.CharField(max_length=100)
+    webhook_code = models.CharField(max_length=100)
+    item_id = models.CharField(max_length=255, blank=True, default='')
+    # sha256 of the delivery's item_id, webhook_type, webhook_code and body (see app/webhooks.py); repeats are dropped
+    fingerprint = models.CharField(max_length=64, unique=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=[(STATUS_QUEUED, 'Queued'), (STATUS_IGNORED, 'Ignored'), (STATUS_UNKNOWN_ITEM, 'Unknown item')])
+    job = models.ForeignKey(Job, on_delete=models.SET_NULL, null=True, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['item_id', 'received_at'], name='webhook_item_received'),
+        ]
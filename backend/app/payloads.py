@@ -0,0 +1,167 @@
+"""
+Compact transaction payloads, fast JSON encoding and response compression.
+
+get_transactions' default layout has one object per row, with every field name
+and the row's whole account repeated. Its compact layout (?format=compact)
+sends the rows as arrays and each account once:
+
+    {
+      "fields": ["transaction_id", "account", "timestamp", "amount_cents", ...],
+      "accounts": [{"account_id": "...", "name": "Checking", ...}, ...],
+      "transactions": [["txn-1", 0, 1714521600, 1250, ...], ...]
+    }
+
+where `account` indexes `accounts`, `timestamp` is in Unix seconds and
+`amount_cents` is the exact amount in integer cents, as stored. The rows are
+read with a raw cursor in which the database computes the timestamps (as in
+app/snapshot.py), so no model instances, datetimes or Decimals are built.
+
+?format=msgpack (or Accept: application/msgpack) sends the compact layout as
+MessagePack when the msgpack package is installed. JSON is encoded with orjson
+when it is installed. Bodies of MIN_COMPRESS_BYTES or more are compressed
+with brotli (when installed) or gzip, whichever the client's Accept-Encoding
+prefers; cached_response keys such views on the negotiated format and
+encoding, so each variant is encoded and compressed once per data version.
+"""
+import gzip
+import json
+
+from django.db import connection
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from app.fields import LookupNames
+from app.models import Transaction
+from app.snapshot import Epoch
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPACT_FIELDS = [
+    'transaction_id', 'account', 'timestamp', 'amount_cents', 'description', 'merchant_name',
+    'transaction_type', 'payment_channel',
+]
+FETCH_SIZE = 5000
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Content codings we can produce, most preferred first
+CONTENT_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def encode_json(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+class CompactJSONRenderer(BaseRenderer):
+    """Selects the compact layout, as JSON."""
+
+    media_type = 'application/json'
+    format = 'compact'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return encode_json(data)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """Selects the compact layout, as MessagePack."""
+
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return msgpack.packb(data)
+
+
+# For @renderer_classes on views answering with payloads.response()
+RENDERERS = [JSONRenderer, CompactJSONRenderer] + ([MessagePackRenderer] if msgpack is not None else [])
+
+
+def compact_transactions(transactions, accounts):
+    """The compact layout of a Transaction queryset whose accounts are all in `accounts`."""
+    account_rows = []
+    index = {}
+    for pk, account_id, name, account_type, institution in accounts.order_by('id').values_list(
+        'id', 'account_id', 'name', 'account_type', 'institution'
+    ):
+        index[pk] = len(account_rows)
+        account_rows.append({'account_id': account_id, 'name': name, 'account_type': account_type, 'institution': institution})
+
+    # The SELECT lists model fields before annotations, whatever order values_list names them in
+    query = transactions.annotate(
+        epoch=Epoch('datetime'),
+    ).values_list('transaction_id', 'account_id', 'amount', 'description', 'merchant_name', 'transaction_type', 'payment_channel', 'epoch')
+    sql, params = query.query.sql_with_params()
+    # The category and channel columns hold lookup codes
+    categories = LookupNames(Transaction._meta.get_field('transaction_type'))
+    channels = LookupNames(Transaction._meta.get_field('payment_channel'))
+    rows = []
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        while chunk := cursor.fetchmany(FETCH_SIZE):
+            rows += [
+                [transaction_id, index[account], epoch, cents, description, merchant_name, categories[category], channels[channel]]
+                for transaction_id, account, cents, description, merchant_name, category, channel, epoch in chunk
+            ]
+    return {'fields': COMPACT_FIELDS, 'accounts': account_rows, 'transactions': rows}
+
+
+def content_encoding(request):
+    """The content coding to compress a response to `request` with, or None."""
+    accepted = {}
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in CONTENT_ENCODINGS:
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def variant(request):
+    """What a response to `request` depends on besides the URL: the negotiated format and encoding."""
+    return f"{request.accepted_renderer.format}:{content_encoding(request) or 'identity'}"
+
+
+def response(request, data):
+    """Encode `data` in the format DRF negotiated for `request`, compressed if the client accepts it."""
+    if request.accepted_renderer.format == 'msgpack':
+        body, content_type = msgpack.packb(data), MessagePackRenderer.media_type
+    else:
+        body, content_type = encode_json(data), 'application/json'
+    response = HttpResponse(body, content_type=content_type)
+    coding = content_encoding(request)
+    if coding is not None and len(body) >= MIN_COMPRESS_BYTES:
+        response.content = compress(body, coding)
+        response['Content-Encoding'] = coding
+    patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+    return response
@@ -0,0 +1,318 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from dotenv import load_dotenv
+import plaid
+from plaid.api import plaid_api
+from plaid.model.country_code import CountryCode
+from plaid.model.products import Products
+
+from app import instrumentation
+
+load_dotenv()
+
+PLAID_CLIENT_ID = os.getenv('PLAID_CLIENT_ID')
+PLAID_ENV = os.getenv('PLAID_ENV', 'sandbox')
+PLAID_PRODUCTS = os.getenv('PLAID_PRODUCTS', 'transactions').split(',')
+PLAID_COUNTRY_CODES = os.getenv('PLAID_COUNTRY_CODES', 'US').split(',')
+PLAID_SECRET = os.getenv('PLAID_SECRET_SANDBOX') if os.getenv('PLAID_ENV') == 'sandbox' else os.getenv('PLAID_SECRET_PRODUCTION')
+
+
+def empty_to_none(field):
+    value = os.getenv(field)
+    if value is None or len(value) == 0:
+        return None
+    return value
+
+host = plaid.Environment.Sandbox
+
+if PLAID_ENV == 'sandbox':
+    host = plaid.Environment.Sandbox
+
+if PLAID_ENV == 'production':
+    host = plaid.Environment.Production
+
+# Point the client somewhere else entirely, e.g. the local fake server in benchmarks/fake_plaid.py
+if empty_to_none('PLAID_HOST'):
+    host = os.getenv('PLAID_HOST')
+
+PLAID_REDIRECT_URI = empty_to_none('PLAID_REDIRECT_URI')
+# Public URL of /api/plaid_webhook/; items linked while it is set report updates there
+PLAID_WEBHOOK_URL = empty_to_none('PLAID_WEBHOOK_URL')
+# Only turn off to post hand-made webhooks at a local server; Plaid signs every real one
+PLAID_WEBHOOK_VERIFY = os.getenv('PLAID_WEBHOOK_VERIFY', '1') != '0'
+
+configuration = plaid.Configuration(
+    host=host,
+    api_key={
+        'clientId': PLAID_CLIENT_ID,
+        'secret': PLAID_SECRET,
+        'plaidVersion': '2020-09-14'
+    }
+)
+
+# Requests per second allowed per endpoint across the whole process, and per item
+# (access token). Plaid's own limits are per minute; these stay safely below them.
+ENDPOINT_RATE_LIMITS = {
+    'transactions_sync': 2000 / 60,
+    'item_get': 1000 / 60,
+    'liabilities_get': 1000 / 60,
+    'link_token_create': 2000 / 60,
+    'item_public_token_exchange': 1000 / 60,
+}
+DEFAULT_ENDPOINT_RATE_LIMIT = 1000 / 60
+# Calls that change state on Plaid's side. A 5xx does not say whether the change
+# happened (a public token may already have been exchanged, and is single-use), so
+# these are only retried when Plaid rejected them for the rate limit.
+NON_IDEMPOTENT_ENDPOINTS = {
+    'item_public_token_exchange',
+    'item_remove',
+    'item_access_token_invalidate',
+}
+ITEM_RATE_LIMIT = 40 / 60
+ITEM_BURST = 10
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, blocking until one is available. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def is_full(self):
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class AdaptiveConcurrency:
+    """Caps in-flight calls with an additive-increase / multiplicative-decrease limit.
+
+    An error halves the limit (down to `minimum`, at most once per
+    `decrease_interval` seconds so one burst of failures counts once), and every
+    `increase_after` consecutive successes raise it by one (up to `maximum`).
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=32, increase_after=20, decrease_interval=1.0):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase_after = increase_after
+        self.decrease_interval = decrease_interval
+        self.last_decrease = float('-inf')
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, blocking while the limit is reached. Returns the seconds spent waiting."""
+        with self.condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return 0.0
+            started = time.monotonic()
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            return time.monotonic() - started
+
+    def release(self, error=False):
+        with self.condition:
+            self.in_flight -= 1
+            if error:
+                self.successes = 0
+                now = time.monotonic()
+                if now - self.last_decrease >= self.decrease_interval:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self.last_decrease = now
+            else:
+                self.successes += 1
+                if self.successes >= self.increase_after and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class PlaidMetrics:
+    """Per-endpoint call, error, retry and throttling counters."""
+
+    FIELDS = ('calls', 'errors', 'retries', 'rate_limited', 'throttled_waits', 'throttled_seconds', 'call_seconds')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.endpoints = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+
+    def record(self, endpoint, **values):
+        with self.lock:
+            counters = self.endpoints[endpoint]
+            for field, value in values.items():
+                counters[field] += value
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            endpoints = {name: dict(counters) for name, counters in self.endpoints.items()}
+        for counters in endpoints.values():
+            counters['calls_per_second'] = counters['calls'] / elapsed
+        return {'uptime_seconds': elapsed, 'endpoints': endpoints}
+
+
+def plaid_error(e):
+    try:
+        return json.loads(e.body)
+    except (TypeError, ValueError):
+        return {}
+
+
+class RateLimitedPlaidClient:
+    """Wraps PlaidApi with rate limiting, retries and an adaptive concurrency cap.
+
+    Every API method is throttled by a token bucket for its endpoint and, when the
+    request carries an access_token, one for the item. RATE_LIMIT_EXCEEDED and 5xx
+    responses are retried with jittered exponential backoff, and they shrink the
+    concurrency cap shared by all calls through this client. Endpoints in
+    `non_idempotent` are not retried on 5xx.
+    """
+
+    def __init__(self, api, endpoint_rates=None, default_rate=DEFAULT_ENDPOINT_RATE_LIMIT,
+                 item_rate=ITEM_RATE_LIMIT, item_burst=ITEM_BURST, max_retries=5,
+                 base_delay=0.5, max_delay=30, concurrency=None, non_idempotent=NON_IDEMPOTENT_ENDPOINTS):
+        self.api = api
+        self.non_idempotent = set(non_idempotent)
+        self.endpoint_rates = {**ENDPOINT_RATE_LIMITS, **(endpoint_rates or {})}
+        self.default_rate = default_rate
+        self.item_rate = item_rate
+        self.item_burst = item_burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.metrics = PlaidMetrics()
+        self.endpoint_buckets = {}
+        self.item_buckets = {}
+        self.buckets_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    def endpoint_bucket(self, endpoint):
+        with self.buckets_lock:
+            if endpoint not in self.endpoint_buckets:
+                rate = self.endpoint_rates.get(endpoint, self.default_rate)
+                self.endpoint_buckets[endpoint] = TokenBucket(rate, max(1, rate))
+            return self.endpoint_buckets[endpoint]
+
+    def item_bucket(self, access_token):
+        with self.buckets_lock:
+            if access_token not in self.item_buckets:
+                if len(self.item_buckets) >= 10000:
+                    # Forget items that have been idle long enough to refill completely
+                    self.item_buckets = {k: b for k, b in self.item_buckets.items() if not b.is_full()}
+                self.item_buckets[access_token] = TokenBucket(self.item_rate, self.item_burst)
+            return self.item_buckets[access_token]
+
+    def backoff(self, attempt):
+        # Full jitter: uniform in [0, min(max_delay, base * 2^attempt)]
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, endpoint, method, *args, **kwargs):
+        request = args[0] if args else None
+        access_token = getattr(request, 'access_token', None)
+
+        for attempt in range(self.max_retries + 1):
+            waited = self.endpoint_bucket(endpoint).acquire()
+            if access_token:
+                waited += self.item_bucket(access_token).acquire()
+            waited += self.concurrency.acquire()
+            if waited:
+                self.metrics.record(endpoint, throttled_waits=1, throttled_seconds=waited)
+
+            started = time.monotonic()
+            try:
+                response = method(*args, **kwargs)
+            except plaid.ApiException as e:
+                elapsed = time.monotonic() - started
+                instrumentation.record_plaid_call(elapsed)
+                rate_limited = plaid_error(e).get('error_type') == 'RATE_LIMIT_EXCEEDED' or e.status == 429
+                overloaded = rate_limited or (e.status or 0) >= 500
+                self.concurrency.release(error=overloaded)
+                self.metrics.record(endpoint, calls=1, errors=1, rate_limited=int(rate_limited), call_seconds=elapsed)
+                retryable = rate_limited or overloaded and endpoint not in self.non_idempotent
+                if not retryable or attempt == self.max_retries:
+                    raise
+                self.metrics.record(endpoint, retries=1)
+                time.sleep(self.backoff(attempt))
+                continue
+            except Exception:
+                # Connection errors and timeouts: count them but leave retrying to the caller
+                elapsed = time.monotonic() - started
+                instrumentation.record_plaid_call(elapsed)
+                self.concurrency.release(error=True)
+                self.metrics.record(endpoint, calls=1, errors=1, call_seconds=elapsed)
+                raise
+
+            elapsed = time.monotonic() - started
+            instrumentation.record_plaid_call(elapsed)
+            self.concurrency.release()
+            self.metrics.record(endpoint, calls=1, call_seconds=elapsed)
+            return response
+
+
+api_client = plaid.ApiClient(configuration)
+client = RateLimitedPlaidClient(plaid_api.PlaidApi(api_client))
+
+
+@instrumentation.registry.register_collector
+def plaid_metric_lines():
+    endpoints = sorted(client.metrics.snapshot()['endpoints'].items())
+    lines = [
+        '# HELP plaid_concurrency_limit Cap on in-flight Plaid calls',
+        '# TYPE plaid_concurrency_limit gauge',
+        f'plaid_concurrency_limit {client.concurrency.limit}',
+    ]
+    for field in PlaidMetrics.FIELDS:
+        name = f'plaid_{field}_total'
+        lines += [f'# HELP {name} Plaid client {field.replace("_", " ")} by endpoint', f'# TYPE {name} counter']
+        lines += [f'{name}{{endpoint="{endpoint}"}} {counters[field]}' for endpoint, counters in endpoints]
+    return lines
+
+
+products = []
+for product in PLAID_PRODUCTS:
+    products.append(Products(product))
+
+country_codes = list(map(lambda x: CountryCode(x), PLAID_COUNTRY_CODES))
@@ -0,0 +1,260 @@
+"""
+Detection of recurring charges, subscriptions and paychecks.
+
+Transactions are grouped by merchant (or normalized description when there is
+no merchant) and by direction (charges apart from inflows such as refunds or
+deposits), and split into amount bands wherever the sorted sizes jump by more
+than AMOUNT_GAP, so two subscriptions at the same merchant stay apart. Each
+band's dates are then scored against every candidate frequency at once: the
+intervals of all bands are one NumPy array and per-band hit counts come from
+np.bincount, so a user with thousands of merchants costs a handful of array
+operations rather than a Python loop per group.
+
+Streams are stored in RecurringStream. A full refresh runs nightly
+(`manage.py detect_recurring`, from refresh_transactions.sh); after each item
+sync only the merchants that received new transactions are re-detected.
+"""
+import math
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import app.db_methods as db
+from app import merchants
+from app.models import Paycheck, RecurringStream, Transaction
+
+# name, period in days, tolerance in days, minimum occurrences
+FREQUENCIES = [
+    ('weekly', 7, 1.5, 4),
+    ('biweekly', 14, 2.5, 3),
+    ('monthly', 30.44, 4, 3),
+    ('annual', 365.25, 12, 2),
+]
+PERIODS = np.array([f[1] for f in FREQUENCIES])
+TOLERANCES = np.array([f[2] for f in FREQUENCIES])
+MIN_OCCURRENCES = np.array([f[3] for f in FREQUENCIES])
+TOLERANCE_BY_FREQUENCY = {f[0]: f[2] for f in FREQUENCIES}
+# Share of a band's intervals that must fit the frequency
+MIN_SCORE = 0.75
+# Relative jump between sorted amounts that starts a new band
+AMOUNT_GAP = 0.2
+# Added to the amount band of inflow streams, so they never share a key with a charge of the same size
+INFLOW_BAND = 1000
+# Long enough to see an annual charge recur
+LOOKBACK_DAYS = 800
+STREAM_FIELDS = [
+    'kind', 'merchant', 'name', 'frequency', 'interval_days', 'average_amount', 'last_amount',
+    'first_date', 'last_date', 'next_date', 'occurrences', 'confidence', 'is_active',
+]
+
+
+def next_occurrence(last, frequency, interval_days):
+    if frequency == 'monthly':
+        return last + relativedelta(months=1)
+    if frequency == 'annual':
+        return last + relativedelta(years=1)
+    return last + timedelta(days=round(interval_days))
+
+
+def detect(keys, days, amounts):
+    """Find periodic bands in parallel arrays of group key, day ordinal and amount.
+
+    Returns one dict per detected stream with its group key, whether it is an
+    inflow (negative amounts), its amount band and statistics. Rows need not be
+    sorted.
+    """
+    n = len(keys)
+    if n < 2:
+        return []
+    amounts = np.asarray(amounts, dtype=np.float64)
+    inflows = amounts < 0
+    key_index = {}
+    groups = np.fromiter(
+        (key_index.setdefault((k, bool(inflow)), len(key_index)) for k, inflow in zip(keys, inflows)), dtype=np.int64, count=n
+    )
+    group_keys = list(key_index)
+    days = np.asarray(days, dtype=np.int64)
+    sizes = np.abs(amounts)
+
+    # Amount bands: sort by (group, size) and cut at group changes and large relative jumps
+    by_amount = np.lexsort((sizes, groups))
+    sorted_groups, sorted_sizes = groups[by_amount], sizes[by_amount]
+    starts = np.ones(n, dtype=bool)
+    starts[1:] = (sorted_groups[1:] != sorted_groups[:-1]) | (sorted_sizes[1:] > sorted_sizes[:-1] * (1 + AMOUNT_GAP))
+    band_group = sorted_groups[starts]
+    bands = np.empty(n, dtype=np.int64)
+    bands[by_amount] = np.cumsum(starts) - 1
+    band_count = len(band_group)
+
+    # Intervals between consecutive dates within each band
+    by_day = np.lexsort((days, bands))
+    b, d, a = bands[by_day], days[by_day], amounts[by_day]
+    occurrences = np.bincount(b, minlength=band_count)
+    same_band = b[1:] == b[:-1]
+    interval_band = b[1:][same_band]
+    intervals = (d[1:] - d[:-1])[same_band].astype(np.float64)
+    interval_count = np.bincount(interval_band, minlength=band_count)
+
+    # hits[f, band]: intervals of the band within tolerance of frequency f
+    fits = np.abs(intervals[None, :] - PERIODS[:, None]) <= TOLERANCES[:, None]
+    hits = np.stack([np.bincount(interval_band, weights=fit, minlength=band_count) for fit in fits])
+    fit_days = np.stack([np.bincount(interval_band, weights=fit * intervals, minlength=band_count) for fit in fits])
+    scores = hits / np.maximum(interval_count, 1)
+    best = scores.argmax(axis=0)
+    columns = np.arange(band_count)
+    best_score = scores[best, columns]
+    detected = (best_score >= MIN_SCORE) & (occurrences >= MIN_OCCURRENCES[best])
+
+    last = np.cumsum(occurrences) - 1
+    first = last - occurrences + 1
+    totals = np.bincount(b, weights=a, minlength=band_count)
+    mean_interval = fit_days[best, columns] / np.maximum(hits[best, columns], 1)
+
+    streams = {}
+    for band in np.flatnonzero(detected):
+        average = totals[band] / occurrences[band]
+        key, inflow = group_keys[band_group[band]]
+        stream = {
+            'group_key': key,
+            'inflow': inflow,
+            'amount_band': int(round(math.log(max(abs(average), 0.01)) * 10)) + (INFLOW_BAND if inflow else 0),
+            'frequency': FREQUENCIES[best[band]][0],
+            'interval_days': float(mean_interval[band]),
+            'average_amount': round(float(average), 2),
+            'last_amount': round(float(a[last[band]]), 2),
+            'first_day': int(d[first[band]]),
+            'last_day': int(d[last[band]]),
+            'occurrences': int(occurrences[band]),
+            'confidence': float(best_score[band]),
+        }
+        # Bands whose averages round alike share a key; keep the longer history
+        key = (stream['group_key'], stream['amount_band'])
+        if key not in streams or streams[key]['occurrences'] < stream['occurrences']:
+            streams[key] = stream
+    return list(streams.values())
+
+
+def group_key(merchant_id, description, description_keys):
+    if merchant_id is not None:
+        return f'merchant:{merchant_id}'
+    key = description_keys.get(description)
+    if key is None:
+        key = description_keys[description] = f"description:{merchants.merchant_key(description or '')}"
+    return key
+
+
+def refresh_streams(user, merchant_ids=None, today=None):
+    """Re-detect a user's recurring streams and store them.
+
+    With merchant_ids only those merchants' streams are re-detected (plus
+    description-grouped ones, which have no merchant to filter on); otherwise all
+    of the user's streams are, including paychecks. Streams that are no longer
+    detected are deleted. Returns the number of streams stored.
+    """
+    today = today or timezone.localdate()
+    since = today - timedelta(days=LOOKBACK_DAYS)
+    transactions = Transaction.objects.filter(
+        account__user=user, datetime__gte=timezone.make_aware(datetime.combine(since, datetime.min.time()))
+    )
+    if merchant_ids is not None:
+        transactions = transactions.filter(Q(merchant_id__in=merchant_ids) | Q(merchant__isnull=True))
+
+    keys, days, amounts, names, merchant_of = [], [], [], {}, {}
+    description_keys = {}
+    rows = transactions.values_list('merchant_id', 'merchant__name', 'merchant_name', 'description', 'datetime', 'amount')
+    for merchant_id, merchant_display, merchant_name, description, stored_at, amount in rows.iterator(chunk_size=5000):
+        key = group_key(merchant_id, description, description_keys)
+        keys.append(key)
+        days.append(timezone.localdate(stored_at).toordinal())
+        amounts.append(float(amount))
+        # Descriptions carry reference numbers; name those streams after the normalized key
+        names.setdefault(key, merchant_display or merchant_name or key.split(':', 1)[1].title() or 'Unknown')
+        merchant_of[key] = merchant_id
+
+    kinds = {}
+    if merchant_ids is None:
+        for paid_on, total in Paycheck.objects.filter(user=user, date__gte=since).values_list('date', 'total_amount'):
+            keys.append('paycheck')
+            days.append(paid_on.toordinal())
+            amounts.append(float(total))
+        names['paycheck'] = 'Paycheck'
+        kinds['paycheck'] = RecurringStream.KIND_INCOME
+
+    streams = []
+    for found in detect(keys, days, amounts):
+        last_date = date.fromordinal(found['last_day'])
+        frequency = found['frequency']
+        tolerance = TOLERANCE_BY_FREQUENCY[frequency]
+        next_date = next_occurrence(last_date, frequency, found['interval_days'])
+        # Inflows (Plaid's negative amounts) are income, which streams hold as positive amounts like paychecks
+        sign = -1 if found['inflow'] else 1
+        streams.append(RecurringStream(
+            user=user,
+            kind=RecurringStream.KIND_INCOME if found['inflow'] else kinds.get(found['group_key'], RecurringStream.KIND_EXPENSE),
+            group_key=found['group_key'],
+            amount_band=found['amount_band'],
+            merchant_id=merchant_of.get(found['group_key']),
+            name=names[found['group_key']][:255],
+            frequency=frequency,
+            interval_days=found['interval_days'],
+            average_amount=sign * found['average_amount'],
+            last_amount=sign * found['last_amount'],
+            first_date=date.fromordinal(found['first_day']),
+            last_date=last_date,
+            next_date=next_date,
+            occurrences=found['occurrences'],
+            confidence=found['confidence'],
+            # A stream stays active until one full period past its expected date is missed
+            is_active=today <= next_date + timedelta(days=found['interval_days'] + tolerance),
+        ))
+
+    existing = RecurringStream.objects.filter(user=user)
+    if merchant_ids is not None:
+        existing = existing.filter(
+            Q(group_key__in=[f'merchant:{m}' for m in merchant_ids]) | Q(group_key__startswith='description:')
+        )
+    with db_transaction.atomic():
+        detected = {(s.group_key, s.amount_band) for s in streams}
+        stale_ids = [pk for pk, key, band in existing.values_list('id', 'group_key', 'amount_band') if (key, band) not in detected]
+        stale = RecurringStream.objects.filter(id__in=stale_ids).delete()[0]
+        RecurringStream.objects.bulk_create(
+            streams,
+            update_conflicts=True,
+            unique_fields=['user', 'group_key', 'amount_band'],
+            update_fields=STREAM_FIELDS + ['updated_at'],
+        )
+        if streams or stale:
+            db.bump_data_version(user)
+    return len(streams)
+
+
+def refresh_after_sync(user, since):
+    """Re-detect the streams of merchants that received transactions created since `since`."""
+    merchant_ids = set(
+        Transaction.objects.filter(account__user=user, created_at__gte=since)
+        .values_list('merchant_id', flat=True)
+        .distinct()
+    )
+    if not merchant_ids:
+        return 0
+    # None stands for description-grouped rows, which refresh_streams always re-detects
+    merchant_ids.discard(None)
+    return refresh_streams(user, merchant_ids=list(merchant_ids))
+
+
+def upcoming(streams, start, end):
+    """(date, stream) for every expected occurrence of the streams between start and end, in date order."""
+    occurrences = []
+    for stream in streams:
+        expected = stream.next_date
+        while expected < start:
+            expected = next_occurrence(expected, stream.frequency, stream.interval_days)
+        while expected <= end:
+            occurrences.append((expected, stream))
+            expected = next_occurrence(expected, stream.frequency, stream.interval_days)
+    occurrences.sort(key=lambda o: (o[0], o[1].name))
+    return occurrences
@@ -0,0 +1,129 @@
+"""
+Keeps MonthlySpending up to date as transactions change.
+
+A sync only recomputes the (user, year, month) buckets its added, modified and
+removed transactions fall in (before and after the change), so reading a user's
+monthly summary never has to scan their whole ledger.
+"""
+from datetime import datetime
+from decimal import Decimal
+
+from django.db.models import Max, Min, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+
+from app.models import MonthlySpending, Paycheck, Transaction
+
+# Plaid personal_finance_category.primary values that get their own MonthlySpending column;
+# everything else is counted as misc
+CATEGORY_BUCKETS = {
+    'FOOD_AND_DRINK': 'food',
+    'RENT_AND_UTILITIES': 'utilities',
+    'TRANSPORTATION': 'transportation',
+}
+
+
+def month_of(value):
+    """(year, month) of an aware datetime in the current timezone."""
+    local = timezone.localtime(value)
+    return local.year, local.month
+
+
+def month_bounds(year, month):
+    start = timezone.make_aware(datetime(year, month, 1))
+    end = timezone.make_aware(datetime(year + month // 12, month % 12 + 1, 1))
+    return start, end
+
+
+def months_between(first, last):
+    """(year, month) pairs from the month of `first` through the month of `last`."""
+    year, month = month_of(first)
+    last_year, last_month = month_of(last)
+    months = set()
+    while (year, month) <= (last_year, last_month):
+        months.add((year, month))
+        year, month = year + month // 12, month % 12 + 1
+    return months
+
+
+def months_spanned(transactions):
+    """Every month between a queryset's first and last transaction.
+
+    Two index-backed aggregates instead of extracting the month of every row, which
+    SQLite does in Python. Months in the span without transactions are harmless:
+    refresh_months deletes their (absent) rows.
+    """
+    span = transactions.aggregate(first=Min('datetime'), last=Max('datetime'))
+    if span['first'] is None:
+        return set()
+    return months_between(span['first'], span['last'])
+
+
+def months_of_transactions(transactions):
+    """Distinct (year, month) pairs a Transaction queryset spans."""
+    return set(
+        transactions.annotate(year=ExtractYear('datetime'), month=ExtractMonth('datetime'))
+        .values_list('year', 'month')
+        .distinct()
+    )
+
+
+def months_of_stored(transaction_ids):
+    """Months the stored versions of these transactions fall in (call before changing them)."""
+    months = set()
+    for start in range(0, len(transaction_ids), 1000):
+        batch = transaction_ids[start:start + 1000]
+        months |= months_of_transactions(Transaction.objects.filter(transaction_id__in=batch))
+    return months
+
+
+def refresh_months(user, months):
+    """Recompute the MonthlySpending rows for the given (year, month) pairs of one user."""
+    for year, month in sorted(months):
+        start, end = month_bounds(year, month)
+        totals = (
+            Transaction.objects.filter(account__user=user, datetime__gte=start, datetime__lt=end)
+            .values('transaction_type')
+            .annotate(total=Sum('amount'))
+        )
+        income = Paycheck.objects.filter(user=user, date__year=year, date__month=month).aggregate(
+            total=Sum('total_amount')
+        )['total']
+
+        buckets = dict.fromkeys(['food', 'utilities', 'transportation', 'misc'], Decimal('0'))
+        for row in totals:
+            buckets[CATEGORY_BUCKETS.get(row['transaction_type'], 'misc')] += row['total']
+
+        if not totals and income is None:
+            MonthlySpending.objects.filter(user=user, year=year, month=month).delete()
+            continue
+
+        income = income or Decimal('0')
+        spent = sum(buckets.values())
+        MonthlySpending.objects.update_or_create(
+            user=user,
+            year=year,
+            month=month,
+            defaults={
+                'amount_spent': spent,
+                'amount_income': income,
+                'amount_saved': income - spent,
+                'amount_spent_food': buckets['food'],
+                'amount_spent_utilities': buckets['utilities'],
+                'amount_spent_transportation': buckets['transportation'],
+                'amount_spent_misc': buckets['misc'],
+            },
+        )
+
+
+def rebuild(user):
+    """Recompute every MonthlySpending row for a user from scratch."""
+    months = months_spanned(Transaction.objects.filter(account__user=user))
+    months |= {(d.year, d.month) for d in Paycheck.objects.filter(user=user).values_list('date', flat=True)}
+    stale = [
+        pk for pk, year, month in MonthlySpending.objects.filter(user=user).values_list('id', 'year', 'month')
+        if (year, month) not in months
+    ]
+    MonthlySpending.objects.filter(id__in=stale).delete()
+    refresh_months(user, months)
+    return len(months)
@@ -0,0 +1,358 @@
+"""
+Per-user columnar snapshots of the transaction ledger.
+
+A snapshot holds one NumPy array per column, ordered by Transaction id:
+
+- id: Transaction primary key
+- ts: epoch seconds of datetime
+- day: local date (days since 1970-01-01 in TIME_ZONE)
+- cents: amount in integer cents
+- category: code into meta['categories'] (transaction_type values)
+- channel: code into meta['channels'] (payment_channel values)
+- merchant: Merchant id, -1 when there is none
+- account: Account id
+
+Each column is saved as a .npy file under SNAPSHOT_DIR/<user id>/ and opened
+with mmap_mode='r', so loading a snapshot costs a few page faults rather than
+reading the ledger. Rows are read with a raw cursor in which the database
+already converts datetimes to epoch seconds, and amounts are stored in cents
+(see app/fields.py), which skips the per-row Decimal and datetime conversion
+the ORM would do. The ledger's category and channel codes are translated to
+names once per distinct code.
+
+Snapshots are refreshed incrementally: rows with an id above the snapshot's
+highest id are appended, rows a sync modified are patched in place by id, and
+a count check catches removed rows (and rows committed out of id order), which
+are reconciled against the ledger's id list. load() refreshes a snapshot whose
+data_version is behind the user's, so anything that bumps data_version after
+appending rows is picked up without a hook. Code that rewrites existing rows
+outside a sync calls refresh(user, rebuild=True), invalidate() or clear(), and
+so does a sync whose refresh fails.
+"""
+import fcntl
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import NotSupportedError, connection
+from django.db.models import BigIntegerField, Func
+from django.utils import timezone
+
+from app.models import Transaction, User
+
+COLUMNS = {
+    'id': np.int64,
+    'ts': np.int64,
+    'day': np.int32,
+    'cents': np.int64,
+    'category': np.int32,
+    'channel': np.int32,
+    'merchant': np.int64,
+    'account': np.int64,
+}
+FETCH_SIZE = 50000
+# Day numbers in the day column count from here
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Generations other processes may still be writing are only deleted once this old
+STALE_FILE_SECONDS = 60
+
+
+class Epoch(Func):
+    """Whole seconds since 1970-01-01 UTC of a datetime column, computed by the database.
+
+    Fractions are truncated, never rounded, so a row keeps its day at midnight.
+    """
+    output_field = BigIntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # Stored as 'YYYY-MM-DD HH:MM:SS[.ffffff]' in UTC; strftime would round the fraction.
+        # '%' is escaped once for the template and once for the cursor's paramstyle.
+        return self.as_sql(
+            compiler, connection, template="CAST(strftime('%%%%s', substr(%(expressions)s, 1, 19)) AS INTEGER)", **extra_context
+        )
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='FLOOR(EXTRACT(EPOCH FROM %(expressions)s))::bigint', **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='FLOOR(UNIX_TIMESTAMP(%(expressions)s))', **extra_context)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        if 'template' not in extra_context:
+            raise NotSupportedError(f'Epoch is not implemented for {connection.vendor}')
+        return super().as_sql(compiler, connection, **extra_context)
+
+
+def snapshot_dir():
+    return getattr(settings, 'SNAPSHOT_DIR', None)
+
+
+def enabled():
+    return bool(snapshot_dir())
+
+
+def user_dir(user):
+    return os.path.join(snapshot_dir(), str(user.pk))
+
+
+class Snapshot:
+    def __init__(self, meta, columns):
+        self.meta = meta
+        self.columns = columns
+        self.categories = meta['categories']
+        self.channels = meta['channels']
+        for name, values in columns.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.id)
+
+    @property
+    def max_id(self):
+        return int(self.id[-1]) if len(self.id) else 0
+
+    def between(self, start=None, end=None):
+        """Boolean mask of rows with start <= datetime < end (aware datetimes or None)."""
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.ts >= int(start.timestamp())
+        if end is not None:
+            mask &= self.ts < int(end.timestamp())
+        return mask
+
+
+def local_days(ts, tz):
+    """Local day numbers of epoch seconds, applying the UTC offset in effect at each hour."""
+    if not len(ts):
+        return np.zeros(0, dtype=np.int32)
+    hours, index = np.unique(ts // 3600, return_inverse=True)
+    offsets = np.array(
+        [datetime.fromtimestamp(int(h) * 3600, dt_timezone.utc).astimezone(tz).utcoffset().total_seconds() for h in hours],
+        dtype=np.int64,
+    )
+    return ((ts + offsets[index]) // 86400).astype(np.int32)
+
+
+def fetch(transactions, categories, channels, tz):
+    """Columns of the rows of a Transaction queryset, encoding categories and channels into the given dicts."""
+    # The SELECT lists model fields before annotations, whatever order values_list names them in.
+    # amount is stored in cents, and the category and channel columns as lookup codes.
+    query = transactions.order_by('id').annotate(
+        epoch=Epoch('datetime'),
+    ).values_list('id', 'amount', 'transaction_type', 'payment_channel', 'merchant_id', 'account_id', 'epoch')
+    sql, params = query.query.sql_with_params()
+    category_name = Transaction._meta.get_field('transaction_type').lookup.name
+    channel_name = Transaction._meta.get_field('payment_channel').lookup.name
+    # Stored code -> snapshot code
+    category_codes, channel_codes = {}, {}
+    parts = {name: [] for name in COLUMNS if name != 'day'}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            ids, cents, category, channel, merchant, account, ts = zip(*rows)
+            for code in set(category) - category_codes.keys():
+                category_codes[code] = categories.setdefault(category_name(code), len(categories))
+            for code in set(channel) - channel_codes.keys():
+                channel_codes[code] = channels.setdefault(channel_name(code), len(channels))
+            parts['id'].append(np.array(ids, dtype=np.int64))
+            parts['ts'].append(np.array(ts, dtype=np.int64))
+            parts['cents'].append(np.array(cents, dtype=np.int64))
+            parts['category'].append(np.array([category_codes[c] for c in category], dtype=np.int32))
+            parts['channel'].append(np.array([channel_codes[c] for c in channel], dtype=np.int32))
+            parts['merchant'].append(np.array([-1 if m is None else m for m in merchant], dtype=np.int64))
+            parts['account'].append(np.array(account, dtype=np.int64))
+    columns = {
+        name: np.concatenate(chunks) if chunks else np.zeros(0, dtype=COLUMNS[name])
+        for name, chunks in parts.items()
+    }
+    columns['day'] = local_days(columns['ts'], tz)
+    return columns
+
+
+def read(user):
+    """The user's stored snapshot, memory-mapped, or None when there is none."""
+    directory = user_dir(user)
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        columns = {
+            name: np.load(os.path.join(directory, f"{meta['generation']}-{name}.npy"), mmap_mode='r')
+            for name in COLUMNS
+        }
+    except (OSError, ValueError, KeyError):
+        return None
+    return Snapshot(meta, columns)
+
+
+def write_meta(user, meta):
+    temporary = os.path.join(user_dir(user), f"meta-{uuid.uuid4().hex}.json")
+    with open(temporary, 'w') as f:
+        json.dump(meta, f)
+    # Readers see either the old or the new generation, never a mix
+    os.replace(temporary, os.path.join(user_dir(user), 'meta.json'))
+
+
+def write(user, meta, columns):
+    """Save a new generation of the user's snapshot and point meta.json at it."""
+    directory = user_dir(user)
+    os.makedirs(directory, exist_ok=True)
+    generation = uuid.uuid4().hex
+    for name, values in columns.items():
+        np.save(os.path.join(directory, f'{generation}-{name}.npy'), np.ascontiguousarray(values, dtype=COLUMNS[name]))
+    meta = dict(meta, generation=generation, rows=len(columns['id']), written_at=time.time())
+    write_meta(user, meta)
+
+    # Open memory maps of old generations stay valid after their files are unlinked
+    cutoff = time.time() - STALE_FILE_SECONDS
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.npy') and not entry.name.startswith(generation) and entry.stat().st_mtime < cutoff:
+            os.unlink(entry.path)
+    return Snapshot(meta, columns)
+
+
+@contextmanager
+def locked(user):
+    """Serialize refreshes of one user's snapshot across processes."""
+    directory = user_dir(user)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def owner(user):
+    # Tells the user apart from an earlier one with the same id, e.g. after the database is recreated
+    return f'{user.pk}:{user.date_joined.timestamp()}'
+
+
+def current(snapshot, user, tz):
+    return (
+        snapshot is not None and snapshot.meta.get('owner') == owner(user) and snapshot.meta.get('timezone') == str(tz)
+        and not snapshot.meta.get('rebuild')
+    )
+
+
+def user_transactions(user):
+    return Transaction.objects.filter(account__user=user)
+
+
+def build(user, data_version, tz):
+    categories, channels = {}, {}
+    columns = fetch(user_transactions(user), categories, channels, tz)
+    meta = {
+        'owner': owner(user),
+        'data_version': data_version,
+        'timezone': str(tz),
+        'categories': list(categories),
+        'channels': list(channels),
+    }
+    return meta, columns
+
+
+def merge(columns, rows):
+    """Columns with `rows` replacing the rows of the same id and the others added, ordered by id."""
+    if not len(rows['id']):
+        return columns
+    position = np.searchsorted(columns['id'], rows['id'])
+    present = position < len(columns['id'])
+    present[present] = columns['id'][position[present]] == rows['id'][present]
+    merged = {name: np.array(values) for name, values in columns.items()}
+    for name in merged:
+        merged[name][position[present]] = rows[name][present]
+    new = ~present
+    if new.any():
+        merged = {name: np.concatenate([merged[name], rows[name][new]]) for name in merged}
+        # Appended rows usually all come after the existing ones
+        if len(merged['id']) > 1 and (np.diff(merged['id']) < 0).any():
+            order = np.argsort(merged['id'], kind='stable')
+            merged = {name: values[order] for name, values in merged.items()}
+    return merged
+
+
+def refresh(user, transaction_ids=(), rebuild=False):
+    """Bring the user's snapshot up to date and return it.
+
+    transaction_ids are Plaid transaction_ids whose rows changed in place (the
+    modified transactions of a sync); their rows are re-read.
+    With rebuild the snapshot is read from scratch.
+    """
+    tz = timezone.get_current_timezone()
+    with locked(user):
+        # Read before the rows: a change committed meanwhile leaves the snapshot behind, not ahead
+        data_version = User.objects.filter(pk=user.pk).values_list('data_version', flat=True).get()
+        snapshot = None if rebuild else read(user)
+        if not current(snapshot, user, tz):
+            meta, columns = build(user, data_version, tz)
+            return write(user, meta, columns)
+
+        categories = {c: i for i, c in enumerate(snapshot.categories)}
+        channels = {c: i for i, c in enumerate(snapshot.channels)}
+        transactions = user_transactions(user)
+        changed = transactions.filter(id__gt=snapshot.max_id)
+        columns = merge(snapshot.columns, fetch(changed, categories, channels, tz))
+        transaction_ids = list(transaction_ids)
+        for start in range(0, len(transaction_ids), 1000):
+            batch = transactions.filter(id__lte=snapshot.max_id, transaction_id__in=transaction_ids[start:start + 1000])
+            columns = merge(columns, fetch(batch, categories, channels, tz))
+
+        if transactions.count() != len(columns['id']):
+            # Rows were removed, or committed with ids below ones already read
+            ids = np.fromiter(transactions.order_by('id').values_list('id', flat=True).iterator(chunk_size=FETCH_SIZE), dtype=np.int64)
+            keep = np.isin(columns['id'], ids, assume_unique=True)
+            columns = {name: values[keep] for name, values in columns.items()}
+            missing = ids[~np.isin(ids, columns['id'], assume_unique=True)]
+            for start in range(0, len(missing), 1000):
+                batch = transactions.filter(id__in=missing[start:start + 1000].tolist())
+                columns = merge(columns, fetch(batch, categories, channels, tz))
+
+        meta = dict(snapshot.meta, data_version=data_version, categories=list(categories), channels=list(channels))
+        if columns is snapshot.columns:
+            # Nothing changed; only record that the snapshot is current
+            write_meta(user, meta)
+            return Snapshot(meta, columns)
+        return write(user, meta, columns)
+
+
+def load(user):
+    """The user's snapshot, refreshed first if the user's data changed since it was written."""
+    snapshot = read(user)
+    if not current(snapshot, user, timezone.get_current_timezone()) or snapshot.meta.get('data_version') != user.data_version:
+        return refresh(user)
+    return snapshot
+
+
+def invalidate(user):
+    """Have the next load() rebuild the user's snapshot from scratch.
+
+    For changes refresh() cannot find on its own: rows rewritten in place whose
+    ids it was not given, e.g. because the refresh after a sync failed.
+    """
+    if not enabled():
+        return
+    try:
+        with locked(user):
+            snapshot = read(user)
+            if snapshot is not None:
+                write_meta(user, dict(snapshot.meta, rebuild=True))
+    except OSError:
+        clear(user)
+
+
+def clear(user=None):
+    """Delete one user's snapshot, or every snapshot; they are rebuilt on next use."""
+    if not enabled():
+        return
+    path = user_dir(user) if user is not None else snapshot_dir()
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,403 @@
+"""
+Bulk import of bank statements (CSV and OFX) into Transaction.
+
+Files are parsed as a stream of records and written in chunks of
+IMPORT_BATCH_SIZE rows, so memory depends on the chunk size rather than on the
+size of the file. A record is skipped as a duplicate when
+
+- its transaction_id is already stored for the account, or
+- a transaction that was stored before the import started has the same
+  (date, amount, description) fingerprint. Fingerprints are compared as a
+  multiset, so two identical coffees on the same day in the statement are only
+  dropped if two matching rows already exist (e.g. from a Plaid sync).
+
+Like the Plaid sync, only expenses (positive amounts) are stored.
+"""
+import csv
+import logging
+import re
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache, partial
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection, transaction as db_transaction
+from django.db.models.constants import OnConflict
+from django.utils import timezone
+
+import app.db_methods as db
+from app import categorize, merchants, rollups
+from app.models import Account, Transaction
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = getattr(settings, 'IMPORT_BATCH_SIZE', 5000)
+FORMATS = ['csv', 'ofx']
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%Y/%m/%d', '%d %b %Y']
+
+# Normalized CSV header -> record field; the first matching column wins
+COLUMN_ALIASES = {
+    'transaction_id': ['transaction_id', 'transaction id', 'id', 'fitid', 'reference', 'reference number'],
+    'date': ['date', 'transaction date', 'posted date', 'posting date', 'post date'],
+    'amount': ['amount', 'transaction amount'],
+    'debit': ['debit', 'withdrawal', 'withdrawals'],
+    'credit': ['credit', 'deposit', 'deposits'],
+    'description': ['description', 'name', 'payee', 'details', 'memo'],
+    'merchant_name': ['merchant_name', 'merchant name', 'merchant'],
+    'category': ['category', 'transaction_type'],
+}
+
+
+class StatementError(ValueError):
+    pass
+
+
+def detect_format(filename, requested=None):
+    statement_format = (requested or filename.rsplit('.', 1)[-1]).lower()
+    if statement_format in ('qfx', 'ofx'):
+        return 'ofx'
+    if statement_format not in FORMATS:
+        raise StatementError(f'Unsupported statement format: {statement_format}')
+    return statement_format
+
+
+def statement_account(user, account_id, name=None, institution=None):
+    """The user's account with this account_id, created as a manual (non-Plaid) account if missing."""
+    account, _ = Account.objects.get_or_create(
+        user=user,
+        account_id=account_id,
+        defaults={
+            'access_token': Account.MANUAL_ACCESS_TOKEN,
+            'name': name or 'Imported statement',
+            'account_type': 'bank',
+            'institution': institution,
+        },
+    )
+    return account
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value, date_format=None):
+    # Statements repeat the same few hundred dates, so parsing is cached
+    value = value.strip()
+    for candidate in [date_format] if date_format else DATE_FORMATS:
+        try:
+            return datetime.strptime(value, candidate).date()
+        except ValueError:
+            continue
+    raise StatementError(f'Invalid date: {value!r}')
+
+
+@lru_cache(maxsize=4096)
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+
+def parse_amount(value):
+    value = value.strip().replace('$', '').replace(',', '')
+    negative = value.startswith('(') and value.endswith(')')
+    try:
+        amount = Decimal(value.strip('()') or '0').quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise StatementError(f'Invalid amount: {value!r}')
+    return -amount if negative else amount
+
+
+def normalize_description(value):
+    return ' '.join((value or '').split()).casefold()
+
+
+def record(date, amount, description, transaction_id=None, merchant_name=None, category=None):
+    return {
+        'transaction_id': transaction_id or None,
+        'date': date,
+        'amount': amount,
+        'description': description,
+        'merchant_name': merchant_name or None,
+        'category': category or None,
+    }
+
+
+def csv_columns(header):
+    normalized = [h.strip().lower() for h in header]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in normalized:
+                columns[field] = normalized.index(alias)
+                break
+    if 'date' not in columns or not ('amount' in columns or 'debit' in columns or 'credit' in columns):
+        raise StatementError(f'CSV needs a date column and an amount or debit/credit columns, got: {header}')
+    return columns
+
+
+def parse_csv(stream, date_format=None, expenses_negative=True):
+    """Yield records from a CSV statement.
+
+    Most banks export money leaving the account as a negative amount, the
+    opposite of Plaid's convention, so a single amount column is negated unless
+    expenses_negative is False. Separate debit/credit columns are unambiguous.
+    Malformed input raises StatementError naming the line.
+    """
+    reader = csv.reader(stream)
+    try:
+        yield from csv_records(reader, date_format, expenses_negative)
+    except (StatementError, csv.Error, UnicodeDecodeError) as e:
+        raise StatementError(f'Line {reader.line_num}: {e}') from e
+
+
+def csv_records(reader, date_format, expenses_negative):
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = csv_columns(header)
+
+    def column(row, field):
+        index = columns.get(field)
+        return row[index] if index is not None and index < len(row) else ''
+
+    for row in reader:
+        if not any(row):
+            continue
+        if 'amount' in columns:
+            amount = parse_amount(column(row, 'amount'))
+            if expenses_negative:
+                amount = -amount
+        else:
+            amount = parse_amount(column(row, 'debit') or '0').copy_abs() - parse_amount(column(row, 'credit') or '0').copy_abs()
+        yield record(
+            parse_date(column(row, 'date'), date_format),
+            amount,
+            column(row, 'description').strip(),
+            transaction_id=column(row, 'transaction_id').strip(),
+            merchant_name=column(row, 'merchant_name').strip(),
+            category=column(row, 'category').strip(),
+        )
+
+
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+def ofx_tags(stream, chunk_size=1 << 16):
+    """Yield (closing, tag, value, line) for every tag in an OFX file.
+
+    Works for both SGML OFX 1.x (leaf elements have no closing tag) and XML OFX
+    2.x, and reads the file in chunks because some banks write it on one line.
+    """
+    pending = ''
+    # Line of the start of pending
+    line = 1
+    while True:
+        try:
+            chunk = stream.read(chunk_size)
+        except UnicodeDecodeError as e:
+            # The bad bytes are somewhere in the chunk after pending
+            line += pending.count('\n')
+            raise StatementError(f'After line {line}: {e}') from e
+        data = pending + chunk
+        # Everything up to the last '<' is complete; keep the rest for the next read
+        cut = len(data) if not chunk else data.rfind('<')
+        position = 0
+        for match in OFX_TAG.finditer(data, 0, max(cut, 0)):
+            line += data.count('\n', position, match.start())
+            position = match.start()
+            yield match.group(1) == '/', match.group(2).upper(), match.group(3).strip(), line
+        if not chunk:
+            return
+        line += data.count('\n', position, max(cut, 0))
+        pending = data[max(cut, 0):]
+
+
+def parse_ofx(stream):
+    """Yield records from the STMTTRN entries of an OFX statement.
+
+    A malformed entry raises StatementError naming the line it ends on.
+    """
+    current = None
+    for closing, tag, value, line in ofx_tags(stream):
+        if tag == 'STMTTRN':
+            if not closing:
+                current = {}
+                continue
+            if current is not None:
+                try:
+                    entry = ofx_record(current)
+                except StatementError as e:
+                    raise StatementError(f'Line {line}: {e}') from e
+                yield entry
+            current = None
+        elif current is not None and not closing and value:
+            current[tag] = value
+
+
+def ofx_record(entry):
+    if 'DTPOSTED' not in entry or 'TRNAMT' not in entry:
+        raise StatementError(f'OFX transaction without DTPOSTED/TRNAMT: {entry}')
+    name, memo = entry.get('NAME', ''), entry.get('MEMO', '')
+    return record(
+        parse_date(entry['DTPOSTED'][:8], '%Y%m%d'),
+        # OFX amounts are signed from the account's point of view; debits are negative
+        -parse_amount(entry['TRNAMT']),
+        name or memo,
+        transaction_id=entry.get('FITID'),
+        merchant_name=name if memo else None,
+    )
+
+
+def parse_statement(stream, statement_format, date_format=None, expenses_negative=True):
+    if statement_format == 'ofx':
+        return parse_ofx(stream)
+    return parse_csv(stream, date_format=date_format, expenses_negative=expenses_negative)
+
+
+def fingerprint(day, amount, description):
+    return day, int(amount * 100), normalize_description(description)
+
+
+def existing_fingerprints(account, days, before):
+    """Multiset of fingerprints stored for the account on these days before the import started."""
+    rows = Transaction.objects.filter(
+        account=account,
+        datetime__gte=day_start(min(days)),
+        datetime__lt=day_start(max(days) + timedelta(days=1)),
+        created_at__lt=before,
+    ).values_list('datetime', 'amount', 'description')
+    return Counter(
+        fingerprint(timezone.localdate(stored_at), amount, description)
+        for stored_at, amount, description in rows.iterator(chunk_size=IMPORT_BATCH_SIZE)
+    )
+
+
+def import_chunk(account, records, started, import_key, matcher, summary, months):
+    expenses = [r for r in records if r['amount'] > 0]
+    summary['skipped_income'] += len(records) - len(expenses)
+    if not expenses:
+        return
+
+    existing_ids = set(
+        Transaction.objects.filter(
+            account=account, transaction_id__in=[r['transaction_id'] for r in expenses if r['transaction_id']]
+        ).values_list('transaction_id', flat=True)
+    )
+    fingerprints = existing_fingerprints(account, {r['date'] for r in expenses}, started)
+    merchant_ids = merchants.resolve([r['merchant_name'] for r in expenses])
+
+    rows = []
+    for r in expenses:
+        key = fingerprint(r['date'], r['amount'], r['description'])
+        if fingerprints[key] > 0:
+            fingerprints[key] -= 1
+            summary['duplicates'] += 1
+            continue
+        transaction_id = r['transaction_id']
+        if transaction_id in existing_ids:
+            summary['duplicates'] += 1
+            continue
+        if transaction_id is None:
+            transaction_id = f'stmt-{import_key}-{summary["rows"] + len(rows)}'
+        existing_ids.add(transaction_id)
+
+        category = r['category'] or 'UNCATEGORIZED'
+        rows.append((
+            transaction_id,
+            account.id,
+            r['date'],
+            r['amount'],
+            r['description'],
+            matcher.categorize(r['merchant_name'], r['description'], 'other', r['amount'], category),
+            category,
+            r['merchant_name'],
+            merchant_ids.get(r['merchant_name']),
+            'other',
+        ))
+        months.add((r['date'].year, r['date'].month))
+
+    inserted = insert_transactions(rows)
+    summary['imported'] += inserted
+    # Rows the unique constraint turned away, e.g. ones a concurrent import stored first
+    summary['duplicates'] += len(rows) - inserted
+
+
+INSERT_FIELDS = [
+    'transaction_id', 'account', 'datetime', 'amount', 'description',
+    'transaction_type', 'plaid_category', 'merchant_name', 'merchant', 'payment_channel', 'created_at',
+]
+
+
+@lru_cache(maxsize=4096)
+def db_day_start(day):
+    return connection.ops.adapt_datetimefield_value(day_start(day))
+
+
+def insert_transactions(rows):
+    """Insert (transaction_id, account_id, date, amount, description, transaction_type,
+    plaid_category, merchant_name, merchant_id, payment_channel) tuples with one executemany.
+
+    bulk_create prepares every value of every model instance through the field
+    API, which dominates the cost of a large import. Here the only values that
+    need adapting are repeated dates, which are cached, a single created_at,
+    amounts, which become cents, and names, which become cached lookup codes.
+    Rows that hit the unique (transaction_id, account) constraint are ignored, as
+    with bulk_create(ignore_conflicts=True). Returns how many rows were inserted.
+    """
+    if not rows:
+        return 0
+    ops = connection.ops
+    meta = Transaction._meta
+    columns = ', '.join(ops.quote_name(meta.get_field(name).column) for name in INSERT_FIELDS)
+    placeholders = ', '.join(['%s'] * len(INSERT_FIELDS))
+    sql = (
+        f'{ops.insert_statement(on_conflict=OnConflict.IGNORE)} {ops.quote_name(meta.db_table)} '
+        f'({columns}) VALUES ({placeholders}) {ops.on_conflict_suffix_sql([], OnConflict.IGNORE, [], [])}'
+    )
+    created_at = ops.adapt_datetimefield_value(timezone.now())
+    # Amounts are stored in cents, categories and channels as lookup codes. Names
+    # new to this transaction stay out of the shared cache until it commits, so
+    # they are memoized here rather than looked up again for every row.
+    cents = meta.get_field('amount').get_prep_value
+    category_code = lru_cache(maxsize=None)(partial(meta.get_field('transaction_type').lookup.code, create=True))
+    channel_code = lru_cache(maxsize=None)(partial(meta.get_field('payment_channel').lookup.code, create=True))
+    inserted = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), IMPORT_BATCH_SIZE):
+            cursor.executemany(sql, [
+                (transaction_id, account_id, db_day_start(day), cents(amount), description,
+                 category_code(transaction_type), category_code(plaid_category), merchant_name, merchant_id,
+                 None if payment_channel is None else channel_code(payment_channel), created_at)
+                for transaction_id, account_id, day, amount, description, transaction_type, plaid_category, merchant_name, merchant_id, payment_channel
+                in rows[start:start + IMPORT_BATCH_SIZE]
+            ])
+            # Summed over the batch; ignored rows are not counted
+            inserted += cursor.rowcount
+    return inserted
+
+
+def import_statement(user, account, records, batch_size=IMPORT_BATCH_SIZE):
+    """Import parsed statement records into one of the user's accounts.
+
+    The whole import is one database transaction, so a malformed line rolls back
+    everything written so far. Returns counts of rows read, imported, skipped as
+    duplicates and skipped as income.
+    """
+    started = timezone.now()
+    import_key = uuid.uuid4().hex[:12]
+    summary = {'rows': 0, 'imported': 0, 'duplicates': 0, 'skipped_income': 0}
+    months = set()
+    matcher = categorize.matcher_for(user)
+    records = iter(records)
+
+    with db_transaction.atomic():
+        while True:
+            chunk = list(islice(records, batch_size))
+            if not chunk:
+                break
+            import_chunk(account, chunk, started, import_key, matcher, summary, months)
+            summary['rows'] += len(chunk)
+        rollups.refresh_months(user, months)
+        db.bump_data_version(user)
+
+    logger.info('Imported statement', extra={'account_id': account.account_id, **summary})
+    return summary
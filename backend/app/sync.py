@@ -0,0 +1,125 @@
+import json
+import logging
+import time
+
+import plaid
+from plaid.model.transactions_sync_request import TransactionsSyncRequest
+
+from django.utils import timezone
+
+import app.db_methods as db
+from app import recurring, snapshot
+from app.plaid_client import client, plaid_error
+
+logger = logging.getLogger(__name__)
+
+MUTATION_DURING_PAGINATION = 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION'
+# How many times a sync restarts from the last committed cursor before giving up
+MAX_RESTARTS = 3
+RESTART_DELAY_SECONDS = 1
+
+
+class SyncError(Exception):
+    """Raised when Plaid returns an error the sync engine cannot recover from."""
+
+    def __init__(self, error):
+        self.error = error
+        super().__init__(error.get('error_message') or error.get('error_code') or str(error))
+
+
+class SyncTimeout(Exception):
+    """Raised when an item sync runs past its deadline. Pages committed so far are kept."""
+
+
+def fetch_sync_page(access_token, cursor=None, timeout=None):
+    """Request a single /transactions/sync page from Plaid."""
+    request_params = {
+        'access_token': access_token,
+    }
+    if cursor is not None:
+        request_params['cursor'] = cursor
+
+    request = TransactionsSyncRequest(**request_params)
+    # The raw JSON is all apply_sync_page needs. Building the SDK's Transaction
+    # models costs milliseconds of CPU per row while holding the GIL, which would
+    # serialize concurrent syncs however many threads run them.
+    options = {'_preload_content': False}
+    if timeout is not None:
+        options['_request_timeout'] = timeout
+    response = client.transactions_sync(request, **options)
+    try:
+        return json.loads(response.data)
+    finally:
+        response.release_conn()
+
+
+def sync_item(access_token, user, max_restarts=MAX_RESTARTS, timeout=None):
+    """Pull every available /transactions/sync page for an item until has_more is false.
+
+    Each page is committed (with its cursor) as soon as it arrives, so only one
+    page is held in memory however large the backfill is. If Plaid reports that
+    the item changed mid-pagination, the loop restarts from the last committed
+    cursor. If timeout (seconds) is given the sync stops with SyncTimeout once it
+    is exceeded. Returns a summary of the pages and rows applied.
+    """
+    summary = {'pages': 0, 'added': 0, 'updated': 0, 'removed': 0, 'restarts': 0}
+    started_at = timezone.now()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    cursor = db.get_cursor(access_token=access_token)
+    # Rows changed in place, which the snapshot refresh re-reads
+    modified_ids = []
+
+    try:
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SyncTimeout(f"Sync timed out after {summary['pages']} pages")
+            try:
+                page = fetch_sync_page(access_token, cursor, timeout=remaining)
+            except plaid.ApiException as e:
+                # Errors raised before Plaid answered (timeouts, dropped connections) have no JSON body
+                error = plaid_error(e) or {'error_message': f'Plaid request failed: {e.status} {e.reason}'}
+                if error.get('error_code') == MUTATION_DURING_PAGINATION and summary['restarts'] < max_restarts:
+                    logger.warning('Item changed during pagination, restarting from last committed cursor')
+                    summary['restarts'] += 1
+                    time.sleep(RESTART_DELAY_SECONDS)
+                    cursor = db.get_cursor(access_token=access_token)
+                    continue
+                raise SyncError(error) from e
+
+            page_summary = db.apply_sync_page(user, access_token, page)
+            summary['pages'] += 1
+            summary['added'] += page_summary['added'] + page_summary['modified']['added']
+            summary['updated'] += page_summary['modified']['updated']
+            summary['removed'] += page_summary['removed']
+            modified_ids.extend(t['transaction_id'] for t in page['modified'])
+
+            cursor = page['next_cursor']
+            if not page['has_more']:
+                break
+        logger.info('Synced item', extra=summary)
+    finally:
+        # Pages committed before a failure or timeout changed the ledger as well
+        if summary['added'] or summary['updated'] or summary['removed']:
+            after_sync(user, started_at, summary, modified_ids)
+    return summary
+
+
+def after_sync(user, started_at, summary, modified_ids):
+    """Bring derived data up to date with the rows a sync committed. Failures are logged, not raised."""
+    if summary['added']:
+        # A detection failure is retried by the nightly run
+        try:
+            recurring.refresh_after_sync(user, started_at)
+        except Exception:
+            logger.exception('Recurring stream refresh failed')
+    if not snapshot.enabled():
+        return
+    try:
+        snapshot.refresh(user, transaction_ids=modified_ids)
+    except Exception:
+        # load() alone would not re-read the modified rows, so rebuild the snapshot instead
+        logger.exception('Snapshot refresh failed; it is rebuilt on next use')
+        snapshot.invalidate(user)
@@ -0,0 +1,79 @@
+from django.conf import settings
+from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
+
+import app.db_methods as db
+from app import categorize, jobs, recurring, sync
+from app.models import Job
+from app.plaid_client import client
+
+
+def enqueue_item_sync(user, access_token, delay=0):
+    """Queue a sync for one item, reusing a sync for the same item that is still waiting to run."""
+    return jobs.enqueue(
+        'sync_item',
+        user=user,
+        delay=delay,
+        dedupe_key=f'sync_item:{access_token}',
+        access_token=access_token,
+    )
+
+
+def enqueue_recategorize(user):
+    """Queue re-applying a user's category rules; edits made while one is waiting share it."""
+    return jobs.enqueue(
+        'recategorize_transactions',
+        user=user,
+        dedupe_key=f'recategorize_transactions:{user.pk}',
+    )
+
+
+def enqueue_detect_recurring(user):
+    """Queue re-detecting all of a user's recurring streams, e.g. after paychecks are edited."""
+    return jobs.enqueue(
+        'detect_recurring',
+        user=user,
+        dedupe_key=f'detect_recurring:{user.pk}',
+    )
+
+
+@jobs.register('exchange_public_token')
+def exchange_public_token(job):
+    """Exchange a Link public token and schedule the item's initial sync."""
+    if 'public_token' not in job.payload:
+        raise ValueError('The public token was already exchanged')
+    exchange_request = ItemPublicTokenExchangeRequest(
+        public_token=job.payload['public_token']
+    )
+    exchange_response = client.item_public_token_exchange(exchange_request).to_dict()
+    # The token is spent; don't keep a credential in the job row
+    del job.payload['public_token']
+    Job.objects.filter(pk=job.pk).update(payload=job.payload)
+    # Webhooks identify the item by item_id only
+    db.record_item(job.user, exchange_response['access_token'], exchange_response['item_id'])
+
+    # Give Plaid time to gather the item's transactions before the first sync
+    sync_job = enqueue_item_sync(
+        job.user, exchange_response['access_token'], delay=getattr(settings, 'INITIAL_SYNC_DELAY', 30)
+    )
+    return {
+        'item_id': exchange_response['item_id'],
+        'sync_job_id': sync_job.id,
+    }
+
+
+@jobs.register('sync_item')
+def sync_item(job):
+    """Pull all available /transactions/sync pages for one item."""
+    return sync.sync_item(job.payload['access_token'], job.user)
+
+
+@jobs.register('recategorize_transactions')
+def recategorize_transactions(job):
+    """Re-apply the user's CategoryRules to all of their stored transactions."""
+    return categorize.recategorize(job.user)
+
+
+@jobs.register('detect_recurring')
+def detect_recurring(job):
+    """Re-detect all of the user's recurring charges and paychecks."""
+    return {'streams': recurring.refresh_streams(job.user)}
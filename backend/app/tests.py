@@ -1,5 +1,1423 @@
-from django.test import TestCase
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import runpy
+import shutil
+import tempfile
+import time
+import unittest
+import warnings
+from unittest import mock
+
+import plaid
+from django.core.management import call_command
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction as db_transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.utils import load_backend
+from django.db.models import Sum
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+import app.db_methods as db
+from app import cache as response_cache, categorize, exports, forecast, instrumentation, jobs, payloads, recurring, rollups, snapshot, statements, sync, webhooks
+from app.fields import UNKNOWN_CODE
+from app.plaid_client import RateLimitedPlaidClient
+from app.models import Account, Category, CategoryRule, Cursor, Job, MonthlySpending, RecurringStream, Transaction, User, WebhookEvent
 from . import views
 
-# Create your tests here.
 
+def make_user(username='alice'):
+    return User.objects.create(username=username)
+
+
+def make_account(user, account_id='acc-1', access_token='access-1', name='Checking'):
+    return Account.objects.create(
+        user=user, account_id=account_id, access_token=access_token, name=name, account_type='bank', balance=0,
+    )
+
+
+def make_transaction(account, transaction_id, when, amount='10.00', **fields):
+    values = {'transaction_type': 'FOOD_AND_DRINK', 'plaid_category': 'FOOD_AND_DRINK', 'payment_channel': 'in store'}
+    values.update(fields)
+    return Transaction.objects.create(
+        account=account, transaction_id=transaction_id, datetime=when, amount=Decimal(amount), **values,
+    )
+
+
+def aware(*args):
+    return timezone.make_aware(datetime(*args))
+
+
+def plaid_account(account_id='acc-1', name='Checking', balance=100.0):
+    return {'account_id': account_id, 'name': name, 'type': 'depository', 'balances': {'current': balance}}
+
+
+def plaid_transaction(transaction_id, amount, day, account_id='acc-1', merchant_name='Corner Cafe', category='FOOD_AND_DRINK'):
+    """A transaction as /transactions/sync returns it."""
+    return {
+        'transaction_id': transaction_id,
+        'account_id': account_id,
+        'amount': amount,
+        'date': day.isoformat(),
+        'datetime': None,
+        'description': merchant_name,
+        'merchant_name': merchant_name,
+        'personal_finance_category': {'primary': category},
+        'payment_channel': 'in store',
+    }
+
+
+def sync_page(added=(), modified=(), removed=(), next_cursor='cursor-1', has_more=False, accounts=None):
+    return {
+        'accounts': accounts if accounts is not None else [plaid_account()],
+        'added': list(added),
+        'modified': list(modified),
+        'removed': list(removed),
+        'next_cursor': next_cursor,
+        'has_more': has_more,
+    }
+
+
+@override_settings(SNAPSHOT_DIR='')
+class AppTestCase(TestCase):
+    """Runs without columnar snapshots and with an empty response cache."""
+
+    def setUp(self):
+        # Primary keys are reused between tests, so cached responses could leak across them
+        response_cache.get_backend().clear()
+
+
+class TransactionFeedTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.account = make_account(self.user)
+        noon = aware(2024, 3, 1, 12)
+        # Three rows share a datetime, so pages must break ties on id
+        self.rows = [
+            make_transaction(self.account, 'txn-a', noon - timedelta(days=1)),
+            make_transaction(self.account, 'txn-b', noon),
+            make_transaction(self.account, 'txn-c', noon),
+            make_transaction(self.account, 'txn-d', noon),
+            make_transaction(self.account, 'txn-e', noon + timedelta(days=1)),
+        ]
+        other = make_account(make_user('bob'), account_id='acc-2', access_token='access-2')
+        make_transaction(other, 'txn-other', noon)
+
+    def walk(self, limit, **filters):
+        ids, cursor = [], None
+        while True:
+            page, cursor = db.get_transaction_feed(self.user, cursor=cursor, limit=limit, **filters)
+            ids += [t.transaction_id for t in page]
+            if cursor is None:
+                return ids
+
+    def test_cursor_round_trip(self):
+        row = self.rows[2]
+        self.assertEqual(db.decode_feed_cursor(db.encode_feed_cursor(row)), (row.datetime, row.id))
+
+    def test_malformed_cursor_is_rejected(self):
+        for token in ['not-a-cursor', '', 'WyIyMDI0LTAzLTAxIiwgIngiXQ']:
+            with self.assertRaises(ValueError):
+                db.decode_feed_cursor(token)
+
+    def test_pages_cover_every_row_once_newest_first(self):
+        expected = ['txn-e', 'txn-d', 'txn-c', 'txn-b', 'txn-a']
+        for limit in (1, 2, 3, 5, 10):
+            self.assertEqual(self.walk(limit), expected, f'limit={limit}')
+
+    def test_full_last_page_has_no_next_cursor(self):
+        page, cursor = db.get_transaction_feed(self.user, limit=5)
+        self.assertEqual(len(page), 5)
+        self.assertIsNone(cursor)
+
+    def test_filters_apply_across_pages(self):
+        noon = aware(2024, 3, 1, 12)
+        self.assertEqual(self.walk(1, start=noon, end=noon + timedelta(hours=1)), ['txn-d', 'txn-c', 'txn-b'])
+
+    def test_view_rejects_bad_cursor(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/api/get_transaction_feed/', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_view_pages_through_the_feed(self):
+        self.client.force_login(self.user)
+        body = self.client.get('/api/get_transaction_feed/', {'limit': 3}).json()
+        self.assertEqual([t['transaction_id'] for t in body['transactions']], ['txn-e', 'txn-d', 'txn-c'])
+        body = self.client.get('/api/get_transaction_feed/', {'limit': 3, 'cursor': body['next_cursor']}).json()
+        self.assertEqual([t['transaction_id'] for t in body['transactions']], ['txn-b', 'txn-a'])
+        self.assertIsNone(body['next_cursor'])
+
+
+class ApplySyncPageTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.page = sync_page(added=[
+            plaid_transaction('txn-1', 12.5, date(2024, 3, 1)),
+            plaid_transaction('txn-2', 30.0, date(2024, 3, 2)),
+            # Inflows are not stored as transactions
+            plaid_transaction('txn-3', -500.0, date(2024, 3, 3)),
+        ])
+
+    def test_replaying_a_page_stores_nothing_twice(self):
+        first = db.apply_sync_page(self.user, 'access-1', self.page)
+        second = db.apply_sync_page(self.user, 'access-1', self.page)
+        self.assertEqual(first['added'], 2)
+        self.assertEqual(second['added'], 0)
+        self.assertEqual(sorted(Transaction.objects.values_list('transaction_id', flat=True)), ['txn-1', 'txn-2'])
+        self.assertEqual(Account.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(Cursor.objects.get(access_token='access-1').cursor, 'cursor-1')
+
+    def test_duplicates_within_a_page_are_stored_once(self):
+        page = sync_page(added=[plaid_transaction('txn-1', 12.5, date(2024, 3, 1))] * 2)
+        self.assertEqual(db.apply_sync_page(self.user, 'access-1', page)['added'], 1)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_failed_page_rolls_back_rows_and_cursor(self):
+        with mock.patch('app.db_methods.update_cursor', side_effect=RuntimeError('database went away')):
+            with self.assertRaises(RuntimeError):
+                db.apply_sync_page(self.user, 'access-1', self.page)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(Account.objects.exists())
+        self.assertIsNone(db.get_cursor('access-1'))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.data_version, 0)
+
+    def test_transactions_never_land_in_another_users_account(self):
+        db.apply_sync_page(self.user, 'access-1', self.page)
+        page = sync_page(added=[plaid_transaction('txn-9', 5.0, date(2024, 3, 4))], accounts=[])
+        self.assertEqual(db.apply_sync_page(make_user('bob'), 'access-2', page)['added'], 0)
+        self.assertFalse(Transaction.objects.filter(transaction_id='txn-9').exists())
+
+    def test_page_bumps_data_version(self):
+        db.apply_sync_page(self.user, 'access-1', self.page)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.data_version, 1)
+
+    def test_modified_transactions_leave_other_users_rows_alone(self):
+        bob_row = make_transaction(make_account(make_user('bob'), access_token='access-2'), 'txn-1', aware(2024, 3, 1), amount='7.00')
+        page = sync_page(modified=[plaid_transaction('txn-1', 12.5, date(2024, 3, 1))])
+        self.assertEqual(db.apply_sync_page(self.user, 'access-1', page)['modified']['added'], 1)
+        bob_row.refresh_from_db()
+        self.assertEqual((bob_row.amount, bob_row.account.user.username), (Decimal('7.00'), 'bob'))
+        self.assertEqual(Transaction.objects.get(account__user=self.user).amount, Decimal('12.50'))
+
+    def test_modified_transaction_moves_between_the_users_accounts(self):
+        accounts = [plaid_account(), plaid_account('acc-2', 'Savings')]
+        db.apply_sync_page(self.user, 'access-1', sync_page(added=[plaid_transaction('txn-1', 12.5, date(2024, 3, 1))], accounts=accounts))
+        page = sync_page(modified=[plaid_transaction('txn-1', 12.5, date(2024, 3, 1), account_id='acc-2')], accounts=accounts)
+        self.assertEqual(db.apply_sync_page(self.user, 'access-1', page)['modified']['updated'], 1)
+        self.assertEqual(Transaction.objects.get(transaction_id='txn-1').account.account_id, 'acc-2')
+
+    def test_modified_transaction_updates_the_row_under_its_own_account(self):
+        savings = make_account(self.user, 'acc-2', name='Savings')
+        make_transaction(make_account(self.user), 'txn-1', aware(2024, 3, 1), amount='1.00')
+        make_transaction(savings, 'txn-1', aware(2024, 3, 1), amount='2.00')
+        page = sync_page(modified=[plaid_transaction('txn-1', 12.5, date(2024, 3, 1))])
+        self.assertEqual(db.apply_sync_page(self.user, 'access-1', page)['modified']['updated'], 1)
+        amounts = dict(Transaction.objects.values_list('account__account_id', 'amount'))
+        self.assertEqual(amounts, {'acc-1': Decimal('12.50'), 'acc-2': Decimal('2.00')})
+
+
+class MonthlySpendingRollupTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        db.apply_sync_page(self.user, 'access-1', sync_page(added=[
+            plaid_transaction('txn-1', 12.5, date(2024, 3, 10)),
+            plaid_transaction('txn-2', 30.0, date(2024, 4, 2), category='TRANSPORTATION'),
+            plaid_transaction('txn-3', 7.5, date(2024, 4, 5), category='GENERAL_MERCHANDISE'),
+        ]))
+
+    def rollups(self):
+        return {
+            (m.year, m.month): (m.amount_spent, m.amount_spent_food, m.amount_spent_transportation, m.amount_spent_misc)
+            for m in MonthlySpending.objects.filter(user=self.user)
+        }
+
+    def assertMatchesRebuild(self):
+        incremental = self.rollups()
+        rollups.rebuild(self.user)
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_added_transactions_fill_their_months(self):
+        self.assertEqual(self.rollups(), {
+            (2024, 3): (Decimal('12.50'), Decimal('12.50'), 0, 0),
+            (2024, 4): (Decimal('37.50'), 0, Decimal('30.00'), Decimal('7.50')),
+        })
+        self.assertMatchesRebuild()
+
+    def test_modified_transaction_moves_between_months_and_buckets(self):
+        db.apply_sync_page(self.user, 'access-1', sync_page(modified=[
+            plaid_transaction('txn-1', 20.0, date(2024, 4, 20), category='TRANSPORTATION'),
+        ], next_cursor='cursor-2'))
+        # March is left empty, so its row goes
+        self.assertEqual(self.rollups(), {
+            (2024, 4): (Decimal('57.50'), 0, Decimal('50.00'), Decimal('7.50')),
+        })
+        self.assertMatchesRebuild()
+
+    def test_removed_transaction_leaves_its_month(self):
+        db.apply_sync_page(self.user, 'access-1', sync_page(removed=[
+            {'transaction_id': 'txn-2', 'account_id': 'acc-1'},
+        ], next_cursor='cursor-2'))
+        self.assertEqual(self.rollups()[(2024, 4)], (Decimal('7.50'), 0, 0, Decimal('7.50')))
+        self.assertEqual(self.rollups()[(2024, 3)][0], Decimal('12.50'))
+        self.assertMatchesRebuild()
+
+    def test_other_users_are_untouched(self):
+        other = make_user('bob')
+        db.apply_sync_page(other, 'access-2', sync_page(
+            added=[plaid_transaction('txn-9', 99.0, date(2024, 3, 1), account_id='acc-9')],
+            accounts=[plaid_account('acc-9')],
+        ))
+        db.apply_sync_page(self.user, 'access-1', sync_page(removed=['txn-1'], next_cursor='cursor-2'))
+        self.assertNotIn((2024, 3), self.rollups())
+        self.assertEqual(MonthlySpending.objects.get(user=other, year=2024, month=3).amount_spent, Decimal('99.00'))
+
+
+class AnalyticsViewTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        account = make_account(self.user)
+        for i, category in enumerate(['FOOD_AND_DRINK', 'TRANSPORTATION', 'TRAVEL']):
+            make_transaction(account, f'txn-{i}', aware(2024, 3, 1 + i), amount=f'{10 * (i + 1)}.00', transaction_type=category)
+        self.client.force_login(self.user)
+
+    def test_limit_keeps_the_top_groups(self):
+        body = self.client.get('/api/analytics/category/', {'limit': 2}).json()
+        self.assertEqual([g['key'] for g in body['groups']], ['TRAVEL', 'TRANSPORTATION'])
+
+    def test_limit_out_of_range_is_rejected(self):
+        for limit in ['0', '-1', '501', 'ten']:
+            response = self.client.get('/api/analytics/category/', {'limit': limit})
+            self.assertEqual(response.status_code, 400, f'limit={limit}')
+
+
+class ResponseCacheTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.account = make_account(self.user)
+        make_transaction(self.account, 'txn-1', aware(2024, 3, 1))
+        self.client.force_login(self.user)
+
+    def feed_ids(self, **headers):
+        response = self.client.get('/api/get_transaction_feed/', headers=headers)
+        ids = [t['transaction_id'] for t in response.json()['transactions']] if response.status_code == 200 else None
+        return response, ids
+
+    def test_cached_until_data_version_changes(self):
+        first, ids = self.feed_ids()
+        self.assertEqual(ids, ['txn-1'])
+        # Written behind the cache's back: the cached response is still served
+        make_transaction(self.account, 'txn-2', aware(2024, 3, 2))
+        self.assertEqual(self.feed_ids()[1], ['txn-1'])
+
+        db.bump_data_version(self.user)
+        second, ids = self.feed_ids()
+        self.assertEqual(ids, ['txn-2', 'txn-1'])
+        self.assertNotEqual(first['ETag'], second['ETag'])
+
+    def test_etag_answers_with_not_modified_until_data_version_changes(self):
+        etag = self.feed_ids()[0]['ETag']
+        self.assertEqual(self.feed_ids(if_none_match=etag)[0].status_code, 304)
+        db.bump_data_version(self.user)
+        self.assertEqual(self.feed_ids(if_none_match=etag)[0].status_code, 200)
+
+    def test_users_do_not_share_entries(self):
+        self.feed_ids()
+        self.client.force_login(make_user('bob'))
+        self.assertEqual(self.feed_ids()[1], [])
+
+
+class LRUCacheBackendTests(TestCase):
+    def entry(self, size):
+        return ('application/json', b'x' * size, {})
+
+    def test_total_size_is_bounded(self):
+        cache = response_cache.LRUCacheBackend(max_bytes=4000, max_entry_bytes=2000)
+        for key in 'abc':
+            cache.set(key, self.entry(1500))
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertLessEqual(cache.size, 4000)
+
+    def test_least_recently_used_goes_first(self):
+        cache = response_cache.LRUCacheBackend(max_bytes=4000, max_entry_bytes=2000)
+        cache.set('a', self.entry(1500))
+        cache.set('b', self.entry(1500))
+        cache.get('a')
+        cache.set('c', self.entry(1500))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_oversized_responses_are_not_cached(self):
+        cache = response_cache.LRUCacheBackend(max_bytes=4000, max_entry_bytes=2000)
+        cache.set('small', self.entry(100))
+        cache.set('large', self.entry(3000))
+        self.assertIsNone(cache.get('large'))
+        self.assertIsNotNone(cache.get('small'))
+
+    def test_replacing_an_entry_updates_the_size(self):
+        cache = response_cache.LRUCacheBackend()
+        cache.set('a', self.entry(1000))
+        cache.set('a', self.entry(10))
+        self.assertEqual(cache.size, cache.entry_size('a', self.entry(10)))
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+
+
+class StatementImportTests(AppTestCase):
+    STATEMENT = (
+        'Date,Description,Amount\n'
+        '2024-03-01,Corner Cafe,-4.50\n'
+        '2024-03-01,Corner Cafe,-4.50\n'
+        '2024-03-02,Grocery Mart,-52.10\n'
+        '2024-03-03,Payroll,2000.00\n'
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.account = statements.statement_account(self.user, 'stmt-1')
+
+    def import_statement(self, text=None):
+        records = statements.parse_csv(io.StringIO(text or self.STATEMENT))
+        return statements.import_statement(self.user, self.account, records)
+
+    def test_repeated_lines_in_one_statement_are_kept(self):
+        summary = self.import_statement()
+        self.assertEqual(summary, {'rows': 4, 'imported': 3, 'duplicates': 0, 'skipped_income': 1})
+        self.assertEqual(Transaction.objects.filter(account=self.account, amount=Decimal('4.50')).count(), 2)
+
+    def test_reimporting_a_statement_imports_nothing(self):
+        self.import_statement()
+        summary = self.import_statement()
+        self.assertEqual((summary['imported'], summary['duplicates']), (0, 3))
+        self.assertEqual(Transaction.objects.filter(account=self.account).count(), 3)
+
+    def test_overlapping_statement_imports_only_new_lines(self):
+        self.import_statement()
+        summary = self.import_statement(
+            'Date,Description,Amount\n'
+            '2024-03-02,GROCERY  MART,-52.10\n'
+            '2024-03-04,Book Shop,-12.00\n'
+        )
+        self.assertEqual((summary['imported'], summary['duplicates']), (1, 1))
+
+    def test_rows_stored_by_a_sync_are_duplicates(self):
+        make_transaction(self.account, 'txn-1', aware(2024, 3, 2), amount='52.10', description='Grocery Mart')
+        summary = self.import_statement()
+        self.assertEqual((summary['imported'], summary['duplicates']), (2, 1))
+
+    def test_rows_ignored_by_the_unique_constraint_are_not_counted(self):
+        row = ('stmt-row-1', self.account.id, date(2024, 3, 1), Decimal('4.50'), 'Corner Cafe',
+               'FOOD_AND_DRINK', 'FOOD_AND_DRINK', None, None, 'other')
+        self.assertEqual(statements.insert_transactions([row, row]), 1)
+        self.assertEqual(statements.insert_transactions([row]), 0)
+        self.assertEqual(Transaction.objects.get(transaction_id='stmt-row-1').transaction_type, 'FOOD_AND_DRINK')
+
+    def upload(self, name, content):
+        self.client.force_login(self.user)
+        return self.client.post('/api/import_statement/', {
+            'account_id': 'stmt-1', 'file': SimpleUploadedFile(name, content),
+        })
+
+    def test_malformed_csv_is_a_bad_request_naming_the_line(self):
+        # csv.Error: a field over csv.field_size_limit()
+        response = self.upload('march.csv', b'Date,Description,Amount\n2024-03-01,Corner Cafe,-4.50\n2024-03-02,"' + b'x' * 200000 + b'",-1\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Line 3: field larger than field limit (131072)')
+        response = self.upload('march.csv', b'Date,Description,Amount\n2024-03-01,Corner Cafe,-4.50\n2024-02-30,Bad Date,-1\n')
+        self.assertEqual(response.json()['error'], "Line 3: Invalid date: '2024-02-30'")
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_broken_ofx_is_a_bad_request_naming_the_line(self):
+        ofx = (
+            b'OFXHEADER:100\n<OFX><BANKTRANLIST>\n'
+            b'<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>20240301\n<TRNAMT>-4.50\n<FITID>1\n</STMTTRN>\n'
+            b'<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>20240302\n<TRNAMT>lots\n<FITID>2\n</STMTTRN>\n'
+            b'</BANKTRANLIST></OFX>\n'
+        )
+        response = self.upload('march.ofx', ofx)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "Line 14: Invalid amount: 'lots'")
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_ofx_tags_report_lines_across_chunks(self):
+        text = '<OFX>\n<A>1\n\n<B>2\n</OFX>'
+        lines = [(tag, line) for _, tag, _, line in statements.ofx_tags(io.StringIO(text), chunk_size=4)]
+        self.assertEqual(lines, [('OFX', 1), ('A', 2), ('B', 4), ('OFX', 5)])
+
+
+class CategoryRuleTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+
+    def rule(self, category, **fields):
+        return CategoryRule.objects.create(user=self.user, category=category, **fields)
+
+    def categorize(self, description='', merchant_name='', amount='10.00', payment_channel='in store'):
+        matcher = categorize.matcher_for(self.user)
+        return matcher.categorize(merchant_name, description, payment_channel, Decimal(amount), 'PLAID')
+
+    def test_higher_priority_wins_then_older(self):
+        self.rule('COFFEE', description_pattern='cafe')
+        self.rule('TREATS', description_pattern='corner')
+        self.assertEqual(self.categorize('Corner Cafe'), 'COFFEE')
+        self.rule('DINING', description_pattern='corner', priority=5)
+        self.assertEqual(self.categorize('Corner Cafe'), 'DINING')
+
+    def test_priority_applies_across_merchant_and_generic_rules(self):
+        self.rule('MERCHANT', merchant_name='Corner Cafe')
+        self.rule('GENERIC', description_pattern='cafe', priority=1)
+        self.assertEqual(self.categorize('corner cafe #12', merchant_name='corner  CAFE'), 'GENERIC')
+        self.assertEqual(self.categorize('pos 123', merchant_name='Corner Cafe'), 'MERCHANT')
+        self.assertEqual(self.categorize('pos 123', merchant_name='Other'), 'PLAID')
+
+    def test_every_condition_must_hold(self):
+        self.rule('BIG', description_pattern='mart', min_amount=Decimal('100'), payment_channel='online')
+        self.rule('MART', description_pattern='mart', priority=-1)
+        self.assertEqual(self.categorize('Grocery Mart', amount='150.00', payment_channel='online'), 'BIG')
+        self.assertEqual(self.categorize('Grocery Mart', amount='50.00', payment_channel='online'), 'MART')
+        self.assertEqual(self.categorize('Grocery Mart', amount='150.00'), 'MART')
+        self.assertEqual(self.categorize('Book Shop', amount='150.00', payment_channel='online'), 'PLAID')
+
+    def test_disabled_rules_are_ignored(self):
+        self.rule('OFF', description_pattern='cafe', enabled=False)
+        self.assertEqual(self.categorize('Corner Cafe'), 'PLAID')
+
+    def test_backreferences_keep_their_groups(self):
+        self.rule('OTHER', description_pattern=r'(x)y')
+        self.rule('DOUBLE', description_pattern=r'(\d)\1')
+        self.assertEqual(self.categorize('store 4471'), 'DOUBLE')
+        self.assertEqual(self.categorize('store 4171'), 'PLAID')
+        self.assertIsNone(categorize.matcher_for(self.user).any_pattern)
+
+    def test_validate_rule_rejects_dangerous_patterns(self):
+        for pattern in ['(a+)+$', r'(\w*\s?)*x', 'x' * 300, '(unclosed']:
+            with self.assertRaises(ValueError, msg=pattern):
+                categorize.validate_rule({'category': 'X', 'description_pattern': pattern})
+        for pattern in ['(corner|main) cafe', r'uber\s*(eats)?', r'[(+)]+', r'(\d)\1']:
+            categorize.validate_rule({'category': 'X', 'description_pattern': pattern})
+
+
+def monthly(key, amount, count=6, first=date(2024, 1, 5), jitter=0.0):
+    """(keys, days, amounts) of a charge recurring on the same day of each month."""
+    days = [date(first.year + (first.month + i - 1) // 12, (first.month + i - 1) % 12 + 1, first.day).toordinal() for i in range(count)]
+    return [key] * count, days, [amount + jitter * (i % 2) for i in range(count)]
+
+
+def combine(*series):
+    return tuple(sum((list(s[i]) for s in series), []) for i in range(3))
+
+
+class RecurringDetectionTests(AppTestCase):
+    def detect(self, *series):
+        return sorted(recurring.detect(*combine(*series)), key=lambda s: (s['group_key'], s['amount_band']))
+
+    def test_two_subscriptions_at_one_merchant_stay_apart(self):
+        streams = self.detect(monthly('merchant:1', 15.99), monthly('merchant:1', 6.99))
+        self.assertEqual([(s['frequency'], s['average_amount']) for s in streams], [('monthly', 6.99), ('monthly', 15.99)])
+
+    def test_inflows_are_banded_by_size(self):
+        # Sorted negative amounts used to be cut into a band per row
+        streams = self.detect(monthly('description:payroll', -2000.0, jitter=-15.0))
+        self.assertEqual(len(streams), 1)
+        self.assertTrue(streams[0]['inflow'])
+        self.assertEqual(streams[0]['occurrences'], 6)
+
+    def test_inflows_of_different_sizes_get_their_own_streams(self):
+        streams = self.detect(monthly('description:transfer', -100.0), monthly('description:transfer', -2000.0))
+        self.assertEqual(sorted(s['average_amount'] for s in streams), [-2000.0, -100.0])
+        self.assertEqual(len({s['amount_band'] for s in streams}), 2)
+
+    def test_charge_and_refund_of_one_size_are_not_merged(self):
+        streams = self.detect(monthly('merchant:1', 50.0), monthly('merchant:1', -50.0))
+        self.assertEqual(sorted(s['inflow'] for s in streams), [False, True])
+        self.assertEqual(len({s['amount_band'] for s in streams}), 2)
+
+    def test_irregular_charges_are_not_streams(self):
+        days = [date(2024, 1, d).toordinal() for d in (1, 3, 11, 12, 29)]
+        self.assertEqual(recurring.detect(['merchant:1'] * 5, days, [20.0] * 5), [])
+
+    def test_refresh_stores_inflows_as_income(self):
+        user = make_user()
+        account = make_account(user)
+        for i in range(6):
+            when = aware(2024, 1 + i, 5)
+            make_transaction(account, f'txn-{i}', when, amount='12.99', description='STREAMFLIX')
+            make_transaction(account, f'dep-{i}', when, amount='-1500.00', description='ACME PAYROLL')
+        self.assertEqual(recurring.refresh_streams(user, today=date(2024, 6, 20)), 2)
+        streams = {s.kind: s for s in RecurringStream.objects.filter(user=user)}
+        self.assertEqual(streams[RecurringStream.KIND_EXPENSE].average_amount, Decimal('12.99'))
+        self.assertEqual(streams[RecurringStream.KIND_INCOME].average_amount, Decimal('1500.00'))
+        self.assertEqual(streams[RecurringStream.KIND_INCOME].next_date, date(2024, 7, 5))
+
+
+class SnapshotTestCase(AppTestCase):
+    """Reads and writes columnar snapshots in a temporary SNAPSHOT_DIR."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        override = override_settings(SNAPSHOT_DIR=directory)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class ForecastHistoryTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        account = make_account(self.user)
+        make_transaction(account, 'txn-1', aware(2024, 3, 1, 12), amount='20.00')
+        make_transaction(account, 'txn-2', aware(2024, 3, 2, 12), amount='5.00')
+        # A refund and a deposit: income is counted from paychecks and income streams
+        make_transaction(account, 'refund-1', aware(2024, 3, 2, 13), amount='-15.00')
+        make_transaction(account, 'deposit-1', aware(2024, 3, 3, 9), amount='-2000.00')
+
+    def test_history_leaves_out_inflows(self):
+        totals, first = forecast.spending_history(self.user, [], date(2024, 3, 5))
+        self.assertEqual(first, date(2024, 3, 1).toordinal())
+        self.assertEqual(totals.tolist(), [20.0, 5.0, 0.0, 0.0])
+
+
+class SnapshotForecastHistoryTests(SnapshotTestCase, ForecastHistoryTests):
+    """The same history read from the columnar snapshot."""
+
+    def test_merchantless_rows_match_description_streams_on_amount_alone(self):
+        # The rows have no merchant and no description; the stream is another description's
+        rent = RecurringStream(group_key='description:landlord', merchant_id=None, average_amount=Decimal('20.00'))
+        since, today = date(2024, 3, 1), date(2024, 3, 5)
+        _, ledger_amounts = forecast.database_spending(self.user, [rent], since, today)
+        _, snapshot_amounts = forecast.snapshot_spending(self.user, [rent], since, today)
+        self.assertEqual(ledger_amounts.tolist(), [20.0, 5.0])
+        self.assertEqual(snapshot_amounts.tolist(), [5.0])
+
+
+class GoalValidationTests(AppTestCase):
+    def test_goal_amounts_must_be_finite(self):
+        for value in ['NaN', 'sNaN', 'Infinity', '-inf', 'ten']:
+            with self.assertRaises(ValueError, msg=value):
+                forecast.validate_goal({'name': 'Trip', 'target_amount': value})
+        self.assertEqual(forecast.validate_goal({'target_amount': '12.346'})['target_amount'], Decimal('12.35'))
+
+    def test_goal_view_rejects_nan(self):
+        self.client.force_login(make_user())
+        response = self.client.post('/api/savings_goals/', {'name': 'Trip', 'target_amount': 'NaN'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class SnapshotRefreshTests(SnapshotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.sync(sync_page(added=[
+            plaid_transaction('txn-1', 12.5, date(2024, 3, 1)),
+            plaid_transaction('txn-2', 30.0, date(2024, 3, 2), category='TRANSPORTATION'),
+        ]))
+        self.snapshot = snapshot.refresh(self.user)
+
+    def sync(self, page):
+        db.apply_sync_page(self.user, 'access-1', page)
+        self.user.refresh_from_db()
+
+    def rows(self, ledger):
+        """The snapshot's rows with codes turned back into names, which may be numbered differently after a rebuild."""
+        return [
+            (int(pk), int(ts), int(day), int(cents), ledger.categories[category], ledger.channels[channel], int(merchant), int(account))
+            for pk, ts, day, cents, category, channel, merchant, account in zip(
+                ledger.id, ledger.ts, ledger.day, ledger.cents, ledger.category, ledger.channel, ledger.merchant, ledger.account,
+            )
+        ]
+
+    def assertMatchesRebuild(self, ledger):
+        self.assertEqual(self.rows(ledger), self.rows(snapshot.refresh(self.user, rebuild=True)))
+
+    def test_added_rows_are_appended(self):
+        self.sync(sync_page(added=[plaid_transaction('txn-3', 7.0, date(2024, 3, 3), category='TRAVEL')], next_cursor='cursor-2'))
+        ledger = snapshot.refresh(self.user)
+        self.assertEqual(len(ledger), 3)
+        self.assertIn('TRAVEL', ledger.categories)
+        self.assertMatchesRebuild(ledger)
+
+    def test_modified_rows_are_patched_in_place(self):
+        self.sync(sync_page(modified=[
+            plaid_transaction('txn-1', 99.0, date(2024, 3, 5), category='TRAVEL'),
+        ], next_cursor='cursor-2'))
+        ledger = snapshot.refresh(self.user, transaction_ids=['txn-1'])
+        self.assertEqual(sorted(ledger.cents.tolist()), [3000, 9900])
+        self.assertMatchesRebuild(ledger)
+
+    def test_removed_rows_are_dropped(self):
+        self.sync(sync_page(removed=[{'transaction_id': 'txn-2'}], next_cursor='cursor-2'))
+        ledger = snapshot.refresh(self.user)
+        self.assertEqual(ledger.cents.tolist(), [1250])
+        self.assertMatchesRebuild(ledger)
+
+    def test_load_refreshes_a_snapshot_behind_data_version(self):
+        self.sync(sync_page(added=[plaid_transaction('txn-3', 7.0, date(2024, 3, 3))], next_cursor='cursor-2'))
+        ledger = snapshot.load(self.user)
+        self.assertEqual(ledger.meta['data_version'], self.user.data_version)
+        self.assertEqual(len(ledger), 3)
+        self.assertMatchesRebuild(ledger)
+
+    def test_refresh_without_changes_keeps_the_generation(self):
+        ledger = snapshot.refresh(self.user)
+        self.assertEqual(ledger.meta['generation'], self.snapshot.meta['generation'])
+        self.assertEqual(snapshot.load(self.user).meta['generation'], self.snapshot.meta['generation'])
+
+    def test_snapshot_of_another_owner_is_rebuilt(self):
+        meta = dict(self.snapshot.meta, owner='someone-else')
+        snapshot.write_meta(self.user, meta)
+        ledger = snapshot.refresh(self.user)
+        self.assertNotEqual(ledger.meta['generation'], self.snapshot.meta['generation'])
+        self.assertEqual(ledger.meta['owner'], snapshot.owner(self.user))
+        self.assertMatchesRebuild(ledger)
+
+    def test_sync_failing_mid_way_refreshes_the_pages_it_committed(self):
+        page = sync_page(modified=[plaid_transaction('txn-1', 99.0, date(2024, 3, 1))], next_cursor='cursor-2', has_more=True)
+        with mock.patch('app.sync.fetch_sync_page', side_effect=[page, plaid_api_error('INTERNAL_SERVER_ERROR', 500)]):
+            with self.assertRaises(sync.SyncError):
+                sync.sync_item('access-1', self.user)
+        self.user.refresh_from_db()
+        ledger = snapshot.load(self.user)
+        self.assertEqual(sorted(ledger.cents.tolist()), [3000, 9900])
+        self.assertMatchesRebuild(ledger)
+
+    def test_failed_refresh_after_a_sync_rebuilds_on_load(self):
+        page = sync_page(modified=[plaid_transaction('txn-1', 99.0, date(2024, 3, 1))], next_cursor='cursor-2')
+        with mock.patch('app.sync.fetch_sync_page', side_effect=[page]), \
+                mock.patch('app.snapshot.refresh', side_effect=OSError('disk full')), \
+                self.assertLogs('app.sync', 'ERROR'):
+            sync.sync_item('access-1', self.user)
+        self.user.refresh_from_db()
+        ledger = snapshot.load(self.user)
+        self.assertNotEqual(ledger.meta['generation'], self.snapshot.meta['generation'])
+        self.assertNotIn('rebuild', ledger.meta)
+        self.assertEqual(sorted(ledger.cents.tolist()), [3000, 9900])
+
+
+@mock.patch('app.exports.ROWS_PER_WRITE', 2)
+class ExportTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        account = make_account(self.user)
+        for i in range(5):
+            make_transaction(account, f'txn-{i}', aware(2024, 3, 1 + i), amount=f'{i + 1}.00', description=f'Shop {i}')
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+
+    def test_wsgi_export_streams_in_chunks(self):
+        with warnings.catch_warnings():
+            # Django warns when it has to buffer an iterator of the wrong kind
+            warnings.simplefilter('error')
+            response = self.client.get('/api/export_transactions/csv/')
+            chunks = list(response.streaming_content)
+        self.assertTrue(response.streaming)
+        # The header, then two rows per chunk
+        self.assertEqual(len(chunks), 4)
+        lines = b''.join(chunks).decode().splitlines()
+        self.assertEqual(lines[0].split(','), exports.EXPORT_FIELDS)
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], [f'txn-{i}' for i in range(5)])
+
+    async def test_asgi_export_streams_in_chunks(self):
+        response = await self.async_client.get('/api/export_transactions/ndjson/')
+        self.assertTrue(response.streaming)
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(len(chunks), 3)
+        rows = [json.loads(line) for line in b''.join(chunks).decode().splitlines()]
+        self.assertEqual([row['amount'] for row in rows], ['1.00', '2.00', '3.00', '4.00', '5.00'])
+
+    def test_unknown_format_is_not_found(self):
+        self.assertEqual(self.client.get('/api/export_transactions/xlsx/').status_code, 404)
+
+
+class CompactPayloadTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        checking = make_account(self.user)
+        savings = make_account(self.user, account_id='acc-2', access_token='access-1', name='Savings')
+        make_transaction(checking, 'txn-1', aware(2024, 3, 1, 9, 30), amount='12.34', description='Corner Cafe', merchant_name='Corner Cafe')
+        make_transaction(savings, 'txn-2', aware(2024, 3, 2), amount='0.10', payment_channel=None)
+        make_transaction(checking, 'txn-3', aware(2024, 3, 3), amount='1999.99', transaction_type='TRAVEL', payment_channel='online')
+        self.client.force_login(self.user)
+
+    def get(self, **params):
+        return self.client.get('/api/get_transactions/', params)
+
+    def expand(self, compact):
+        """The compact layout turned back into the default one."""
+        rows = []
+        for values in compact['transactions']:
+            row = dict(zip(compact['fields'], values))
+            rows.append({
+                'transaction_id': row['transaction_id'],
+                'amount': row['amount_cents'] / 100,
+                'description': row['description'],
+                'merchant_name': row['merchant_name'],
+                'datetime': datetime.fromtimestamp(row['timestamp'], tz=dt_timezone.utc).isoformat(),
+                'transaction_type': row['transaction_type'],
+                'payment_channel': row['payment_channel'],
+                'account': compact['accounts'][row['account']],
+            })
+        return rows
+
+    def test_compact_layout_holds_the_same_transactions(self):
+        default = self.get().json()['transactions']
+        compact = self.get(format='compact').json()
+        self.assertEqual(compact['fields'], payloads.COMPACT_FIELDS)
+        self.assertEqual(len(compact['accounts']), 2)
+        self.assertEqual(self.expand(compact), default)
+
+    def test_amounts_are_exact_cents(self):
+        compact = self.get(format='compact').json()
+        cents = compact['fields'].index('amount_cents')
+        self.assertEqual([row[cents] for row in compact['transactions']], [1234, 10, 199999])
+
+    def test_large_bodies_are_compressed_when_accepted(self):
+        account = Account.objects.get(account_id='acc-1')
+        for i in range(50):
+            make_transaction(account, f'bulk-{i}', aware(2024, 4, 1, i % 24), description=f'Bulk purchase {i}')
+        plain = self.get(format='compact')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        compressed = self.client.get('/api/get_transactions/', {'format': 'compact'}, headers={'accept-encoding': 'gzip'})
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(compressed.content)), plain.json())
+        self.assertNotEqual(plain['ETag'], compressed['ETag'])
+        # Served again from the cache with its encoding
+        again = self.client.get('/api/get_transactions/', {'format': 'compact'}, headers={'accept-encoding': 'gzip'})
+        self.assertEqual((again['Content-Encoding'], again.content), ('gzip', compressed.content))
+
+    def test_small_bodies_are_not_compressed(self):
+        response = self.client.get('/api/get_transactions/', {'format': 'compact'}, headers={'accept-encoding': 'gzip'})
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_content_encoding_follows_the_accept_encoding_header(self):
+        request = mock.Mock(headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        self.assertIsNone(payloads.content_encoding(request))
+        request.headers = {'Accept-Encoding': '*'}
+        self.assertEqual(payloads.content_encoding(request), payloads.CONTENT_ENCODINGS[0])
+
+    @unittest.skipUnless(payloads.msgpack is not None, 'msgpack is not installed')
+    def test_msgpack_has_the_compact_layout(self):
+        response = self.get(format='msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(payloads.msgpack.unpackb(response.content), self.get(format='compact').json())
+
+
+def plaid_api_error(error_code, status=400):
+    error = plaid.ApiException(status=status, reason='Bad Request')
+    error.body = json.dumps({'error_code': error_code, 'error_message': error_code.lower()})
+    return error
+
+
+@mock.patch('app.sync.RESTART_DELAY_SECONDS', 0)
+class SyncItemTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.first = sync_page(added=[plaid_transaction('txn-1', 10.0, date(2024, 3, 1))], next_cursor='c1', has_more=True)
+        self.second = sync_page(added=[plaid_transaction('txn-2', 20.0, date(2024, 3, 2))], next_cursor='c2')
+
+    def test_mutation_during_pagination_restarts_from_committed_cursor(self):
+        responses = [self.first, plaid_api_error(sync.MUTATION_DURING_PAGINATION), self.second]
+        with mock.patch('app.sync.fetch_sync_page', side_effect=responses) as fetch:
+            summary = sync.sync_item('access-1', self.user)
+        self.assertEqual([c.args[1] for c in fetch.call_args_list], [None, 'c1', 'c1'])
+        self.assertEqual(summary['restarts'], 1)
+        self.assertEqual(summary['pages'], 2)
+        self.assertEqual(summary['added'], 2)
+        self.assertEqual(db.get_cursor('access-1'), 'c2')
+
+    def test_gives_up_after_max_restarts(self):
+        mutation = plaid_api_error(sync.MUTATION_DURING_PAGINATION)
+        with mock.patch('app.sync.fetch_sync_page', side_effect=[self.first, mutation, mutation]):
+            with self.assertRaises(sync.SyncError):
+                sync.sync_item('access-1', self.user, max_restarts=1)
+        # The page committed before the failure is kept
+        self.assertEqual(db.get_cursor('access-1'), 'c1')
+        self.assertEqual(list(Transaction.objects.values_list('transaction_id', flat=True)), ['txn-1'])
+
+    def test_other_errors_are_not_retried(self):
+        with mock.patch('app.sync.fetch_sync_page', side_effect=[plaid_api_error('ITEM_LOGIN_REQUIRED')]) as fetch:
+            with self.assertRaises(sync.SyncError) as raised:
+                sync.sync_item('access-1', self.user)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(raised.exception.error['error_code'], 'ITEM_LOGIN_REQUIRED')
+
+    def test_error_without_a_body_raises_sync_error(self):
+        error = plaid.ApiException(status=0, reason='Read timed out')
+        with mock.patch('app.sync.fetch_sync_page', side_effect=[self.first, error]):
+            with self.assertRaises(sync.SyncError) as raised:
+                sync.sync_item('access-1', self.user)
+        self.assertIn('Read timed out', str(raised.exception))
+        self.assertEqual(db.get_cursor('access-1'), 'c1')
+
+
+def sync_summary(pages=1, added=0):
+    return {'pages': pages, 'added': added, 'updated': 0, 'removed': 0, 'restarts': 0}
+
+
+class RefreshTransactionsCommandTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user(), make_user('bob')
+        make_account(self.alice, 'acc-1', 'access-1')
+        make_account(self.alice, 'acc-2', 'access-1', name='Savings')
+        make_account(self.bob, 'acc-3', 'access-2')
+        make_account(self.bob, 'acc-4', 'access-3')
+
+    def refresh(self, responses, **options):
+        def sync_item(access_token, user, timeout=None):
+            response = responses[access_token]
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        out = io.StringIO()
+        with mock.patch('app.sync.sync_item', side_effect=sync_item) as synced:
+            call_command('refresh_transactions', workers=3, stdout=out, **options)
+        return {(c.args[0], c.args[1].username) for c in synced.call_args_list}, out.getvalue()
+
+    def test_failing_item_does_not_stop_the_others(self):
+        synced, out = self.refresh({
+            'access-1': sync_summary(pages=2, added=5),
+            'access-2': sync.SyncError({'error_code': 'ITEM_LOGIN_REQUIRED'}),
+            'access-3': sync_summary(added=1),
+        })
+        # Once per item, however many accounts it has
+        self.assertEqual(synced, {('access-1', 'alice'), ('access-2', 'bob'), ('access-3', 'bob')})
+        self.assertIn('Items: 3 (2 succeeded, 1 failed)', out)
+        self.assertIn('Rows: 6 added', out)
+        self.assertIn('SyncError: 1 items', out)
+        self.assertIn('Successfully refreshed transactions for 2/3 items', out)
+
+    def test_stale_hours_skips_recently_synced_items(self):
+        Cursor.objects.create(user=self.alice, access_token='access-1', cursor='c1', synced_at=timezone.now() - timedelta(hours=1))
+        Cursor.objects.create(user=self.bob, access_token='access-2', cursor='c1', synced_at=timezone.now() - timedelta(hours=30))
+        responses = {token: sync_summary() for token in ('access-1', 'access-2', 'access-3')}
+        synced, out = self.refresh(responses, stale_hours=6)
+        # Items never synced have no cursor and count as stale
+        self.assertEqual(synced, {('access-2', 'bob'), ('access-3', 'bob')})
+        self.assertIn('Items: 2 (2 succeeded, 0 failed)', out)
+
+    def test_user_option_limits_the_items(self):
+        synced, _ = self.refresh({'access-1': sync_summary()}, user='alice')
+        self.assertEqual(synced, {('access-1', 'alice')})
+
+
+class JobQueueTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.handler = mock.Mock(return_value={'ok': True})
+        patcher = mock.patch.dict(jobs.HANDLERS, {'test': lambda job: self.handler(job)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def claim_and_run(self):
+        job = jobs.claim_next_job('worker-1')
+        return job if job is None else jobs.run_job(job)
+
+    def test_claim_takes_due_jobs_in_order_once(self):
+        later = jobs.enqueue('test', user=self.user, delay=60)
+        first = jobs.enqueue('test', user=self.user)
+        second = jobs.enqueue('test', user=self.user)
+        self.assertEqual(jobs.claim_next_job('worker-1').pk, first.pk)
+        claimed = jobs.claim_next_job('worker-2')
+        self.assertEqual(claimed.pk, second.pk)
+        self.assertEqual((claimed.status, claimed.locked_by, claimed.attempts), (Job.STATUS_RUNNING, 'worker-2', 1))
+        # The delayed job is not due yet
+        self.assertIsNone(jobs.claim_next_job('worker-1'))
+        self.assertEqual(Job.objects.get(pk=later.pk).status, Job.STATUS_QUEUED)
+
+    def test_successful_job_records_its_result(self):
+        job = jobs.enqueue('test', user=self.user)
+        job = self.claim_and_run()
+        self.assertEqual((job.status, job.result, job.attempts, job.locked_by), (Job.STATUS_SUCCEEDED, {'ok': True}, 1, ''))
+
+    def test_failed_job_is_retried_with_backoff_then_fails(self):
+        self.handler.side_effect = RuntimeError('plaid is down')
+        job = jobs.enqueue('test', user=self.user, max_attempts=2)
+        with self.assertLogs('app.jobs', 'ERROR') as logs:
+            job = self.claim_and_run()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_QUEUED, 1))
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=jobs.RETRY_BASE_DELAY - 5))
+        self.assertIn('Traceback', logs.output[0])
+
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        with self.assertLogs('app.jobs', 'ERROR'):
+            job = self.claim_and_run()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_FAILED, 2))
+        self.assertIsNone(self.claim_and_run())
+
+    def test_error_keeps_only_the_exception_class_and_message(self):
+        self.handler.side_effect = ValueError('bad token')
+        job = jobs.enqueue('test', user=self.user, max_attempts=1)
+        with self.assertLogs('app.jobs', 'ERROR'):
+            job = self.claim_and_run()
+        self.assertEqual(job.error, 'ValueError: bad token')
+        self.assertEqual(job.to_dict()['error'], 'ValueError: bad token')
+
+    def test_stale_job_counts_the_lost_attempt(self):
+        job = jobs.enqueue('test', user=self.user, max_attempts=2)
+        stale = timezone.now() - timedelta(seconds=jobs.lock_timeout() + 1)
+
+        jobs.claim_next_job('worker-1')
+        Job.objects.filter(pk=job.pk).update(locked_at=stale)
+        self.assertEqual(jobs.requeue_stale_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.locked_by), (Job.STATUS_QUEUED, 1, ''))
+
+        # A job that keeps killing its worker fails once its attempts are used up
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        jobs.claim_next_job('worker-1')
+        Job.objects.filter(pk=job.pk).update(locked_at=stale)
+        with self.assertLogs('app.jobs', 'ERROR'):
+            self.assertEqual(jobs.requeue_stale_jobs(), 0)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_FAILED, 2))
+
+    def test_running_job_with_a_fresh_lock_is_left_alone(self):
+        job = jobs.enqueue('test', user=self.user)
+        jobs.claim_next_job('worker-1')
+        self.assertEqual(jobs.requeue_stale_jobs(), 0)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.STATUS_RUNNING)
+
+    @override_settings(JOB_BACKEND='app.jobs.ImmediateBackend')
+    def test_immediate_backend_runs_inline(self):
+        job = jobs.enqueue('test', user=self.user)
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_SUCCEEDED, 1))
+
+    def test_only_one_job_per_dedupe_key_is_queued(self):
+        first = jobs.enqueue('test', user=self.user, dedupe_key='key-1')
+        self.assertEqual(jobs.enqueue('test', user=self.user, dedupe_key='key-1').pk, first.pk)
+        # Another enqueue inserts its job between this one's check and insert
+        with mock.patch('django.db.models.query.QuerySet.first', side_effect=[None, first]):
+            self.assertEqual(jobs.enqueue('test', user=self.user, dedupe_key='key-1').pk, first.pk)
+        self.assertEqual(Job.objects.filter(dedupe_key='key-1').count(), 1)
+        # Once the job runs, the key can be queued again
+        jobs.claim_next_job('worker-1')
+        self.assertNotEqual(jobs.enqueue('test', user=self.user, dedupe_key='key-1').pk, first.pk)
+
+    def test_retry_gives_way_to_a_job_queued_while_it_ran(self):
+        def enqueue_again_and_fail(job):
+            jobs.enqueue('test', user=self.user, dedupe_key='key-1')
+            raise RuntimeError('plaid is down')
+
+        self.handler.side_effect = enqueue_again_and_fail
+        jobs.enqueue('test', user=self.user, dedupe_key='key-1')
+        with self.assertLogs('app.jobs', 'ERROR'):
+            job = self.claim_and_run()
+        queued = Job.objects.get(dedupe_key='key-1', status=Job.STATUS_QUEUED)
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertEqual(job.error, f'RuntimeError: plaid is down; job {queued.pk} is queued to run it again')
+
+    @mock.patch('app.tasks.client')
+    def test_exchange_drops_the_public_token(self, client):
+        client.item_public_token_exchange.return_value.to_dict.return_value = {'access_token': 'access-1', 'item_id': 'item-1'}
+        job = jobs.enqueue('exchange_public_token', user=self.user, public_token='public-sandbox-1')
+        result = jobs.run_job(jobs.claim_next_job('worker-1'))
+        self.assertEqual(result.status, Job.STATUS_SUCCEEDED)
+        self.assertEqual(Job.objects.get(pk=job.pk).payload, {})
+        self.assertEqual(Cursor.objects.get(access_token='access-1').item_id, 'item-1')
+
+
+@override_settings(SNAPSHOT_DIR='')
+class JobHeartbeatTests(TransactionTestCase):
+    """Commits for real, so the heartbeat thread's connection sees the claimed job."""
+
+    def test_heartbeat_refreshes_the_lock(self):
+        Job.objects.create(kind='test', user=make_user(), run_at=timezone.now())
+        job = jobs.claim_next_job('worker-1')
+        stale = timezone.now() - timedelta(hours=1)
+        Job.objects.filter(pk=job.pk).update(locked_at=stale)
+        with jobs.heartbeat(job, interval=0.01):
+            deadline = time.monotonic() + 5
+            while Job.objects.get(pk=job.pk).locked_at == stale and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertGreater(Job.objects.get(pk=job.pk).locked_at, stale)
+
+
+class RateLimitedPlaidClientTests(TestCase):
+    def setUp(self):
+        self.api = mock.Mock()
+        self.client = RateLimitedPlaidClient(self.api, base_delay=0, max_retries=3)
+
+    def test_server_errors_are_retried(self):
+        self.api.transactions_sync.side_effect = [plaid_api_error('INTERNAL_SERVER_ERROR', status=500), {'ok': True}]
+        self.assertEqual(self.client.transactions_sync(mock.Mock(access_token='access-1')), {'ok': True})
+        self.assertEqual(self.api.transactions_sync.call_count, 2)
+
+    def test_non_idempotent_calls_are_not_retried_on_server_errors(self):
+        self.api.item_public_token_exchange.side_effect = [plaid_api_error('INTERNAL_SERVER_ERROR', status=500), {'ok': True}]
+        with self.assertRaises(plaid.ApiException):
+            self.client.item_public_token_exchange(mock.Mock(public_token='public-1'))
+        self.assertEqual(self.api.item_public_token_exchange.call_count, 1)
+
+    def test_non_idempotent_calls_are_retried_when_rate_limited(self):
+        self.api.item_public_token_exchange.side_effect = [plaid_api_error('RATE_LIMIT_EXCEEDED', status=429), {'ok': True}]
+        self.assertEqual(self.client.item_public_token_exchange(mock.Mock(public_token='public-1')), {'ok': True})
+        self.assertEqual(self.api.item_public_token_exchange.call_count, 2)
+
+
+def webhook_body(item_id='item-1', webhook_code='SYNC_UPDATES_AVAILABLE', **fields):
+    return json.dumps({'webhook_type': 'TRANSACTIONS', 'webhook_code': webhook_code, 'item_id': item_id, **fields}).encode()
+
+
+@mock.patch('app.webhooks.PLAID_WEBHOOK_VERIFY', True)
+@mock.patch('app.webhooks.verify')
+class WebhookTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        db.record_item(self.user, 'access-1', 'item-1')
+
+    def test_retry_with_a_fresh_token_is_dropped(self, verify):
+        event = webhooks.receive(webhook_body(), 'jwt-1')
+        self.assertEqual(event.status, WebhookEvent.STATUS_QUEUED)
+        self.assertIsNone(webhooks.receive(webhook_body(), 'jwt-2'))
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.assertEqual([c.args for c in verify.call_args_list], [(webhook_body(), 'jwt-1'), (webhook_body(), 'jwt-2')])
+
+    def test_different_deliveries_are_kept(self, verify):
+        for body in [webhook_body(), webhook_body(item_id='item-2'), webhook_body(webhook_code='DEFAULT_UPDATE'),
+                     webhook_body(new_transactions=3)]:
+            self.assertIsNotNone(webhooks.receive(body, 'jwt'))
+        self.assertEqual(WebhookEvent.objects.count(), 4)
+
+    def test_repeat_after_the_dedupe_window_is_accepted(self, verify):
+        first = webhooks.receive(webhook_body(), 'jwt-1')
+        Job.objects.update(status=Job.STATUS_SUCCEEDED)
+        WebhookEvent.objects.update(received_at=timezone.now() - timedelta(seconds=webhooks.DEDUPE_SECONDS + 1))
+        event = webhooks.receive(webhook_body(), 'jwt-2')
+        self.assertEqual(event.status, WebhookEvent.STATUS_QUEUED)
+        self.assertNotEqual(event.job_id, first.job_id)
+        # The delivery takes over the earlier one's row, and starts a new window
+        self.assertEqual(WebhookEvent.objects.get().job_id, event.job_id)
+        self.assertIsNone(webhooks.receive(webhook_body(), 'jwt-3'))
+
+    def test_concurrent_retry_is_dropped_by_the_constraint(self, verify):
+        webhooks.receive(webhook_body(), 'jwt-1')
+        # Both deliveries passed any check before either was stored; the insert decides
+        self.assertIsNone(webhooks.receive(webhook_body(), 'jwt-2'))
+        with self.assertRaises(IntegrityError), db_transaction.atomic():
+            WebhookEvent.objects.create(fingerprint=WebhookEvent.objects.get().fingerprint, webhook_type='TRANSACTIONS')
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_sync_webhooks_share_one_queued_sync(self, verify):
+        first = webhooks.receive(webhook_body(), 'jwt-1')
+        second = webhooks.receive(webhook_body(webhook_code='DEFAULT_UPDATE'), 'jwt-2')
+        self.assertEqual(first.job_id, second.job_id)
+        self.assertEqual(Job.objects.get(pk=first.job_id).payload['access_token'], 'access-1')
+
+    def test_unknown_items_and_other_webhooks_are_recorded_only(self, verify):
+        self.assertEqual(webhooks.receive(webhook_body(item_id='item-9'), 'jwt').status, WebhookEvent.STATUS_UNKNOWN_ITEM)
+        event = webhooks.receive(webhook_body(webhook_code='RECURRING_TRANSACTIONS_UPDATE'), 'jwt')
+        self.assertEqual(event.status, WebhookEvent.STATUS_IGNORED)
+        self.assertFalse(Job.objects.exists())
+
+    def test_body_must_be_a_webhook(self, verify):
+        for body in [b'[]', b'{"item_id": "item-1"}', b'not json']:
+            with self.assertRaises(ValueError):
+                webhooks.receive(body, 'jwt')
+
+    def test_view_rejects_unverified_deliveries(self, verify):
+        verify.side_effect = webhooks.WebhookVerificationError('Missing Plaid-Verification header')
+        response = self.client.post('/api/plaid_webhook/', webhook_body(), content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec('jwt') and importlib.util.find_spec('cryptography'), 'PyJWT and cryptography are needed to sign tokens'
+)
+class WebhookVerificationTests(TestCase):
+    def setUp(self):
+        import jwt
+        from cryptography.hazmat.primitives.asymmetric import ec
+
+        self.jwt = jwt
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(self.private_key.public_key()))
+        patcher = mock.patch.dict(webhooks.verification_keys, {'key-1': {**jwk, 'expired_at': None}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def token(self, body, issued_at=None, kid='key-1'):
+        claims = {'iat': int(issued_at or time.time()), 'request_body_sha256': hashlib.sha256(body).hexdigest()}
+        return self.jwt.encode(claims, self.private_key, algorithm='ES256', headers={'kid': kid})
+
+    def test_valid_token_passes(self):
+        webhooks.verify(webhook_body(), self.token(webhook_body()))
+
+    def test_bad_tokens_are_rejected(self):
+        body = webhook_body()
+        for token in [None, 'garbage', self.token(webhook_body(item_id='item-2')), self.token(body, issued_at=time.time() - 600)]:
+            with self.assertRaises(webhooks.WebhookVerificationError):
+                webhooks.verify(body, token)
+
+    def test_other_algorithms_are_rejected(self):
+        token = self.jwt.encode({'iat': int(time.time())}, 'secret', algorithm='HS256', headers={'kid': 'key-1'})
+        with self.assertRaises(webhooks.WebhookVerificationError):
+            webhooks.verify(webhook_body(), token)
+
+
+class FieldTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.account = make_account(make_user())
+
+    def stored(self, transaction, column):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {column} FROM app_transaction WHERE id = %s', [transaction.pk])
+            return cursor.fetchone()[0]
+
+    def test_cents_round_trip(self):
+        for value, expected in [(Decimal('12.34'), Decimal('12.34')), (12.3, Decimal('12.30')), (5, Decimal('5.00')),
+                                ('-0.10', Decimal('-0.10')), (Decimal('0.005'), Decimal('0.00'))]:
+            t = make_transaction(self.account, f'txn-{value}', aware(2024, 3, 1), amount=value)
+            t.refresh_from_db()
+            self.assertEqual(t.amount, expected)
+            self.assertEqual(t.amount.as_tuple().exponent, -2)
+            self.assertEqual(self.stored(t, 'amount'), int(expected * 100))
+
+    def test_cents_filter_and_sum_as_decimals(self):
+        make_transaction(self.account, 'txn-1', aware(2024, 3, 1), amount='0.10')
+        make_transaction(self.account, 'txn-2', aware(2024, 3, 2), amount='0.20')
+        total = Transaction.objects.aggregate(total=Sum('amount'))['total']
+        self.assertEqual(total, Decimal('0.30'))
+        self.assertEqual(Transaction.objects.filter(amount__gt=Decimal('0.15')).get().transaction_id, 'txn-2')
+
+    def test_lookup_round_trip(self):
+        t = make_transaction(self.account, 'txn-1', aware(2024, 3, 1), transaction_type='TRAVEL', payment_channel='online')
+        t.refresh_from_db()
+        self.assertEqual((t.transaction_type, t.payment_channel), ('TRAVEL', 'online'))
+        self.assertEqual(self.stored(t, 'transaction_type'), Category.objects.get(name='TRAVEL').pk)
+        self.assertEqual(list(Transaction.objects.values_list('transaction_type', flat=True)), ['TRAVEL'])
+        # Both category columns share the Category table
+        make_transaction(self.account, 'txn-2', aware(2024, 3, 2), transaction_type='FOOD_AND_DRINK', plaid_category='TRAVEL')
+        self.assertEqual(Category.objects.filter(name='TRAVEL').count(), 1)
+
+    def test_unknown_names_match_no_rows(self):
+        make_transaction(self.account, 'txn-1', aware(2024, 3, 1), payment_channel=None)
+        make_transaction(self.account, 'txn-2', aware(2024, 3, 2), payment_channel='online')
+        self.assertEqual(Transaction._meta.get_field('payment_channel').get_prep_value('teleport'), UNKNOWN_CODE)
+        self.assertFalse(Transaction.objects.filter(payment_channel='teleport').exists())
+        self.assertFalse(Transaction.objects.filter(payment_channel__in=['teleport', 'warp']).exists())
+        self.assertEqual(Transaction.objects.exclude(payment_channel='teleport').count(), 2)
+        self.assertEqual(Transaction.objects.get(payment_channel__isnull=True).transaction_id, 'txn-1')
+        # Filtering does not add the name
+        self.assertFalse(Category.objects.filter(name='teleport').exists())
+
+    def test_name_added_in_a_rolled_back_transaction_is_forgotten(self):
+        field = Transaction._meta.get_field('transaction_type')
+        with self.assertRaises(RuntimeError):
+            with db_transaction.atomic():
+                make_transaction(self.account, 'txn-1', aware(2024, 3, 1), transaction_type='ROLLED_BACK')
+                raise RuntimeError
+        self.assertIsNone(field.lookup.code('ROLLED_BACK'))
+        t = make_transaction(self.account, 'txn-2', aware(2024, 3, 1), transaction_type='ROLLED_BACK')
+        t.refresh_from_db()
+        self.assertEqual(t.transaction_type, 'ROLLED_BACK')
+
+    def test_name_added_in_a_transaction_is_cached_when_it_commits(self):
+        lookup = Transaction._meta.get_field('transaction_type').lookup
+        # The test's rollback removes the row, so its code must not outlive the test
+        self.addCleanup(lookup.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            t = make_transaction(self.account, 'txn-1', aware(2024, 3, 1), transaction_type='COMMITTED')
+            self.assertNotIn('COMMITTED', lookup.codes)
+            self.assertEqual(lookup.code('COMMITTED'), self.stored(t, 'transaction_type'))
+        self.assertEqual(lookup.codes['COMMITTED'], self.stored(t, 'transaction_type'))
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Migrates the test database to `before`, and back to the latest schema afterwards."""
+    before = None
+    after = None
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        # Leave the schema the other tests expect
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+        super().tearDown()
+
+
+class TransactionConstraintsMigrationTests(MigrationTestCase):
+    before = [('app', '0001_initial')]
+    after = [('app', '0002_transaction_indexes')]
+
+    def test_duplicates_removed_before_constraints(self):
+        apps = self.migrate(self.before)
+        user = apps.get_model('app', 'User').objects.create(username='alice')
+        Account_ = apps.get_model('app', 'Account')
+        checking = Account_.objects.create(user=user, account_id='acc-1', access_token='access-1', name='Checking', account_type='bank')
+        savings = Account_.objects.create(user=user, account_id='acc-2', access_token='access-1', name='Savings', account_type='bank')
+        Transaction_ = apps.get_model('app', 'Transaction')
+        Cursor_ = apps.get_model('app', 'Cursor')
+
+        def add(account, transaction_id, amount):
+            return Transaction_.objects.create(account=account, transaction_id=transaction_id, datetime=aware(2024, 3, 1),
+                                               amount=Decimal(amount), transaction_type='FOOD').pk
+
+        oldest = add(checking, 'txn-1', '10.00')
+        add(checking, 'txn-1', '10.00')
+        add(checking, 'txn-1', '11.00')
+        # The same id under another account is not a duplicate
+        other_account = add(savings, 'txn-1', '10.00')
+        single = add(checking, 'txn-2', '5.00')
+        Cursor_.objects.create(user=user, access_token='access-1', cursor='cursor-1')
+        newest = Cursor_.objects.create(user=user, access_token='access-1', cursor='cursor-2').pk
+        other_token = Cursor_.objects.create(user=user, access_token='access-2', cursor='cursor-1').pk
+
+        apps = self.migrate(self.after)
+        Transaction_ = apps.get_model('app', 'Transaction')
+        Cursor_ = apps.get_model('app', 'Cursor')
+        self.assertEqual(set(Transaction_.objects.values_list('pk', flat=True)), {oldest, other_account, single})
+        self.assertEqual(set(Cursor_.objects.values_list('pk', flat=True)), {newest, other_token})
+        self.assertEqual(Cursor_.objects.get(access_token='access-1').cursor, 'cursor-2')
+
+        with self.assertRaises(IntegrityError), db_transaction.atomic():
+            Transaction_.objects.create(account_id=checking.pk, transaction_id='txn-2', datetime=aware(2024, 3, 2),
+                                        amount=Decimal('1.00'), transaction_type='FOOD')
+        with self.assertRaises(IntegrityError), db_transaction.atomic():
+            Cursor_.objects.create(user_id=user.pk, access_token='access-2', cursor='cursor-3')
+
+
+class CentsAndLookupCodesMigrationTests(MigrationTestCase):
+    before = [('app', '0009_webhooks')]
+    after = [('app', '0010_cents_and_lookup_codes')]
+
+    def test_forward_and_backward(self):
+        apps = self.migrate(self.before)
+        User_ = apps.get_model('app', 'User')
+        Account_ = apps.get_model('app', 'Account')
+        Transaction_ = apps.get_model('app', 'Transaction')
+        user = User_.objects.create(username='alice')
+        account = Account_.objects.create(user=user, account_id='acc-1', access_token='access-1', name='Checking',
+                                          account_type='bank', balance=Decimal('1234.56'))
+        rows = [('txn-1', Decimal('12.34'), 'FOOD_AND_DRINK', 'FOOD_AND_DRINK', 'in store'),
+                ('txn-2', Decimal('0.10'), 'TRAVEL', '', None),
+                ('txn-3', Decimal('999.99'), 'FOOD_AND_DRINK', 'TRAVEL', 'online')]
+        for transaction_id, amount, transaction_type, plaid_category, payment_channel in rows:
+            Transaction_.objects.create(account=account, transaction_id=transaction_id, datetime=aware(2024, 3, 1), amount=amount,
+                                        transaction_type=transaction_type, plaid_category=plaid_category, payment_channel=payment_channel)
+
+        apps = self.migrate(self.after)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT transaction_id, amount, transaction_type, payment_channel FROM app_transaction ORDER BY transaction_id')
+            stored = cursor.fetchall()
+            cursor.execute('SELECT balance FROM app_account')
+            self.assertEqual(cursor.fetchone()[0], 123456)
+        categories = dict(apps.get_model('app', 'Category').objects.values_list('name', 'id'))
+        channels = dict(apps.get_model('app', 'PaymentChannel').objects.values_list('name', 'id'))
+        self.assertEqual(stored, [
+            ('txn-1', 1234, categories['FOOD_AND_DRINK'], channels['in store']),
+            ('txn-2', 10, categories['TRAVEL'], None),
+            ('txn-3', 99999, categories['FOOD_AND_DRINK'], channels['online']),
+        ])
+        self.assertEqual(set(categories), {'FOOD_AND_DRINK', 'TRAVEL', ''})
+
+        apps = self.migrate(self.before)
+        Transaction_ = apps.get_model('app', 'Transaction')
+        restored = list(Transaction_.objects.order_by('transaction_id').values_list(
+            'transaction_id', 'amount', 'transaction_type', 'plaid_category', 'payment_channel'
+        ))
+        self.assertEqual(restored, rows)
+        self.assertEqual(apps.get_model('app', 'Account').objects.get().balance, Decimal('1234.56'))
+
+
+class DatabaseSettingsTests(TestCase):
+    SETTINGS_FILE = os.path.join(settings.BASE_DIR, 'server', 'settings.py')
+
+    def settings_from(self, **env):
+        with mock.patch.dict(os.environ, env):
+            return runpy.run_path(self.SETTINGS_FILE)['DATABASES']['default']
+
+    def test_sqlite_connections_use_wal(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        # The test database is in memory, which has no WAL; open a file with the same settings
+        settings_dict = dict(connection.settings_dict, NAME=os.path.join(directory, 'wal.sqlite3'))
+        wrapper = load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, alias='wal')
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            pragmas = {}
+            for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'temp_store'):
+                cursor.execute(f'PRAGMA {pragma}')
+                pragmas[pragma] = cursor.fetchone()[0]
+        # synchronous 1 is NORMAL, temp_store 2 is MEMORY
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 20000, 'temp_store': 2})
+
+    def test_postgresql_from_environment(self):
+        database = self.settings_from(
+            DB_ENGINE='postgresql', DB_NAME='ledger', DB_USER='app', DB_PASSWORD='secret', DB_HOST='db', DB_PORT='6432',
+            DB_POOL_MAX_SIZE='20',
+        )
+        self.assertEqual(
+            {key: database[key] for key in ('ENGINE', 'NAME', 'USER', 'PASSWORD', 'HOST', 'PORT', 'CONN_MAX_AGE')},
+            {'ENGINE': 'django.db.backends.postgresql', 'NAME': 'ledger', 'USER': 'app', 'PASSWORD': 'secret',
+             'HOST': 'db', 'PORT': '6432', 'CONN_MAX_AGE': 0},
+        )
+        self.assertEqual(database['OPTIONS']['pool'], {'min_size': 2, 'max_size': 20, 'timeout': 10})
+
+    def test_postgresql_without_pool_keeps_connections(self):
+        database = self.settings_from(DB_ENGINE='postgresql', DB_POOL='0', DB_CONN_MAX_AGE='120')
+        self.assertEqual((database['CONN_MAX_AGE'], database['OPTIONS']), (120, {}))
+
+    def test_untuned_sqlite_and_unknown_engines(self):
+        self.assertEqual(self.settings_from(DB_ENGINE='sqlite3', SQLITE_TUNED='0')['OPTIONS'], {})
+        with self.assertRaisesMessage(ValueError, 'Unsupported DB_ENGINE: oracle'):
+            self.settings_from(DB_ENGINE='oracle')
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        override = override_settings(PROFILE_REQUESTS=True, PROFILE_DIR=directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.request = RequestFactory().get('/api/analytics/?profile=1')
+
+    def test_profiled_request_saves_a_profile(self):
+        middleware = instrumentation.InstrumentationMiddleware(lambda request: HttpResponse('ok'))
+        response = middleware(self.request)
+        self.assertTrue(os.path.exists(response['X-Profile-File']))
+        self.assertFalse(instrumentation.profile_lock.locked())
+
+    def test_failing_request_releases_the_profiler(self):
+        def fail(request):
+            raise RuntimeError('view crashed')
+
+        with self.assertRaises(RuntimeError):
+            instrumentation.InstrumentationMiddleware(fail)(self.request)
+        self.assertFalse(instrumentation.profile_lock.locked())
+        # The next request can still be profiled
+        response = instrumentation.InstrumentationMiddleware(lambda request: HttpResponse('ok'))(self.request)
+        self.assertIn('X-Profile-File', response)
@@ -15,10 +15,28 @@ urlpatterns = [
     path('check_has_accounts/', views.has_accounts, name='check_has_accounts'),
     path('create_link_token/', views.create_link_token, name='create_link_token'),
     path('exchange_public_token/', views.exchange_public_token, name='exchange_public_token'),
+    path('plaid_webhook/', views.plaid_webhook, name='plaid_webhook'),
     path('get_item/', views.get_item, name='get_item'),
     path('get_transactions/', views.get_transactions, name='get_transactions'),
+    path('get_transaction_feed/', views.get_transaction_feed, name='get_transaction_feed'),
+    path('monthly_spending/', views.get_monthly_spending, name='monthly_spending'),
+    path('analytics/<str:dimension>/', views.get_analytics, name='analytics'),
+    path('recurring/', views.get_recurring, name='recurring'),
+    path('upcoming_bills/', views.get_upcoming_bills, name='upcoming_bills'),
+    path('forecast/', views.get_forecast, name='forecast'),
+    path('savings_goals/', views.savings_goals, name='savings_goals'),
+    path('savings_goals/<int:goal_id>/', views.savings_goal, name='savings_goal'),
+    path('paychecks/', views.paychecks, name='paychecks'),
+    path('paychecks/<int:paycheck_id>/', views.paycheck, name='paycheck'),
+    path('export_transactions/<str:export_format>/', views.export_transactions, name='export_transactions'),
+    path('import_statement/', views.import_statement, name='import_statement'),
+    path('category_rules/', views.category_rules, name='category_rules'),
+    path('category_rules/<int:rule_id>/', views.category_rule, name='category_rule'),
     path('get_liabilities/', views.get_liabilities, name='get_liabilities'),
     path('create_user/', views.create_user, name='create_user'),
     path('get_accounts/', views.get_accounts, name='get_accounts'),
     path('force_transaction_sync/', views.force_transaction_sync, name='force_transaction_sync'),
+    path('jobs/<int:job_id>/', views.get_job, name='get_job'),
+    path('plaid_metrics/', views.get_plaid_metrics, name='plaid_metrics'),
+    path('cache_stats/', views.get_cache_stats, name='cache_stats'),
 ]
\ No newline at end of file
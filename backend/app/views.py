@@ -1,4 +1,7 @@
 import base64
+import io
+import hmac
+import logging
 import os
 import datetime as dt
 import json
@@ -7,19 +10,22 @@ from datetime import date, timedelta, datetime
 import uuid
 import traceback
 
-from app.models import User, Account, Transaction, SavingsGoal, Paycheck, MonthlySpending
+from app.models import User, Account, Transaction, SavingsGoal, Paycheck, MonthlySpending, Job, CategoryRule, RecurringStream
 
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.db.models import Q
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from django.contrib.auth import authenticate, login, logout
 from django.middleware.csrf import get_token
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from rest_framework import status
 
-from dotenv import load_dotenv
 import plaid
 from plaid.model.payment_amount import PaymentAmount
 from plaid.model.payment_amount_currency import PaymentAmountCurrency
@@ -42,50 +48,16 @@ from plaid.model.liabilities_get_request import LiabilitiesGetRequest
 
 from plaid.api import plaid_api
 
-import app.db_methods as db
-
-load_dotenv()
-
-PLAID_CLIENT_ID = os.getenv('PLAID_CLIENT_ID')
-PLAID_ENV = os.getenv('PLAID_ENV', 'sandbox')
-PLAID_PRODUCTS = os.getenv('PLAID_PRODUCTS', 'transactions').split(',')
-PLAID_COUNTRY_CODES = os.getenv('PLAID_COUNTRY_CODES', 'US').split(',')
-PLAID_SECRET = os.getenv('PLAID_SECRET_SANDBOX') if os.getenv('PLAID_ENV') == 'sandbox' else os.getenv('PLAID_SECRET_PRODUCTION')
-
-
-def empty_to_none(field):
-    value = os.getenv(field)
-    if value is None or len(value) == 0:
-        return None
-    return value
-
-host = plaid.Environment.Sandbox
-
-if PLAID_ENV == 'sandbox':
-    host = plaid.Environment.Sandbox
+from asgiref.sync import async_to_sync, sync_to_async
 
-if PLAID_ENV == 'production':
-    host = plaid.Environment.Production
-
-PLAID_REDIRECT_URI = empty_to_none('PLAID_REDIRECT_URI')
-
-configuration = plaid.Configuration(
-    host=host,
-    api_key={
-        'clientId': PLAID_CLIENT_ID,
-        'secret': PLAID_SECRET,
-        'plaidVersion': '2020-09-14'
-    }
-)
-
-api_client = plaid.ApiClient(configuration)
-client = plaid_api.PlaidApi(api_client)
-
-products = []
-for product in PLAID_PRODUCTS:
-    products.append(Products(product))
+import app.db_methods as db
+from app import aio, analytics, categorize, exports, forecast, instrumentation, jobs, merchants, payloads, recurring, rollups, statements, sync, tasks, webhooks
+from app import cache as response_cache
+from app.cache import cached_response
+from app.aio import async_api_view
+from app.plaid_client import client, products, country_codes, plaid_error, PLAID_WEBHOOK_URL
 
-country_codes = list(map(lambda x: CountryCode(x), PLAID_COUNTRY_CODES))
+logger = logging.getLogger(__name__)
 
 
 # We store the access_token in memory - in production, store it in a secure
@@ -115,9 +87,9 @@ def check_user_exists(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@cached_response('has_accounts')
 def has_accounts(request):
-    accounts = Account.objects.filter(user=request.user)
-    has_accounts = len(accounts) > 0
+    has_accounts = Account.objects.filter(user=request.user).exists()
     return JsonResponse({
         'hasAccounts': has_accounts,
     })
@@ -151,18 +123,17 @@ def create_or_get_user(): # for testing purposes
                 password_hash='password'
             )
             user.save()
-        print('user created or found:', user)
+        logger.info('User created or found', extra={'user_id': user.pk})
         return user
     except Exception as e:
-        print('Error in create_or_get_user:', e)
+        logger.exception('Error in create_or_get_user')
         raise
 
 
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def create_link_token(request):
+@async_api_view(['GET'])
+async def create_link_token(request):
     try:
-        request = LinkTokenCreateRequest(
+        link_request = LinkTokenCreateRequest(
             user = LinkTokenCreateRequestUser(
                 client_user_id = str(request.user.id),
             ),
@@ -173,176 +144,552 @@ def create_link_token(request):
             client_name='Finance App',
             country_codes=country_codes,
             language='en',
+            **({'webhook': PLAID_WEBHOOK_URL} if PLAID_WEBHOOK_URL else {}),
         )
-        print('request:', request)
-        response = client.link_token_create(request)
-        print('Link token created: %s' % response.link_token)
+        response = await aio.plaid_call('link_token_create', link_request)
+        logger.info('Link token created', extra={'user_id': request.user.pk})
         return JsonResponse(response.to_dict())
     except plaid.ApiException as e:
-        print(e)
-        return json.loads(e.body)
+        logger.error('Link token creation failed', extra={'plaid_error': plaid_error(e)})
+        return JsonResponse(plaid_error(e), status=e.status or 500)
     
 
 
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])
-def exchange_public_token(request):
-    global access_token
-    public_token = request.data.get('public_token')
+@async_api_view(['POST'])
+async def exchange_public_token(request):
+    public_token = aio.request_data(request).get('public_token')
     
     if not public_token:
         return JsonResponse({
             'error': 'public_token is required'
         }, status=400)
     
+    # The exchange and the initial sync run on a background worker; the client
+    # polls /api/jobs/<id>/ for completion
+    job = await sync_to_async(jobs.enqueue)('exchange_public_token', user=request.user, public_token=public_token)
+    return JsonResponse({
+        'job': job.to_dict()
+    }, status=202)
+    
+@csrf_exempt
+@require_POST
+async def plaid_webhook(request):
+    # Plaid posts without a session; the Plaid-Verification JWT is what authenticates it
     try:
-        # Exchange the public token for an access token
-        exchange_request = ItemPublicTokenExchangeRequest(
-            public_token=public_token
-        )
-        exchange_response = client.item_public_token_exchange(exchange_request)
-        exchange_response = exchange_response if isinstance(exchange_response, dict) else exchange_response.to_dict()
-
-        access_token = exchange_response['access_token']
-        print('access_token: %s' % access_token)        
-        # Add a delay to allow Plaid to gather transaction data
-        time.sleep(30)  # 30 second delay
-        
-        update_transactions_and_accounts_for_access_token(access_token, request.user)
-        return JsonResponse(exchange_response)
-    except plaid.ApiException as e:
-        return JsonResponse(json.loads(e.body), status=500)
-    except Exception as e:
+        event = await aio.run_blocking(webhooks.receive, request.body, request.headers.get('Plaid-Verification'))
+    except webhooks.WebhookVerificationError as e:
+        logger.warning('Rejected webhook: %s', e)
         return JsonResponse({
             'error': str(e)
-        }, status=500)
-    
+        }, status=401)
+    except ValueError as e:
+        return JsonResponse({
+            'error': f'Invalid webhook: {e}'
+        }, status=400)
+    return JsonResponse({
+        'status': event.status if event is not None else 'duplicate'
+    })
+
 def create_login(access_token, item_id):
     #TODO: create login object
     pass
     
 
+def serialize_transaction(t):
+    return {
+        'transaction_id': t.transaction_id,
+        'amount': float(t.amount),
+        'description': t.description,
+        'merchant_name': t.merchant_name,
+        'datetime': t.datetime.isoformat(),
+        'transaction_type': t.transaction_type,
+        'payment_channel': t.payment_channel,
+        'account': {
+            'account_id': t.account.account_id,
+            'name': t.account.name,
+            'account_type': t.account.account_type,
+            'institution': t.account.institution
+        }
+    }
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@renderer_classes(payloads.RENDERERS)
+@cached_response('transactions', variant=payloads.variant)
 def get_transactions(request):
     # get accounts associated to user
-    accounts = Account.objects.filter(user=request.user)
-    if len(accounts) == 0:
+    if not Account.objects.filter(user=request.user).exists():
         return JsonResponse({
             'error': 'No accounts found for user',
             'transactions': []
         })
-    # get transactions for each account and combine into json list
-    transactions = []
-    for acc in accounts:
-        transactions.extend([
-            {
-                'transaction_id': t.transaction_id,
-                'amount': float(t.amount),
-                'description': t.description,
-                'merchant_name': t.merchant_name,
-                'datetime': t.datetime.isoformat(),
-                'transaction_type': t.transaction_type,
-                'payment_channel': t.payment_channel,
-                'account': {
-                    'name': t.account.name,
-                    'account_type': t.account.account_type,
-                    'institution': t.account.institution
-                }
-            }
-            for t in Transaction.objects.filter(account=acc).order_by('datetime')
-        ])
-    
+    transactions = Transaction.objects.filter(account__user=request.user).order_by('datetime', 'id')
+    if request.accepted_renderer.format == 'json':
+        # get transactions across all accounts in one query, joining the account in
+        data = {'transactions': [serialize_transaction(t) for t in transactions.select_related('account')]}
+    else:
+        data = payloads.compact_transactions(transactions, Account.objects.filter(user=request.user))
+    return payloads.response(request, data)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@cached_response('transaction_feed')
+def get_transaction_feed(request):
+    params = request.query_params
+    try:
+        limit = int(params.get('limit', db.FEED_DEFAULT_LIMIT))
+        start = db.parse_feed_bound(params['start']) if params.get('start') else None
+        end = db.parse_feed_bound(params['end'], end=True) if params.get('end') else None
+        transactions, next_cursor = db.get_transaction_feed(
+            request.user,
+            cursor=params.get('cursor'),
+            limit=limit,
+            start=start,
+            end=end,
+            account_id=params.get('account'),
+            transaction_type=params.get('transaction_type'),
+        )
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+
+    return JsonResponse({
+        'transactions': [serialize_transaction(t) for t in transactions],
+        'next_cursor': next_cursor,
+    })
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@cached_response('monthly_spending')
+def get_monthly_spending(request):
+    # rollups are kept current by each sync, so this reads one row per month
+    months = MonthlySpending.objects.filter(user=request.user).order_by('year', 'month')
+    try:
+        if request.query_params.get('start'):
+            year, month = map(int, request.query_params['start'].split('-'))
+            months = months.filter(Q(year__gt=year) | Q(year=year, month__gte=month))
+        if request.query_params.get('end'):
+            year, month = map(int, request.query_params['end'].split('-'))
+            months = months.filter(Q(year__lt=year) | Q(year=year, month__lte=month))
+    except ValueError:
+        return JsonResponse({
+            'error': 'start and end must be formatted as YYYY-MM'
+        }, status=400)
+    return JsonResponse({
+        'months': [m.to_dict() for m in months]
+    })
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@cached_response('recurring')
+def get_recurring(request):
+    # streams are detected after each sync and nightly, so this is a plain read
+    streams = RecurringStream.objects.filter(user=request.user).order_by('next_date', 'name')
+    if request.query_params.get('include_inactive') != '1':
+        streams = streams.filter(is_active=True)
+    if request.query_params.get('kind'):
+        streams = streams.filter(kind=request.query_params['kind'])
+    if request.query_params.get('frequency'):
+        streams = streams.filter(frequency=request.query_params['frequency'])
+    return JsonResponse({
+        'streams': [stream.to_dict() for stream in streams]
+    })
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@cached_response('upcoming_bills')
+def get_upcoming_bills(request):
+    try:
+        days = min(int(request.query_params.get('days', 30)), 366)
+    except ValueError:
+        return JsonResponse({
+            'error': 'days must be an integer'
+        }, status=400)
+    # The nightly detection bumps data_version, so cached responses do not outlive the day
+    start = timezone.localdate()
+    end = start + timedelta(days=days)
+    streams = RecurringStream.objects.filter(
+        user=request.user, kind=RecurringStream.KIND_EXPENSE, is_active=True, next_date__lte=end
+    )
+    bills = [
+        {'date': expected.isoformat(), 'amount': float(stream.average_amount), 'stream': stream.to_dict()}
+        for expected, stream in recurring.upcoming(streams, start, end)
+    ]
+    return JsonResponse({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'total': round(sum(bill['amount'] for bill in bills), 2),
+        'bills': bills,
+    })
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@cached_response('forecast')
+def get_forecast(request):
+    try:
+        months = int(request.query_params.get('months', forecast.DEFAULT_MONTHS))
+        scenarios = int(request.query_params.get('scenarios', forecast.DEFAULT_SCENARIOS))
+    except ValueError:
+        return JsonResponse({
+            'error': 'months and scenarios must be integers'
+        }, status=400)
+    if not 1 <= months <= forecast.MAX_MONTHS or not 1 <= scenarios <= forecast.MAX_SCENARIOS:
+        return JsonResponse({
+            'error': f'months must be 1-{forecast.MAX_MONTHS} and scenarios 1-{forecast.MAX_SCENARIOS}'
+        }, status=400)
+    return JsonResponse(forecast.forecast(request.user, months=months, scenarios=scenarios))
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def savings_goals(request):
+    if request.method == 'GET':
+        goals = SavingsGoal.objects.filter(user=request.user).order_by('deadline', 'id')
+        return JsonResponse({
+            'goals': [goal.to_dict() for goal in goals]
+        })
+
+    try:
+        values = forecast.validate_goal(request.data)
+        if 'name' not in values or 'target_amount' not in values:
+            raise ValueError('name and target_amount are required')
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+    goal = SavingsGoal.objects.create(user=request.user, **values)
+    # Forecasts include goal attainment
+    db.bump_data_version(request.user)
+    return JsonResponse({
+        'goal': goal.to_dict()
+    }, status=201)
+
+@api_view(['PUT', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def savings_goal(request, goal_id):
+    goal = SavingsGoal.objects.filter(id=goal_id, user=request.user).first()
+    if goal is None:
+        return JsonResponse({
+            'error': 'Goal not found'
+        }, status=404)
+
+    if request.method == 'DELETE':
+        goal.delete()
+        db.bump_data_version(request.user)
+        return JsonResponse({
+            'success': True
+        })
+
+    try:
+        for field, value in forecast.validate_goal(request.data).items():
+            setattr(goal, field, value)
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+    goal.save()
+    db.bump_data_version(request.user)
+    return JsonResponse({
+        'goal': goal.to_dict()
+    })
+
+def paycheck_changed(user, *paid_on):
+    """Refresh what is derived from paychecks: monthly income, paycheck streams and cached reads."""
+    rollups.refresh_months(user, {(d.year, d.month) for d in paid_on})
+    db.bump_data_version(user)
+    return tasks.enqueue_detect_recurring(user)
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def paychecks(request):
+    if request.method == 'GET':
+        rows = Paycheck.objects.filter(user=request.user).order_by('-date', '-id')
+        return JsonResponse({
+            'paychecks': [paycheck.to_dict() for paycheck in rows]
+        })
+
+    try:
+        values = forecast.validate_paycheck(request.data)
+        if 'total_amount' not in values or 'date' not in values:
+            raise ValueError('total_amount and date are required')
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+    paycheck = Paycheck.objects.create(user=request.user, **values)
+    job = paycheck_changed(request.user, paycheck.date)
     return JsonResponse({
-        'transactions': transactions
+        'paycheck': paycheck.to_dict(),
+        'job': job.to_dict()
+    }, status=201)
+
+@api_view(['PUT', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def paycheck(request, paycheck_id):
+    paycheck = Paycheck.objects.filter(id=paycheck_id, user=request.user).first()
+    if paycheck is None:
+        return JsonResponse({
+            'error': 'Paycheck not found'
+        }, status=404)
+
+    if request.method == 'DELETE':
+        paycheck.delete()
+        job = paycheck_changed(request.user, paycheck.date)
+        return JsonResponse({
+            'success': True,
+            'job': job.to_dict()
+        })
+
+    previous_date = paycheck.date
+    try:
+        for field, value in forecast.validate_paycheck(request.data).items():
+            setattr(paycheck, field, value)
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+    paycheck.save()
+    job = paycheck_changed(request.user, previous_date, paycheck.date)
+    return JsonResponse({
+        'paycheck': paycheck.to_dict(),
+        'job': job.to_dict()
     })
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
-def force_transaction_sync(request):
+@cached_response('analytics')
+def get_analytics(request, dimension):
+    if dimension not in analytics.DIMENSIONS:
+        return JsonResponse({
+            'error': f'Unknown dimension: {dimension}'
+        }, status=404)
+    params = request.query_params
+    try:
+        start = db.parse_feed_bound(params['start']) if params.get('start') else None
+        end = db.parse_feed_bound(params['end'], end=True) if params.get('end') else None
+        result = analytics.spending_by(
+            request.user,
+            dimension,
+            start=start,
+            end=end,
+            granularity=params.get('granularity'),
+            limit=int(params.get('limit', analytics.DEFAULT_LIMIT)),
+        )
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+    return JsonResponse(result)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_transactions(request, export_format):
+    if export_format not in exports.FORMATS:
+        return JsonResponse({
+            'error': f'Unknown export format: {export_format}'
+        }, status=404)
+    params = request.query_params
+    try:
+        start = db.parse_feed_bound(params['start']) if params.get('start') else None
+        end = db.parse_feed_bound(params['end'], end=True) if params.get('end') else None
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+
+    make_writer, content_type = exports.FORMATS[export_format]
+    # Each server streams only its own kind of iterator (see app/exports.py)
+    stream = exports.astream if aio.is_asgi(request) else exports.stream
+    response = StreamingHttpResponse(
+        stream(exports.export_queryset(request.user, start, end), make_writer),
+        content_type=content_type,
+    )
+    filename = f'transactions-{timezone.localdate().isoformat()}.{export_format}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def import_statement(request):
+    upload = request.FILES.get('file')
+    account_id = request.data.get('account_id')
+    if not upload or not account_id:
+        return JsonResponse({
+            'error': 'file and account_id are required'
+        }, status=400)
+
+    try:
+        statement_format = statements.detect_format(upload.name, request.data.get('format'))
+        account = statements.statement_account(
+            request.user,
+            account_id,
+            name=request.data.get('account_name'),
+            institution=request.data.get('institution'),
+        )
+        # Large uploads are spooled to a temporary file, so this reads from disk as it parses
+        stream = io.TextIOWrapper(upload.file, encoding='utf-8-sig', errors='replace', newline='')
+        records = statements.parse_statement(
+            stream,
+            statement_format,
+            date_format=request.data.get('date_format'),
+            expenses_negative=request.data.get('expenses_negative', 'true').lower() != 'false',
+        )
+        summary = statements.import_statement(request.user, account, records)
+    except statements.StatementError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+
+    return JsonResponse({
+        'account': account.to_dict(),
+        'summary': summary,
+    })
+
+@async_api_view(['GET'])
+async def force_transaction_sync(request):
     # get accounts associated to user
-    accounts = Account.objects.filter(user=request.user)
+    accounts = [
+        acc async for acc in Account.objects.filter(user=request.user).exclude(access_token=Account.MANUAL_ACCESS_TOKEN)
+    ]
     if len(accounts) == 0:
-        print('No accounts found for user')
+        logger.info('No accounts found for user', extra={'user_id': request.user.pk})
         return JsonResponse({
             'error': 'No accounts found for user',
             'transactions': []
         })
     # get unique access tokens from accounts
-    access_tokens = set([acc.access_token for acc in accounts])
-    for access_token in access_tokens:
-        update_transactions_and_accounts_for_access_token(access_token, request.user)
-    print('Transactions synced for all accounts')
+    access_tokens = list(dict.fromkeys(acc.access_token for acc in accounts))
+
+    if request.GET.get('wait') not in ('1', 'true'):
+        sync_jobs = await sync_to_async(
+            lambda: [tasks.enqueue_item_sync(request.user, access_token) for access_token in access_tokens]
+        )()
+        logger.info('Transaction syncs queued', extra={'user_id': request.user.pk, 'items': len(access_tokens)})
+        return JsonResponse({
+            'success': True,
+            'jobs': [job.to_dict() for job in sync_jobs]
+        }, status=202)
+
+    # ?wait=1: sync every item now, all at once, and answer when they are done
+    results = await aio.sync_items(request.user, access_tokens)
+    items = []
+    for access_token, (summary, error) in zip(access_tokens, results):
+        item = {'accounts': [acc.account_id for acc in accounts if acc.access_token == access_token]}
+        item.update({'summary': summary} if error is None else {'error': error})
+        items.append(item)
+    logger.info('Transaction syncs finished', extra={'user_id': request.user.pk, 'items': len(access_tokens)})
     return JsonResponse({
-        'success': True
+        'success': all(error is None for _, error in results),
+        'items': items
+    })
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def category_rules(request):
+    if request.method == 'GET':
+        rules = CategoryRule.objects.filter(user=request.user)
+        return JsonResponse({
+            'rules': [rule.to_dict() for rule in rules]
+        })
+
+    try:
+        values = categorize.validate_rule(request.data)
+        if not values.get('category'):
+            raise ValueError('category is required')
+        rule = CategoryRule(user=request.user, **values)
+        if not categorize.has_condition(rule):
+            raise ValueError('A rule needs at least one condition')
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+    rule.save()
+    # Existing transactions are recategorized in the background; new ones are categorized as they sync
+    job = tasks.enqueue_recategorize(request.user)
+    return JsonResponse({
+        'rule': rule.to_dict(),
+        'job': job.to_dict()
+    }, status=201)
+
+@api_view(['PUT', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def category_rule(request, rule_id):
+    rule = CategoryRule.objects.filter(id=rule_id, user=request.user).first()
+    if rule is None:
+        return JsonResponse({
+            'error': 'Rule not found'
+        }, status=404)
+
+    if request.method == 'DELETE':
+        rule.delete()
+        job = tasks.enqueue_recategorize(request.user)
+        return JsonResponse({
+            'success': True,
+            'job': job.to_dict()
+        })
+
+    try:
+        for field, value in categorize.validate_rule(request.data).items():
+            setattr(rule, field, value)
+        if rule.min_amount is not None and rule.max_amount is not None and rule.min_amount > rule.max_amount:
+            raise ValueError('min_amount is greater than max_amount')
+        if not categorize.has_condition(rule):
+            raise ValueError('A rule needs at least one condition')
+    except ValueError as e:
+        return JsonResponse({
+            'error': str(e)
+        }, status=400)
+    rule.save()
+    job = tasks.enqueue_recategorize(request.user)
+    return JsonResponse({
+        'rule': rule.to_dict(),
+        'job': job.to_dict()
+    })
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_job(request, job_id):
+    job = Job.objects.filter(id=job_id, user=request.user).first()
+    if job is None:
+        return JsonResponse({
+            'error': 'Job not found'
+        }, status=404)
+    return JsonResponse({
+        'job': job.to_dict()
     })
 
 def update_transactions_and_accounts_for_access_token(access_token, user):
     try:
-        response = send_transaction_request(access_token)
-        if 'error' in response:
-            print('Error in transaction sync:', response['error'])
-            return False
-        accounts = response['accounts']
-        print(response)
-
-        print('updating accounts')
-        db.update_accounts(user, access_token, accounts)
-        
-        print('updating cursor')
-        db.update_cursor(user, access_token, response['next_cursor'])
-        
-        print('updating transactions')
-        db.update_transactions(user, response)
-        
+        # pages are fetched and committed one at a time until Plaid has nothing more
+        sync.sync_item(access_token, user)
+    except sync.SyncError as e:
+        logger.error('Error in transaction sync', extra={'plaid_error': e.error})
+        return False
     except Exception as e:
-        print('Error processing access token:', str(e))
-        print('Error details:', e.__class__.__name__)
-        traceback.print_exc()
+        logger.exception('Error processing access token')
         return False
     return True
 
 def update_transactions_and_accounts_for_user(user):
     # get accounts associated to user
-    accounts = Account.objects.filter(user=user)
+    accounts = Account.objects.filter(user=user).exclude(access_token=Account.MANUAL_ACCESS_TOKEN)
     
     # If no accounts exist yet, we'll return True since accounts were just created in exchange_public_token
     # if len(accounts) == 0:
     #     return True
         
     # get unique access tokens from accounts
-    access_tokens = set([acc.access_token for acc in accounts])
+    access_tokens = list(dict.fromkeys(acc.access_token for acc in accounts))
     
-    success = True
-    # get transactions for each account and combine into json list
-    for access_token in access_tokens:
-        success = success and update_transactions_and_accounts_for_access_token(access_token)
-
-    return success
-
-def send_transaction_request(access_token):
-    try:
-        cursor = db.get_cursor(access_token=access_token)
-        request_params = {
-            'access_token': access_token,
-        }
-        if cursor is not None:
-            request_params['cursor'] = cursor
-            
-        request = TransactionsSyncRequest(**request_params)
-        response = client.transactions_sync(request)
-        response_dict = response.to_dict()
-        print("Raw Plaid response:", str(response_dict))
-        return response_dict
-    except plaid.ApiException as e:
-        error_response = json.loads(e.body)
-        print("Plaid API error:", str(error_response))
-        return error_response
+    # every item is synced at the same time
+    results = async_to_sync(aio.sync_items)(user, access_tokens, timeout=None)
+    return all(error is None for _, error in results)
     
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cached_response('accounts')
 def get_accounts(request):
-    accounts = Account.objects.filter(user=request.user)
+    accounts = Account.objects.filter(user=request.user).exclude(access_token=Account.MANUAL_ACCESS_TOKEN)
     if len(accounts) == 0:
         return JsonResponse({
             'error': 'No accounts found for user',
@@ -351,29 +698,54 @@ def get_accounts(request):
         'accounts': [acc.to_dict() for acc in accounts],
     })
 
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def get_item(request):
+@async_api_view(['GET'])
+async def get_item(request):
     global access_token
     try:
-        request = ItemGetRequest(
+        item_request = ItemGetRequest(
             access_token=access_token
         )
-        response = client.item_get(request)
-        print("Item response:", str(response))
+        response = await aio.plaid_call('item_get', item_request)
         return JsonResponse(response.to_dict())
     except plaid.ApiException as e:
-        return json.loads(e.body)
+        return JsonResponse(plaid_error(e), status=e.status or 500)
     
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def get_liabilities(request):
+@async_api_view(['GET'])
+async def get_liabilities(request):
     try:
-        request = LiabilitiesGetRequest(access_token=access_token)
-        response = client.liabilities_get(request)
+        liabilities_request = LiabilitiesGetRequest(access_token=access_token)
+        response = await aio.plaid_call('liabilities_get', liabilities_request)
         return JsonResponse(response.to_dict())
     except plaid.ApiException as e:
-        return json.loads(e.body)
+        return JsonResponse(plaid_error(e), status=e.status or 500)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_plaid_metrics(request):
+    # calls/sec, errors, retries and throttling per Plaid endpoint for this process
+    return JsonResponse({
+        **client.metrics.snapshot(),
+        'concurrency_limit': client.concurrency.limit,
+    })
+
+def metrics(request):
+    # Prometheus scrapes with a bearer token rather than a session
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token:
+        allowed = hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    else:
+        allowed = request.user.is_authenticated and request.user.is_staff
+    if not allowed:
+        return HttpResponse('Forbidden\n', status=403, content_type='text/plain')
+    return HttpResponse(instrumentation.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_cache_stats(request):
+    return JsonResponse({
+        **response_cache.stats.snapshot(),
+        'merchants': merchants.resolver.stats.snapshot(),
+    })
 
 @api_view(['POST'])
 def register_user(request):
@@ -412,7 +784,7 @@ def register_user(request):
         }, status=status.HTTP_201_CREATED)
 
     except Exception as e:
-        print('Registration error:', str(e))  # Add logging
+        logger.exception('Registration error')
         return Response(
             {'error': str(e)}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -453,8 +825,9 @@ def get_csrf_token(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cached_response('check_auth')
 def check_auth(request):
-    return Response({
+    return JsonResponse({
         'isAuthenticated': True,
         'user': {
             'username': request.user.username,
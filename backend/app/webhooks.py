@@ -0,0 +1,162 @@
+"""
+Plaid webhooks: verification, deduplication and the syncs they trigger.
+
+Items linked while PLAID_WEBHOOK_URL is set (or pointed at it later with
+`manage.py register_webhooks`) have Plaid post to /api/plaid_webhook/ whenever
+they have new transaction data. Each delivery is
+
+- verified: the Plaid-Verification header is an ES256 JWT whose key comes from
+  /webhook_verification_key/get and whose request_body_sha256 claim must match
+  the body. Tokens older than MAX_TOKEN_AGE_SECONDS are refused as replays;
+- deduplicated: a delivery for the same item, webhook_type and webhook_code
+  with the same body, seen again within DEDUPE_SECONDS, is dropped. Plaid
+  signs every retry with a fresh token, so the token only serves the replay
+  check above. WebhookEvent.fingerprint is unique, so of concurrent retries
+  only the one that inserts (or, after the window, reclaims) the row goes on;
+- coalesced: SYNC_WEBHOOKS enqueue a sync of that one item, delayed by
+  settings.WEBHOOK_SYNC_DELAY and deduplicated on the item, so every webhook
+  that arrives before the sync starts shares it.
+
+Accepted deliveries are stored as WebhookEvents, the latest one per fingerprint.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import plaid
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from plaid.model.webhook_verification_key_get_request import WebhookVerificationKeyGetRequest
+
+from app import tasks
+from app.models import Cursor, WebhookEvent
+from app.plaid_client import PLAID_WEBHOOK_VERIFY, client, plaid_error
+
+logger = logging.getLogger(__name__)
+
+# (webhook_type, webhook_code) pairs meaning the item has transactions to sync
+SYNC_WEBHOOKS = {
+    ('TRANSACTIONS', 'SYNC_UPDATES_AVAILABLE'),
+    ('TRANSACTIONS', 'DEFAULT_UPDATE'),
+}
+# Plaid's guidance: refuse verification tokens issued more than five minutes ago
+MAX_TOKEN_AGE_SECONDS = 5 * 60
+DEDUPE_SECONDS = MAX_TOKEN_AGE_SECONDS
+
+verification_keys = {}
+verification_keys_lock = threading.Lock()
+
+
+class WebhookVerificationError(Exception):
+    """Raised when a webhook's Plaid-Verification JWT is missing or does not check out."""
+
+
+def verification_key(key_id):
+    """The JWK Plaid signs webhooks with under key_id, fetched once per process."""
+    with verification_keys_lock:
+        if key_id in verification_keys:
+            return verification_keys[key_id]
+    try:
+        response = client.webhook_verification_key_get(WebhookVerificationKeyGetRequest(key_id=key_id))
+    except plaid.ApiException as e:
+        raise WebhookVerificationError(f"Unknown verification key {key_id}: {plaid_error(e).get('error_code')}")
+    key = response.to_dict()['key']
+    if key.get('expired_at') is not None:
+        raise WebhookVerificationError(f'Verification key {key_id} has expired')
+    with verification_keys_lock:
+        verification_keys[key_id] = key
+    return key
+
+
+def verify(body, token):
+    """Check a Plaid-Verification JWT against the raw request body."""
+    # PyJWT is only needed when verification is on
+    import jwt
+
+    if not token:
+        raise WebhookVerificationError('Missing Plaid-Verification header')
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.PyJWTError as e:
+        raise WebhookVerificationError(f'Malformed verification token: {e}')
+    if header.get('alg') != 'ES256':
+        raise WebhookVerificationError(f"Unexpected signing algorithm {header.get('alg')}")
+
+    key = verification_key(header.get('kid'))
+    public_key = jwt.algorithms.ECAlgorithm.from_jwk(json.dumps({k: key[k] for k in ('kty', 'crv', 'x', 'y')}))
+    try:
+        claims = jwt.decode(token, public_key, algorithms=['ES256'])
+    except jwt.PyJWTError as e:
+        raise WebhookVerificationError(f'Invalid verification token: {e}')
+    if time.time() - claims.get('iat', 0) > MAX_TOKEN_AGE_SECONDS:
+        raise WebhookVerificationError('Verification token is too old')
+    if not hmac.compare_digest(str(claims.get('request_body_sha256', '')), hashlib.sha256(body).hexdigest()):
+        raise WebhookVerificationError('Body does not match the verification token')
+
+
+def delivery_fingerprint(payload, body):
+    """sha256 identifying a delivery by its item, type, code and body; a retry of it has the same one."""
+    identity = [str(payload.get(field) or '') for field in ('item_id', 'webhook_type', 'webhook_code')]
+    return hashlib.sha256('\n'.join(identity + [hashlib.sha256(body).hexdigest()]).encode()).hexdigest()
+
+
+def receive(body, token=None):
+    """Verify, deduplicate and act on one webhook delivery.
+
+    Returns the stored WebhookEvent, or None when the delivery is a repeat.
+    Raises WebhookVerificationError for deliveries that fail verification and
+    ValueError for bodies that are not a webhook.
+    """
+    if PLAID_WEBHOOK_VERIFY:
+        verify(body, token)
+    payload = json.loads(body)
+    if not isinstance(payload, dict) or 'webhook_type' not in payload:
+        raise ValueError('expected an object with a webhook_type')
+    fingerprint = delivery_fingerprint(payload, body)
+
+    values = {
+        'webhook_type': str(payload['webhook_type'])[:100],
+        'webhook_code': str(payload.get('webhook_code', ''))[:100],
+        'item_id': str(payload.get('item_id') or '')[:255],
+        'payload': payload,
+        'status': WebhookEvent.STATUS_IGNORED,
+        'job': None,
+    }
+    try:
+        with transaction.atomic():
+            event = WebhookEvent.objects.create(fingerprint=fingerprint, **values)
+    except IntegrityError:
+        # Delivered before. Inside the window it is a retry; after it, the same body
+        # again (SYNC_UPDATES_AVAILABLE bodies repeat), which takes over the row.
+        # The conditional update lets only one of several concurrent deliveries do so.
+        now = timezone.now()
+        reclaimed = WebhookEvent.objects.filter(
+            fingerprint=fingerprint, received_at__lt=now - timedelta(seconds=DEDUPE_SECONDS),
+        ).update(received_at=now, **values)
+        if not reclaimed:
+            logger.info('Dropped repeated webhook', extra={'webhook_code': payload.get('webhook_code')})
+            return None
+        event = WebhookEvent.objects.get(fingerprint=fingerprint)
+
+    if (event.webhook_type, event.webhook_code) in SYNC_WEBHOOKS:
+        item = Cursor.objects.filter(item_id=event.item_id).select_related('user').first() if event.item_id else None
+        if item is None:
+            event.status = WebhookEvent.STATUS_UNKNOWN_ITEM
+        else:
+            event.job = tasks.enqueue_item_sync(
+                item.user, item.access_token, delay=getattr(settings, 'WEBHOOK_SYNC_DELAY', 10)
+            )
+            event.status = WebhookEvent.STATUS_QUEUED
+    event.save(update_fields=['status', 'job'])
+    logger.info('Received webhook', extra={
+        'webhook_type': event.webhook_type,
+        'webhook_code': event.webhook_code,
+        'item_id': event.item_id,
+        'webhook_status': event.status,
+    })
+    return event
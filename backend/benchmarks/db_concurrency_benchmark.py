@@ -0,0 +1,247 @@
+"""
+Read latency while syncs write, for each database configuration.
+
+Each configuration runs in its own process, since Django reads DATABASES once
+at startup. The database is migrated and seeded, then writer threads apply
+/transactions/sync pages through db.apply_sync_page (the path every sync
+takes) while reader threads run the dashboard's read queries. Reported per
+configuration: read latency percentiles, reads and written rows per second,
+and "database is locked" errors.
+
+    python benchmarks/db_concurrency_benchmark.py
+    python benchmarks/db_concurrency_benchmark.py --configs sqlite-default sqlite-tuned --duration 20 --json results.json
+
+The postgresql configuration connects with the DB_* variables read by
+server/settings.py and needs a database it may migrate and fill, e.g.
+
+    DB_NAME=finance_bench python benchmarks/db_concurrency_benchmark.py --configs postgresql
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Environment each configuration runs server/settings.py with
+CONFIGS = {
+    'sqlite-default': {'DB_ENGINE': 'sqlite3', 'SQLITE_TUNED': '0'},
+    'sqlite-tuned': {'DB_ENGINE': 'sqlite3', 'SQLITE_TUNED': '1'},
+    'postgresql': {'DB_ENGINE': 'postgresql'},
+}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def setup_django():
+    sys.path.insert(0, BACKEND_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+    # db_methods logs every page it applies; keep the output readable
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    import django
+    from django.conf import settings
+    django.setup()
+    # Analytics read the database here, not the columnar snapshots
+    settings.SNAPSHOT_DIR = ''
+
+
+def seed(users, rows_per_user):
+    from decimal import Decimal
+    from django.utils import timezone
+    from app.models import Account, Transaction, User
+    from benchmarks.fake_plaid import MERCHANTS
+
+    rng = random.Random(0)
+    now = timezone.now()
+    seeded = []
+    for u in range(users):
+        user = User.objects.create_user(username=f'bench-{u}', password='bench')
+        account = Account.objects.create(
+            user=user, account_id=f'bench-acc-{u}', access_token=f'access-bench-{u}', name='Checking', account_type='depository'
+        )
+        rows = []
+        for i in range(rows_per_user):
+            name, category, channel, low, high = rng.choice(MERCHANTS)
+            rows.append(Transaction(
+                transaction_id=f'seed-{u}-{i}',
+                account=account,
+                datetime=now - timedelta(days=rng.randrange(730)),
+                amount=Decimal(str(round(rng.uniform(low, high), 2))),
+                description=name.upper(),
+                transaction_type=category,
+                plaid_category=category,
+                merchant_name=name,
+                payment_channel=channel,
+            ))
+        Transaction.objects.bulk_create(rows, batch_size=2000)
+        seeded.append(user)
+    return seeded
+
+
+def writer(user, page_size, stop, stats):
+    from django.db import OperationalError, connection
+    import app.db_methods as db
+    from benchmarks.fake_plaid import make_account, make_transaction
+
+    rng = random.Random(user.pk)
+    access_token = f'access-bench-{user.username}'
+    account = make_account(f'bench-acc-{user.username}')
+    page_number = 0
+    try:
+        while not stop.is_set():
+            page_number += 1
+            today = date.today()
+            page = {
+                'accounts': [account],
+                'added': [
+                    make_transaction(rng, f'{user.username}-{page_number}-{i}', account['account_id'], today - timedelta(days=rng.randrange(90)))
+                    for i in range(page_size)
+                ],
+                'modified': [],
+                'removed': [],
+                'next_cursor': f'cursor-{page_number}',
+                'has_more': False,
+            }
+            started = time.perf_counter()
+            try:
+                db.apply_sync_page(user, access_token, page)
+            except OperationalError:
+                stats['write_errors'] += 1
+                continue
+            stats['page_ms'].append((time.perf_counter() - started) * 1000)
+            stats['rows_written'] += page_size
+    finally:
+        connection.close()
+
+
+def reader(users, stop, stats):
+    from django.db import OperationalError, connection
+    import app.db_methods as db
+    from app import analytics
+    from app.models import MonthlySpending
+
+    rng = random.Random(threading.get_ident())
+    queries = [
+        ('transaction_feed', lambda user: db.get_transaction_feed(user, limit=100)),
+        ('analytics_category', lambda user: analytics.database_spending_by(user, 'category', None, None, None, 25)),
+        ('monthly_spending', lambda user: list(MonthlySpending.objects.filter(user=user).order_by('year', 'month'))),
+    ]
+    try:
+        while not stop.is_set():
+            name, query = rng.choice(queries)
+            user = rng.choice(users)
+            started = time.perf_counter()
+            try:
+                query(user)
+            except OperationalError:
+                stats['read_errors'] += 1
+                continue
+            stats['read_ms'].setdefault(name, []).append((time.perf_counter() - started) * 1000)
+    finally:
+        connection.close()
+
+
+def run(args):
+    """Benchmark the configuration this process was started with; returns the results."""
+    setup_django()
+    from django.core.management import call_command
+    from django.db import connection
+
+    call_command('migrate', verbosity=0)
+    users = seed(args.users, args.rows_per_user)
+    connection.close()
+
+    stats = {'read_ms': {}, 'page_ms': [], 'rows_written': 0, 'read_errors': 0, 'write_errors': 0}
+    stop = threading.Event()
+    threads = [threading.Thread(target=writer, args=(users[i % len(users)], args.page_size, stop, stats)) for i in range(args.writers)]
+    threads += [threading.Thread(target=reader, args=(users, stop, stats)) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    reads = [ms for timings in stats['read_ms'].values() for ms in timings]
+    return {
+        'engine': connection.vendor,
+        'reads_per_second': len(reads) / args.duration,
+        'read_p50_ms': percentile(reads, 50),
+        'read_p95_ms': percentile(reads, 95),
+        'read_p99_ms': percentile(reads, 99),
+        'read_max_ms': max(reads) if reads else None,
+        'read_median_ms_by_query': {name: statistics.median(timings) for name, timings in stats['read_ms'].items()},
+        'rows_written_per_second': stats['rows_written'] / args.duration,
+        'page_p50_ms': percentile(stats['page_ms'], 50),
+        'read_errors': stats['read_errors'],
+        'write_errors': stats['write_errors'],
+    }
+
+
+def run_config(name, args, tmp):
+    env = dict(os.environ, **CONFIGS[name])
+    if env['DB_ENGINE'] == 'sqlite3':
+        env['DB_NAME'] = os.path.join(tmp, f'{name}.sqlite3')
+    command = [
+        sys.executable, os.path.abspath(__file__), '--run',
+        '--duration', str(args.duration), '--readers', str(args.readers), '--writers', str(args.writers),
+        '--users', str(args.users), '--rows-per-user', str(args.rows_per_user), '--page-size', str(args.page_size),
+    ]
+    completed = subprocess.run(command, env=env, cwd=BACKEND_DIR, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS), default=['sqlite-default', 'sqlite-tuned'])
+    parser.add_argument('--duration', type=float, default=10, help='Seconds readers and writers run')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--rows-per-user', type=int, default=5000, help='Transactions seeded per user')
+    parser.add_argument('--page-size', type=int, default=500, help='Transactions per sync page written')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args)))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.configs:
+            print(f'Running {name}...', flush=True)
+            results[name] = run_config(name, args, tmp)
+
+    for name, result in results.items():
+        print(name)
+        if 'error' in result:
+            print(f"  failed: {result['error']}")
+            continue
+        print(f"  reads:  {result['reads_per_second']:8.1f}/s  p50 {result['read_p50_ms']:8.2f} ms  "
+              f"p95 {result['read_p95_ms']:8.2f} ms  p99 {result['read_p99_ms']:8.2f} ms  max {result['read_max_ms']:8.2f} ms")
+        print(f"  writes: {result['rows_written_per_second']:8.1f} rows/s  page p50 {result['page_p50_ms']:8.2f} ms")
+        print(f"  errors: {result['read_errors']} reads, {result['write_errors']} writes")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'duration': args.duration, 'readers': args.readers, 'writers': args.writers, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
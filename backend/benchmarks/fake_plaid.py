@@ -0,0 +1,302 @@
+"""
+A local stand-in for the Plaid API, good enough for the plaid-python client.
+
+Each item has an append-only log of transaction events (added / modified /
+removed) and /transactions/sync cursors are offsets into that log, so paging,
+has_more and incremental syncs behave like the real thing. The server can also
+enforce a per-item rate limit, inject 5xx errors and add latency, which is what
+the client-side limiter in app/plaid_client.py has to cope with.
+
+    python benchmarks/fake_plaid.py --port 8001 --items 10 --transactions 5000
+    PLAID_HOST=http://localhost:8001 python manage.py refresh_transactions
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MERCHANTS = [
+    ('Starbucks', 'FOOD_AND_DRINK', 'in store', 3, 9),
+    ('Chipotle', 'FOOD_AND_DRINK', 'in store', 9, 18),
+    ('Whole Foods', 'FOOD_AND_DRINK', 'in store', 20, 180),
+    ('Amazon', 'GENERAL_MERCHANDISE', 'online', 5, 250),
+    ('Target', 'GENERAL_MERCHANDISE', 'in store', 10, 150),
+    ('Shell', 'TRANSPORTATION', 'in store', 25, 70),
+    ('Uber', 'TRANSPORTATION', 'online', 8, 45),
+    ('Con Edison', 'RENT_AND_UTILITIES', 'online', 60, 180),
+    ('Netflix', 'ENTERTAINMENT', 'online', 15, 23),
+    ('CVS Pharmacy', 'MEDICAL', 'in store', 5, 60),
+]
+
+
+def make_transaction(rng, transaction_id, account_id, day, merchant=None, amount=None):
+    """Build a transaction dict in the shape /transactions/sync returns."""
+    name, category, channel, low, high = merchant or rng.choice(MERCHANTS)
+    return {
+        'transaction_id': transaction_id,
+        'account_id': account_id,
+        'amount': amount if amount is not None else round(rng.uniform(low, high), 2),
+        'iso_currency_code': 'USD',
+        'unofficial_currency_code': None,
+        'date': day.isoformat(),
+        'datetime': None,
+        'authorized_date': None,
+        'authorized_datetime': None,
+        'name': name.upper(),
+        'merchant_name': name,
+        'merchant_entity_id': None,
+        'logo_url': None,
+        'website': None,
+        'pending': False,
+        'pending_transaction_id': None,
+        'account_owner': None,
+        'payment_channel': channel,
+        'transaction_code': None,
+        'check_number': None,
+        'category': None,
+        'category_id': None,
+        'counterparties': [],
+        'location': dict.fromkeys(['address', 'city', 'region', 'postal_code', 'country', 'lat', 'lon', 'store_number']),
+        'payment_meta': dict.fromkeys(['by_order_of', 'payee', 'payer', 'payment_method', 'payment_processor', 'ppd_id', 'reason', 'reference_number']),
+        'personal_finance_category': {'primary': category, 'detailed': category, 'confidence_level': 'HIGH'},
+    }
+
+
+def make_account(account_id, name='Checking', balance=2500.0):
+    return {
+        'account_id': account_id,
+        'balances': {'available': balance, 'current': balance, 'limit': None, 'iso_currency_code': 'USD', 'unofficial_currency_code': None},
+        'mask': account_id[-4:],
+        'name': name,
+        'official_name': None,
+        'type': 'depository',
+        'subtype': 'checking',
+    }
+
+
+class FakeItem:
+    def __init__(self, access_token, accounts):
+        self.access_token = access_token
+        self.item_id = f'item-{uuid.uuid4().hex[:12]}'
+        self.accounts = accounts
+        self.events = []  # (kind, payload) where kind is 'added', 'modified' or 'removed'
+        self.live = {}  # transaction_id -> current version, for picking rows to modify or remove
+        self.lock = threading.Lock()
+
+    def add(self, transaction):
+        with self.lock:
+            self.events.append(('added', transaction))
+            self.live[transaction['transaction_id']] = transaction
+
+    def modify(self, transaction):
+        with self.lock:
+            self.events.append(('modified', transaction))
+            self.live[transaction['transaction_id']] = transaction
+
+    def remove(self, transaction_id, account_id):
+        with self.lock:
+            self.events.append(('removed', {'transaction_id': transaction_id, 'account_id': account_id}))
+            self.live.pop(transaction_id, None)
+
+    def churn(self, rng, modified=0, removed=0):
+        """Edit the amounts of `modified` random live transactions and remove `removed` others."""
+        with self.lock:
+            picked = rng.sample(sorted(self.live), min(len(self.live), modified + removed))
+        for transaction_id in picked[:modified]:
+            # e.g. a pending charge settling for a different amount, such as a tip added
+            changed = dict(self.live[transaction_id], amount=round(self.live[transaction_id]['amount'] * rng.uniform(1.0, 1.25), 2))
+            self.modify(changed)
+        for transaction_id in picked[modified:]:
+            self.remove(transaction_id, self.live[transaction_id]['account_id'])
+
+    def page(self, cursor, count):
+        with self.lock:
+            start = int(cursor or 0)
+            end = min(len(self.events), start + count)
+            events = self.events[start:end]
+            has_more = end < len(self.events)
+        page = {'added': [], 'modified': [], 'removed': []}
+        for kind, payload in events:
+            page[kind].append(payload)
+        return page, str(end), has_more
+
+
+class FakePlaidState:
+    """The items a fake server serves, plus its rate limit / error injection knobs."""
+
+    def __init__(self, page_size=500, item_rate_limit=None, error_rate=0.0, latency=0.0, seed=0):
+        self.items = {}
+        self.public_tokens = {}
+        self.page_size = page_size
+        self.item_rate_limit = item_rate_limit
+        self.error_rate = error_rate
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.request_log = {}
+        self.counters = {'requests': 0, 'rate_limited': 0, 'errors': 0}
+        self.lock = threading.Lock()
+
+    def add_item(self, access_token=None, accounts=1, transactions=0, days=365):
+        access_token = access_token or f'access-fake-{uuid.uuid4().hex[:12]}'
+        item = FakeItem(access_token, [make_account(f'{access_token}-acc-{i}') for i in range(accounts)])
+        today = date.today()
+        for i in range(transactions):
+            account = item.accounts[i % accounts]['account_id']
+            day = today - timedelta(days=self.rng.randrange(days))
+            item.add(make_transaction(self.rng, f'{access_token}-txn-{i}', account, day))
+        self.items[access_token] = item
+        return item
+
+    def create_public_token(self, **item_options):
+        public_token = f'public-fake-{uuid.uuid4().hex[:12]}'
+        self.public_tokens[public_token] = item_options
+        return public_token
+
+    def check_limits(self, access_token):
+        """Return an (http status, error body) tuple if this request should fail, else None."""
+        with self.lock:
+            self.counters['requests'] += 1
+            if self.error_rate and self.rng.random() < self.error_rate:
+                self.counters['errors'] += 1
+                return 500, plaid_error('API_ERROR', 'INTERNAL_SERVER_ERROR', 'injected failure')
+            if self.item_rate_limit and access_token:
+                now = time.monotonic()
+                window = [t for t in self.request_log.get(access_token, []) if now - t < 1.0]
+                if len(window) >= self.item_rate_limit:
+                    self.counters['rate_limited'] += 1
+                    self.request_log[access_token] = window
+                    return 429, plaid_error('RATE_LIMIT_EXCEEDED', 'TRANSACTIONS_SYNC_LIMIT', 'rate limit exceeded')
+                window.append(now)
+                self.request_log[access_token] = window
+        return None
+
+
+def plaid_error(error_type, error_code, message):
+    return {
+        'error_type': error_type,
+        'error_code': error_code,
+        'error_message': message,
+        'display_message': None,
+        'request_id': uuid.uuid4().hex,
+    }
+
+
+class FakePlaidHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if self.state.latency:
+            time.sleep(self.state.latency)
+
+        access_token = body.get('access_token')
+        failure = self.state.check_limits(access_token)
+        if failure:
+            return self.send_json(*failure)
+
+        route = {
+            '/transactions/sync': self.transactions_sync,
+            '/item/get': self.item_get,
+            '/item/public_token/exchange': self.public_token_exchange,
+            '/link/token/create': self.link_token_create,
+        }.get(self.path)
+        if route is None:
+            return self.send_json(400, plaid_error('INVALID_REQUEST', 'UNKNOWN_ENDPOINT', f'{self.path} is not faked'))
+        if access_token is not None and access_token not in self.state.items:
+            return self.send_json(400, plaid_error('INVALID_INPUT', 'INVALID_ACCESS_TOKEN', 'unknown access token'))
+        return route(body)
+
+    def transactions_sync(self, body):
+        item = self.state.items[body['access_token']]
+        count = body.get('count') or self.state.page_size
+        page, next_cursor, has_more = item.page(body.get('cursor'), count)
+        self.send_json(200, {
+            'transactions_update_status': 'HISTORICAL_UPDATE_COMPLETE',
+            'accounts': item.accounts,
+            'next_cursor': next_cursor,
+            'has_more': has_more,
+            'request_id': uuid.uuid4().hex,
+            **page,
+        })
+
+    def item_get(self, body):
+        item = self.state.items[body['access_token']]
+        self.send_json(200, {
+            'item': {
+                'item_id': item.item_id,
+                'institution_id': 'ins_fake',
+                'webhook': None,
+                'error': None,
+                'available_products': [],
+                'billed_products': ['transactions'],
+                'consent_expiration_time': None,
+                'update_type': 'background',
+            },
+            'request_id': uuid.uuid4().hex,
+        })
+
+    def public_token_exchange(self, body):
+        options = self.state.public_tokens.pop(body.get('public_token'), None)
+        if options is None:
+            return self.send_json(400, plaid_error('INVALID_INPUT', 'INVALID_PUBLIC_TOKEN', 'unknown public token'))
+        item = self.state.add_item(**options)
+        self.send_json(200, {'access_token': item.access_token, 'item_id': item.item_id, 'request_id': uuid.uuid4().hex})
+
+    def link_token_create(self, body):
+        self.send_json(200, {
+            'link_token': f'link-fake-{uuid.uuid4().hex[:12]}',
+            'expiration': '2099-01-01T00:00:00Z',
+            'request_id': uuid.uuid4().hex,
+        })
+
+
+def start_fake_plaid(state, host='127.0.0.1', port=0):
+    """Serve `state` on a background thread. Returns (server, base url)."""
+    handler = type('BoundFakePlaidHandler', (FakePlaidHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--items', type=int, default=5, help='Items created up front (access-fake-0, access-fake-1, ...)')
+    parser.add_argument('--transactions', type=int, default=1000, help='Transactions per item')
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--item-rate-limit', type=int, help='Requests per second allowed per item')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 500')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    args = parser.parse_args()
+
+    state = FakePlaidState(args.page_size, args.item_rate_limit, args.error_rate, args.latency)
+    for i in range(args.items):
+        state.add_item(f'access-fake-{i}', transactions=args.transactions)
+    server, url = start_fake_plaid(state, port=args.port)
+    print(f'Fake Plaid listening on {url} with {args.items} items')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
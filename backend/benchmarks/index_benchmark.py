@@ -0,0 +1,206 @@
+"""
+Query plans and timings for the Transaction hot-path lookups, before and after
+the indexes added in app/migrations/0002_transaction_indexes.py.
+
+Builds a synthetic SQLite database shaped like the app's tables (1M transactions
+by default), runs each lookup against the unindexed schema, creates the indexes
+and runs them again.
+
+    python benchmarks/index_benchmark.py
+    python benchmarks/index_benchmark.py --rows 200000 --json results.json
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE app_account (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    user_id bigint NOT NULL,
+    account_id varchar(255) NOT NULL,
+    access_token varchar(255) NOT NULL,
+    name varchar(255) NOT NULL,
+    account_type varchar(50) NOT NULL,
+    balance decimal NOT NULL,
+    institution varchar(255) NULL
+);
+CREATE INDEX app_account_user_id ON app_account (user_id);
+CREATE TABLE app_cursor (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    user_id bigint NOT NULL,
+    access_token varchar(255) NOT NULL,
+    cursor varchar(255) NOT NULL
+);
+CREATE INDEX app_cursor_user_id ON app_cursor (user_id);
+CREATE TABLE app_transaction (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    transaction_id varchar(255) NOT NULL,
+    account_id bigint NOT NULL REFERENCES app_account (id),
+    datetime datetime NOT NULL,
+    amount decimal NOT NULL,
+    description text NULL,
+    transaction_type varchar(10) NOT NULL,
+    created_at datetime NOT NULL,
+    merchant_id varchar(255) NULL,
+    merchant_name varchar(255) NULL,
+    payment_channel varchar(255) NULL
+);
+CREATE INDEX app_transaction_account_id ON app_transaction (account_id);
+"""
+
+# Mirrors the Meta.indexes / Meta.constraints on the models
+INDEXES = """
+CREATE INDEX app_account_account_id ON app_account (account_id);
+CREATE INDEX account_user_access_token ON app_account (user_id, access_token);
+CREATE UNIQUE INDEX unique_cursor_access_token ON app_cursor (access_token);
+CREATE UNIQUE INDEX unique_transaction_per_account ON app_transaction (transaction_id, account_id);
+CREATE INDEX transaction_account_datetime ON app_transaction (account_id, datetime);
+"""
+
+CATEGORIES = ['FOOD_AND_DRINK', 'GENERAL_MERCHANDISE', 'TRANSPORTATION', 'RENT_AND_UTILITIES', 'ENTERTAINMENT']
+CHANNELS = ['online', 'in store', 'other']
+
+
+def populate(conn, rows, accounts_per_user, accounts):
+    rng = random.Random(42)
+    start = datetime(2020, 1, 1)
+    users = max(1, accounts // accounts_per_user)
+
+    conn.executemany(
+        'INSERT INTO app_account (id, user_id, account_id, access_token, name, account_type, balance, institution) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            (i, i % users + 1, f'acc-{i}', f'access-{i // 2}', f'Account {i}', 'bank', 0, 'Bank')
+            for i in range(1, accounts + 1)
+        ),
+    )
+    conn.executemany(
+        'INSERT INTO app_cursor (user_id, access_token, cursor) VALUES (?, ?, ?)',
+        ((i % users + 1, f'access-{i}', f'cursor-{i}') for i in range(accounts // 2 + 1)),
+    )
+
+    def transactions():
+        for i in range(rows):
+            when = start + timedelta(minutes=rng.randrange(5 * 365 * 24 * 60))
+            yield (
+                f'txn-{i}',
+                rng.randrange(1, accounts + 1),
+                when.isoformat(sep=' '),
+                round(rng.uniform(1, 500), 2),
+                'Purchase',
+                rng.choice(CATEGORIES)[:10],
+                when.isoformat(sep=' '),
+                f'Merchant {rng.randrange(2000)}',
+                rng.choice(CHANNELS),
+            )
+
+    conn.executemany(
+        'INSERT INTO app_transaction (transaction_id, account_id, datetime, amount, description, '
+        'transaction_type, created_at, merchant_name, payment_channel) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        transactions(),
+    )
+    conn.commit()
+    return users
+
+
+def build_queries(rows, accounts, users):
+    rng = random.Random(7)
+    ids = [f'txn-{rng.randrange(rows)}' for _ in range(500)]
+    account = rng.randrange(1, accounts + 1)
+    user = rng.randrange(1, users + 1)
+    user_accounts = [a for a in range(1, accounts + 1) if a % users + 1 == user]
+    placeholders = ','.join('?' * len(ids))
+    account_placeholders = ','.join('?' * len(user_accounts))
+    return [
+        (
+            'modify/remove: transaction_id__in (500 ids)',
+            f'SELECT id FROM app_transaction WHERE transaction_id IN ({placeholders})',
+            ids,
+        ),
+        (
+            'get_account_transactions: account + datetime range',
+            'SELECT * FROM app_transaction WHERE account_id = ? AND datetime >= ? AND datetime <= ? ORDER BY datetime',
+            [account, '2023-01-01', '2023-03-31'],
+        ),
+        (
+            'get_transaction_feed: first page across user accounts',
+            f'SELECT * FROM app_transaction WHERE account_id IN ({account_placeholders}) '
+            'ORDER BY datetime DESC, id DESC LIMIT 101',
+            user_accounts,
+        ),
+        (
+            'add_transactions: Account by account_id',
+            'SELECT * FROM app_account WHERE account_id IN (?, ?, ?)',
+            [f'acc-{account}', f'acc-{account + 1}', f'acc-{account + 2}'],
+        ),
+        (
+            'force_transaction_sync: Account by user + access_token',
+            'SELECT * FROM app_account WHERE user_id = ? AND access_token = ?',
+            [user, f'access-{account // 2}'],
+        ),
+        (
+            'get_cursor: Cursor by access_token',
+            'SELECT cursor FROM app_cursor WHERE access_token = ?',
+            [f'access-{account // 2}'],
+        ),
+    ]
+
+
+def measure(conn, queries, repeat):
+    results = {}
+    for name, sql, params in queries:
+        plan = [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = {'plan': plan, 'median_ms': statistics.median(timings)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Number of synthetic transactions')
+    parser.add_argument('--accounts', type=int, default=20_000, help='Number of synthetic accounts')
+    parser.add_argument('--accounts-per-user', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per query; the median is reported')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.sqlite3'))
+        conn.executescript(SCHEMA)
+
+        started = time.perf_counter()
+        users = populate(conn, args.rows, args.accounts_per_user, args.accounts)
+        print(f'Populated {args.rows:,} transactions in {time.perf_counter() - started:.1f}s')
+
+        queries = build_queries(args.rows, args.accounts, users)
+        before = measure(conn, queries, args.repeat)
+
+        started = time.perf_counter()
+        conn.executescript(INDEXES)
+        conn.execute('ANALYZE')
+        print(f'Built indexes in {time.perf_counter() - started:.1f}s\n')
+        after = measure(conn, queries, args.repeat)
+        conn.close()
+
+    for name, _, _ in queries:
+        print(name)
+        print(f'  before: {before[name]["median_ms"]:9.3f} ms  {" | ".join(before[name]["plan"])}')
+        print(f'  after:  {after[name]["median_ms"]:9.3f} ms  {" | ".join(after[name]["plan"])}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'rows': args.rows, 'before': before, 'after': after}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""
+Synthetic households for benchmarks: realistic transaction streams and a fast
+loader that puts millions of them in the database.
+
+A Household has a fixed set of habits drawn from its seed:
+
+- discretionary spending spread over a weighted catalog of national merchants
+  (a few, like Amazon and Starbucks, account for much of the volume) plus a
+  neighbourhood of local merchants drawn from a long tail, with lognormal
+  amounts around each merchant's typical ticket;
+- more purchases on Fridays and weekends and in December;
+- monthly bills (rent, utilities, phone, subscriptions) on fixed days, with
+  utilities varying month to month;
+- a biweekly paycheck, which Plaid reports as a negative amount.
+
+Transactions come out as the dicts /transactions/sync returns, so the same
+stream can be served by benchmarks/fake_plaid.py or stored directly with
+load(), which bulk-inserts rows built by db.stored_fields (the mapping every
+sync uses) and rebuilds each user's monthly rollups.
+
+    python benchmarks/ledger.py --transactions 1000000 --users 10
+    DB_NAME=/tmp/bench.sqlite3 python benchmarks/ledger.py --load --transactions 2000000
+"""
+import argparse
+import itertools
+import math
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.fake_plaid import make_account, make_transaction  # noqa: E402
+
+# (name, category, channel, weight, typical amount, spread of log(amount))
+NATIONAL_MERCHANTS = [
+    ('Amazon', 'GENERAL_MERCHANDISE', 'online', 10, 35, 0.9),
+    ('Starbucks', 'FOOD_AND_DRINK', 'in store', 9, 6.5, 0.35),
+    ('Whole Foods', 'FOOD_AND_DRINK', 'in store', 6, 75, 0.6),
+    ('Chipotle', 'FOOD_AND_DRINK', 'in store', 6, 14, 0.3),
+    ('Trader Joe\'s', 'FOOD_AND_DRINK', 'in store', 5, 55, 0.5),
+    ('McDonald\'s', 'FOOD_AND_DRINK', 'in store', 5, 11, 0.4),
+    ('Target', 'GENERAL_MERCHANDISE', 'in store', 5, 45, 0.7),
+    ('Shell', 'TRANSPORTATION', 'in store', 5, 45, 0.3),
+    ('Uber', 'TRANSPORTATION', 'online', 5, 19, 0.5),
+    ('DoorDash', 'FOOD_AND_DRINK', 'online', 4, 38, 0.4),
+    ('Dunkin', 'FOOD_AND_DRINK', 'in store', 4, 5, 0.3),
+    ('Kroger', 'FOOD_AND_DRINK', 'in store', 4, 85, 0.6),
+    ('Walmart', 'GENERAL_MERCHANDISE', 'in store', 4, 50, 0.7),
+    ('Uber Eats', 'FOOD_AND_DRINK', 'online', 3, 32, 0.4),
+    ('Sweetgreen', 'FOOD_AND_DRINK', 'in store', 3, 16, 0.2),
+    ('Chevron', 'TRANSPORTATION', 'in store', 3, 48, 0.3),
+    ('MTA', 'TRANSPORTATION', 'in store', 3, 2.9, 0.1),
+    ('CVS Pharmacy', 'MEDICAL', 'in store', 3, 18, 0.7),
+    ('Venmo', 'TRANSFER_OUT', 'online', 3, 40, 0.9),
+    ('Costco', 'GENERAL_MERCHANDISE', 'in store', 2, 160, 0.5),
+    ('Home Depot', 'HOME_IMPROVEMENT', 'in store', 2, 70, 0.9),
+    ('Lyft', 'TRANSPORTATION', 'online', 2, 17, 0.5),
+    ('Walgreens', 'MEDICAL', 'in store', 2, 16, 0.7),
+    ('Best Buy', 'GENERAL_MERCHANDISE', 'in store', 1, 120, 0.9),
+    ('AMC Theatres', 'ENTERTAINMENT', 'in store', 1, 28, 0.4),
+    ('Sephora', 'PERSONAL_CARE', 'in store', 1, 55, 0.6),
+    ('Steam', 'ENTERTAINMENT', 'online', 0.7, 25, 0.7),
+    ('IKEA', 'HOME_IMPROVEMENT', 'in store', 0.5, 150, 0.8),
+    ('Great Clips', 'PERSONAL_CARE', 'in store', 0.5, 24, 0.2),
+    ('Delta Air Lines', 'TRAVEL', 'online', 0.4, 380, 0.5),
+    ('Airbnb', 'TRAVEL', 'online', 0.3, 450, 0.6),
+    ('Marriott', 'TRAVEL', 'in store', 0.3, 260, 0.5),
+]
+# Local merchants are named '<place> <kind>'; (kind, category, typical amount, spread)
+LOCAL_PLACES = [
+    'Maple', 'Harbor', 'Union', 'Elm', 'Corner', 'Sunrise', 'Golden', 'Bluebird', 'Riverside', 'Oak',
+    'Main Street', 'Park', 'Lucky', 'Little', 'Mission', 'Liberty', 'Cedar', 'Hillside', 'Lakeview', 'Northside',
+]
+LOCAL_KINDS = [
+    ('Cafe', 'FOOD_AND_DRINK', 9, 0.4),
+    ('Deli', 'FOOD_AND_DRINK', 12, 0.4),
+    ('Pizza', 'FOOD_AND_DRINK', 22, 0.4),
+    ('Taqueria', 'FOOD_AND_DRINK', 15, 0.3),
+    ('Bakery', 'FOOD_AND_DRINK', 10, 0.4),
+    ('Tavern', 'FOOD_AND_DRINK', 35, 0.5),
+    ('Market', 'FOOD_AND_DRINK', 28, 0.6),
+    ('Hardware', 'HOME_IMPROVEMENT', 30, 0.7),
+    ('Dry Cleaners', 'GENERAL_SERVICES', 22, 0.3),
+    ('Books', 'GENERAL_MERCHANDISE', 25, 0.5),
+    ('Barber', 'PERSONAL_CARE', 30, 0.2),
+]
+# (name, category, channel, monthly amount range, how much it varies month to month, share of households with it)
+BILLS = [
+    ('Rent', 'RENT_AND_UTILITIES', 'other', (1400, 3200), 0.0, 0.7),
+    ('Con Edison', 'RENT_AND_UTILITIES', 'online', (60, 140), 0.25, 0.8),
+    ('Verizon Wireless', 'RENT_AND_UTILITIES', 'online', (70, 110), 0.0, 0.7),
+    ('Comcast', 'RENT_AND_UTILITIES', 'online', (60, 90), 0.0, 0.5),
+    ('GEICO', 'GENERAL_SERVICES', 'online', (95, 160), 0.0, 0.5),
+    ('Netflix', 'ENTERTAINMENT', 'online', (15.49, 15.49), 0.0, 0.6),
+    ('Spotify', 'ENTERTAINMENT', 'online', (10.99, 10.99), 0.0, 0.5),
+    ('Planet Fitness', 'PERSONAL_CARE', 'online', (24.99, 24.99), 0.0, 0.3),
+    ('New York Times', 'ENTERTAINMENT', 'online', (17, 17), 0.0, 0.2),
+]
+PAYROLL = ('Acme Corp Payroll', 'INCOME', 'other')
+LOCAL_SHARE = 0.2  # of discretionary purchases
+NEIGHBOURHOOD_SIZE = 40  # local merchants one household frequents
+DAY_WEIGHTS = (0.9, 0.9, 0.95, 1.0, 1.2, 1.45, 1.3)  # Monday .. Sunday
+
+
+class Household:
+    """One user's spending habits; the same seed always produces the same ledger."""
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        rng = self.rng
+        # Each household leans a little differently on the catalog
+        self.merchant_weights = list(itertools.accumulate(m[3] * rng.uniform(0.3, 1.7) for m in NATIONAL_MERCHANTS))
+        locals_ = [(f'{place} {kind}', category, amount, spread) for place in LOCAL_PLACES for kind, category, amount, spread in LOCAL_KINDS]
+        self.neighbourhood = rng.sample(locals_, min(NEIGHBOURHOOD_SIZE, len(locals_)))
+        # A handful of favourites take most local visits
+        self.local_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(self.neighbourhood))))
+        self.bills = [
+            (name, category, channel, round(rng.uniform(*amounts), 2), variation, rng.randint(1, 28))
+            for name, category, channel, amounts, variation, share in BILLS
+            if rng.random() < share
+        ]
+        self.paycheck = round(rng.uniform(1800, 4500), 2)
+        # Biweekly Fridays, starting on one of the first two
+        self.payday_offset = rng.randrange(2)
+
+    def recurring(self, day):
+        """The bills and paychecks falling on `day`, as (merchant tuple, amount)."""
+        for name, category, channel, amount, variation, bill_day in self.bills:
+            if day.day == bill_day:
+                if variation:
+                    amount = round(amount * self.rng.uniform(1 - variation, 1 + variation), 2)
+                yield (name, category, channel, amount, amount), amount
+        if day.weekday() == 4 and (day.toordinal() // 7) % 2 == self.payday_offset:
+            yield PAYROLL + (self.paycheck, self.paycheck), -self.paycheck
+
+    def purchase(self):
+        """A discretionary purchase as (merchant tuple, amount)."""
+        rng = self.rng
+        if rng.random() < LOCAL_SHARE:
+            name, category, typical, spread = rng.choices(self.neighbourhood, cum_weights=self.local_weights)[0]
+            channel = 'in store'
+        else:
+            name, category, channel, _, typical, spread = rng.choices(NATIONAL_MERCHANTS, cum_weights=self.merchant_weights)[0]
+        amount = round(max(0.5, rng.lognormvariate(math.log(typical), spread)), 2)
+        return (name, category, channel, amount, amount), amount
+
+    def transactions(self, account_id, count, days=730, end=None, prefix='txn', recurring=True):
+        """Yield about `count` transactions for one account over the `days` ending at `end`, oldest first.
+
+        With recurring the account also carries the household's bills and paychecks
+        (its checking account); they count towards `count`.
+        """
+        end = end or date.today()
+        start = end - timedelta(days=days - 1)
+        rng = self.rng
+        weights = [
+            DAY_WEIGHTS[day.weekday()] * (1.3 if day.month == 12 else 1.0)
+            for day in (start + timedelta(days=offset) for offset in range(days))
+        ]
+        expected_recurring = (len(self.bills) * 12 / 365 + 1 / 14) * days if recurring else 0
+        per_weight = max(0, count - expected_recurring) / sum(weights)
+
+        number = itertools.count()
+        for offset, weight in enumerate(weights):
+            day = start + timedelta(days=offset)
+            if recurring:
+                for merchant, amount in self.recurring(day):
+                    yield make_transaction(rng, f'{prefix}-{next(number)}', account_id, day, merchant, amount)
+            expected = weight * per_weight
+            purchases = int(expected) + (rng.random() < expected - int(expected))
+            for _ in range(purchases):
+                merchant, amount = self.purchase()
+                yield make_transaction(rng, f'{prefix}-{next(number)}', account_id, day, merchant, amount)
+
+
+def household_accounts(access_token, accounts):
+    """Plaid account dicts for a household: a checking account, then credit cards."""
+    return [
+        make_account(f'{access_token}-acc-{i}', name='Checking' if i == 0 else f'Credit Card {i}')
+        for i in range(accounts)
+    ]
+
+
+def household_transactions(household, access_token, accounts, count, days=730, end=None):
+    """Spread `count` transactions over a household's accounts, the bills and pay on the first."""
+    streams = []
+    for i, account in enumerate(accounts):
+        share = count // len(accounts) + (i < count % len(accounts))
+        streams.append(household.transactions(
+            account['account_id'], share, days=days, end=end, prefix=f'{access_token}-{i}', recurring=i == 0,
+        ))
+    return itertools.chain.from_iterable(streams)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def load(users, transactions, accounts_per_user=2, days=730, seed=0, batch_size=5000, prefix='bench'):
+    """Create `users` users sharing `transactions` transactions and return [(user, access_token, accounts)].
+
+    Needs Django set up. Rows are built with db.stored_fields and bulk-inserted,
+    paychecks become Paycheck rows (as sync drops negative amounts), and each
+    user's MonthlySpending is rebuilt.
+    """
+    from decimal import Decimal
+    from django.db import transaction as db_transaction
+    import app.db_methods as db
+    from app import categorize, merchants, rollups
+    from app.models import Paycheck, Transaction, User
+
+    loaded = []
+    for u in range(users):
+        user = User.objects.create(username=f'{prefix}-{u}')
+        access_token = f'access-{prefix}-{u}'
+        accounts = household_accounts(access_token, accounts_per_user)
+        db.update_accounts(user, access_token, accounts)
+        stored = {a.account_id: a for a in user.account_set.all()}
+        matcher = categorize.matcher_for(user)
+        count = transactions // users + (u < transactions % users)
+        stream = household_transactions(Household(seed * 100003 + u), access_token, accounts, count, days=days)
+        for batch in batched(stream, batch_size):
+            with db_transaction.atomic():
+                expenses = [t for t in batch if t['amount'] > 0]
+                merchant_ids = merchants.resolve([t['merchant_name'] for t in expenses])
+                Transaction.objects.bulk_create([
+                    Transaction(
+                        transaction_id=t['transaction_id'],
+                        account=stored[t['account_id']],
+                        **db.stored_fields(t, matcher, merchant_ids),
+                    )
+                    for t in expenses
+                ], batch_size=1000)
+                Paycheck.objects.bulk_create([
+                    Paycheck(user=user, total_amount=Decimal(str(-t['amount'])), date=date.fromisoformat(t['date']))
+                    for t in batch if t['amount'] < 0
+                ])
+        rollups.rebuild(user)
+        loaded.append((user, access_token, accounts))
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transactions', type=int, default=100000, help='Total across all users')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--accounts', type=int, default=2, help='Accounts per user')
+    parser.add_argument('--days', type=int, default=730, help='Days of history')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--load', action='store_true', help='Migrate the database from server/settings.py and store the ledger in it')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.load:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        import django
+        from django.core.management import call_command
+        django.setup()
+        call_command('migrate', verbosity=0)
+        from app.models import Paycheck, Transaction
+        load(args.users, args.transactions, args.accounts, args.days, args.seed)
+        print(f'Stored {Transaction.objects.count()} transactions and {Paycheck.objects.count()} paychecks '
+              f'for {args.users} users in {time.perf_counter() - started:.1f}s')
+        return
+
+    # Without --load, describe the ledger that would be generated
+    categories, merchant_counts, generated, income = {}, {}, 0, 0
+    for u in range(args.users):
+        access_token = f'access-bench-{u}'
+        accounts = household_accounts(access_token, args.accounts)
+        count = args.transactions // args.users + (u < args.transactions % args.users)
+        for t in household_transactions(Household(args.seed * 100003 + u), access_token, accounts, count, days=args.days):
+            generated += 1
+            if t['amount'] < 0:
+                income += 1
+                continue
+            category = t['personal_finance_category']['primary']
+            categories[category] = categories.get(category, 0) + t['amount']
+            merchant_counts[t['merchant_name']] = merchant_counts.get(t['merchant_name'], 0) + 1
+    elapsed = time.perf_counter() - started
+    print(f'Generated {generated} transactions ({income} paychecks) for {args.users} users in {elapsed:.1f}s '
+          f'({generated / elapsed:.0f}/s), {len(merchant_counts)} distinct merchants')
+    total = sum(categories.values())
+    for category, amount in sorted(categories.items(), key=lambda item: -item[1]):
+        print(f'  {category:<22} {amount / total:6.1%}')
+    top = sorted(merchant_counts.items(), key=lambda item: -item[1])[:10]
+    print('Most frequent merchants: ' + ', '.join(f'{name} ({count})' for name, count in top))
+
+
+if __name__ == '__main__':
+    main()
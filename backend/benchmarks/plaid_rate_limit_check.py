@@ -0,0 +1,85 @@
+"""
+Drive the rate-limited Plaid client against the fake Plaid server.
+
+The fake server enforces a per-item limit that the client's buckets are set to
+exceed, and injects a share of 500s. Every item is synced to completion from
+several threads, so the run only succeeds if backoff and retries absorb all of
+the throttling and failures. It prints the client's metrics at the end.
+
+    python -m benchmarks.plaid_rate_limit_check
+    python -m benchmarks.plaid_rate_limit_check --items 20 --threads 16 --error-rate 0.1
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import plaid
+from plaid.api import plaid_api
+from plaid.model.transactions_sync_request import TransactionsSyncRequest
+
+from app.plaid_client import AdaptiveConcurrency, RateLimitedPlaidClient
+from benchmarks.fake_plaid import FakePlaidState, start_fake_plaid
+
+
+def sync_everything(client, access_token, page_size):
+    cursor, transactions = None, 0
+    while True:
+        params = {'access_token': access_token, 'count': page_size}
+        if cursor:
+            params['cursor'] = cursor
+        page = client.transactions_sync(TransactionsSyncRequest(**params))
+        transactions += len(page.added)
+        cursor = page.next_cursor
+        if not page.has_more:
+            return transactions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=8)
+    parser.add_argument('--transactions', type=int, default=300, help='Transactions per item')
+    parser.add_argument('--page-size', type=int, default=10, help='Small pages mean many calls per item')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--server-item-rate', type=int, default=5, help='Requests/s per item the fake server allows')
+    parser.add_argument('--client-item-rate', type=float, default=20, help='Requests/s per item the client allows itself')
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    args = parser.parse_args()
+
+    state = FakePlaidState(item_rate_limit=args.server_item_rate, error_rate=args.error_rate)
+    tokens = [state.add_item(transactions=args.transactions).access_token for _ in range(args.items)]
+    server, url = start_fake_plaid(state)
+
+    api = plaid_api.PlaidApi(plaid.ApiClient(plaid.Configuration(host=url)))
+    client = RateLimitedPlaidClient(
+        api,
+        item_rate=args.client_item_rate,
+        item_burst=5,
+        base_delay=0.05,
+        max_delay=2,
+        max_retries=8,
+        concurrency=AdaptiveConcurrency(initial=args.threads, maximum=args.threads * 2),
+    )
+
+    started = time.monotonic()
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for future in [executor.submit(sync_everything, client, token, args.page_size) for token in tokens]:
+            try:
+                assert future.result() == args.transactions
+            except Exception as e:
+                failures += 1
+                print(f'Item failed: {e.__class__.__name__}: {e}')
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    print(f'Synced {args.items - failures}/{args.items} items in {elapsed:.2f}s')
+    print(f'Server: {state.counters}')
+    print(f'Client concurrency limit at end: {client.concurrency.limit}')
+    print(json.dumps(client.metrics.snapshot(), indent=2))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+Transaction table size and aggregation speed with money as decimals and
+categories and channels as strings, against integer cents and lookup codes,
+before and after app/migrations/0010_cents_and_lookup_codes.py.
+
+A synthetic ledger (benchmarks/ledger.py) is loaded into a fresh SQLite
+database in a temporary directory (or --db), migrated back to the decimal and
+string schema of 0009 and forward again through the real migration, and
+measured on each side of it after a VACUUM:
+
+- size: bytes of app_transaction and of its indexes, and the average stored
+  row payload (from SQLite's dbstat, or pg_relation_size on PostgreSQL);
+- aggregation: the same SQL on both schemas, the GROUP BYs behind the
+  analytics and rollups, timed as the median of --repeat runs. The results of
+  both sides are compared (cents against rounded decimals, codes translated
+  to names) to check that the migration kept every total.
+
+    python benchmarks/storage_benchmark.py
+    python benchmarks/storage_benchmark.py --transactions 2000000 --users 20 --json results.json
+
+With DB_ENGINE=postgresql it uses the database named by DB_NAME (or --db)
+from server/settings.py, which it must be allowed to migrate and fill, e.g.
+
+    DB_ENGINE=postgresql DB_NAME=finance_bench python benchmarks/storage_benchmark.py
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks import ledger  # noqa: E402
+
+BEFORE_MIGRATION = '0009_webhooks'
+AFTER_MIGRATION = '0010_cents_and_lookup_codes'
+# (name, SQL, whether it takes the user id); the text is the same for both schemas
+QUERIES = [
+    (
+        'total',
+        'SELECT SUM(amount), COUNT(*) FROM app_transaction',
+        False,
+    ),
+    (
+        'by_category',
+        'SELECT transaction_type, SUM(amount), COUNT(*) FROM app_transaction GROUP BY transaction_type',
+        False,
+    ),
+    (
+        'user_by_category',
+        'SELECT t.transaction_type, SUM(t.amount), COUNT(*) FROM app_transaction t '
+        'JOIN app_account a ON a.id = t.account_id WHERE a.user_id = %s GROUP BY t.transaction_type',
+        True,
+    ),
+    (
+        'user_by_channel',
+        'SELECT t.payment_channel, SUM(t.amount), COUNT(*) FROM app_transaction t '
+        'JOIN app_account a ON a.id = t.account_id WHERE a.user_id = %s GROUP BY t.payment_channel',
+        True,
+    ),
+    (
+        'by_account_category',
+        'SELECT account_id, transaction_type, SUM(amount), COUNT(*) FROM app_transaction GROUP BY account_id, transaction_type',
+        False,
+    ),
+]
+# Columns of each query's rows that hold a category or channel
+LOOKUP_COLUMNS = {
+    'by_category': {0: 'transaction_type'},
+    'user_by_category': {0: 'transaction_type'},
+    'user_by_channel': {0: 'payment_channel'},
+    'by_account_category': {1: 'transaction_type'},
+}
+
+
+def setup_django(args, tmp):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if args.db or os.getenv('DB_ENGINE') != 'postgresql':
+        os.environ['DB_NAME'] = args.db or os.path.join(tmp, 'bench.sqlite3')
+    # The ledger loader would otherwise build a snapshot per user
+    os.environ['SNAPSHOT_DIR'] = ''
+    os.environ.setdefault('PLAID_ENV', 'sandbox')
+    os.environ.setdefault('PLAID_CLIENT_ID', 'bench')
+    os.environ.setdefault('PLAID_SECRET_SANDBOX', 'bench')
+    import django
+    django.setup()
+
+
+def table_size():
+    """{table_bytes, index_bytes, payload_bytes} of app_transaction; payload_bytes is None on PostgreSQL."""
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT pg_relation_size('app_transaction'), pg_indexes_size('app_transaction')")
+            table_bytes, index_bytes = cursor.fetchone()
+            return {'table_bytes': table_bytes, 'index_bytes': index_bytes, 'payload_bytes': None}
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'app_transaction'")
+        indexes = [name for name, in cursor.fetchall()]
+        cursor.execute("SELECT SUM(payload) FROM dbstat WHERE name = 'app_transaction' AND pagetype = 'leaf'")
+        payload_bytes, = cursor.fetchone()
+        cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = 'app_transaction'")
+        table_bytes, = cursor.fetchone()
+        cursor.execute(f"SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name IN ({', '.join(['%s'] * len(indexes))})", indexes)
+        index_bytes, = cursor.fetchone()
+    return {'table_bytes': table_bytes, 'index_bytes': index_bytes, 'payload_bytes': payload_bytes}
+
+
+def compact():
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        cursor.execute('VACUUM' if connection.vendor == 'sqlite' else 'VACUUM FULL app_transaction')
+        cursor.execute('ANALYZE' if connection.vendor == 'sqlite' else 'ANALYZE app_transaction')
+
+
+def measure(user_id, repeat):
+    """({query: median ms}, {query: rows}) of QUERIES on the current schema."""
+    from django.db import connection
+
+    timings, results = {}, {}
+    with connection.cursor() as cursor:
+        for name, sql, per_user in QUERIES:
+            params = [user_id] if per_user else []
+            samples = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+                samples.append((time.perf_counter() - started) * 1000)
+            timings[name] = statistics.median(samples)
+            results[name] = rows
+    return timings, results
+
+
+def normalize(results, decode):
+    """Query rows, sorted, with totals in cents and, with decode, codes replaced by names."""
+    from app.models import Transaction
+
+    normalized = {}
+    for name, rows in results.items():
+        lookups = {column: Transaction._meta.get_field(field).lookup for column, field in LOOKUP_COLUMNS.get(name, {}).items()}
+        normalized[name] = []
+        for row in rows:
+            row = list(row)
+            # Every query ends with SUM(amount), COUNT(*)
+            row[-2] = int(row[-2]) if decode else int(round(Decimal(str(row[-2])) * 100))
+            if decode:
+                for column, lookup in lookups.items():
+                    row[column] = lookup.name(row[column])
+            normalized[name].append(tuple(row))
+        normalized[name].sort(key=repr)
+    return normalized
+
+
+def format_bytes(value):
+    return '-' if value is None else f'{value / 1e6:9.2f} MB'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transactions', type=int, default=500000, help='Transactions loaded, across all users')
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per query; the median is reported')
+    parser.add_argument('--db', help='SQLite file (or PostgreSQL database) to use instead of a temporary one; must be empty')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(args, tmp)
+        from django.core.management import call_command
+        from django.db import connection
+        from app.models import Transaction
+
+        call_command('migrate', verbosity=0)
+        started = time.perf_counter()
+        loaded = ledger.load(args.users, args.transactions)
+        rows = Transaction.objects.count()
+        print(f'Loaded {rows:,} transactions for {args.users} users in {time.perf_counter() - started:.1f}s')
+        user_id = loaded[0][0].id
+
+        started = time.perf_counter()
+        call_command('migrate', 'app', BEFORE_MIGRATION, verbosity=0)
+        backward_s = time.perf_counter() - started
+        compact()
+        before = {'size': table_size()}
+        before['timings_ms'], before_results = measure(user_id, args.repeat)
+
+        started = time.perf_counter()
+        call_command('migrate', 'app', AFTER_MIGRATION, verbosity=0)
+        forward_s = time.perf_counter() - started
+        compact()
+        after = {'size': table_size()}
+        after['timings_ms'], after_results = measure(user_id, args.repeat)
+
+        matches = normalize(before_results, decode=False) == normalize(after_results, decode=True)
+        vendor = connection.vendor
+        connection.close()
+
+    print(f'Migrated back in {backward_s:.1f}s and forward in {forward_s:.1f}s ({vendor})\n')
+    print(f'{"":24}{"before":>16}{"after":>16}{"change":>10}')
+    for key in ('table_bytes', 'index_bytes', 'payload_bytes'):
+        old, new = before['size'][key], after['size'][key]
+        change = f'{(new - old) / old * 100:+9.1f}%' if old and new is not None else ''
+        print(f'{key:24}{format_bytes(old):>16}{format_bytes(new):>16}{change:>10}')
+    if before['size']['payload_bytes'] is not None:
+        print(f'{"payload bytes per row":24}{before["size"]["payload_bytes"] / rows:16.1f}{after["size"]["payload_bytes"] / rows:16.1f}')
+    print()
+    for name, _, _ in QUERIES:
+        old, new = before['timings_ms'][name], after['timings_ms'][name]
+        print(f'{name:24}{old:13.2f} ms{new:13.2f} ms{(new - old) / old * 100:+9.1f}%')
+    print(f'\nResults match: {"yes" if matches else "NO"}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'rows': rows, 'users': args.users, 'vendor': vendor,
+                'migrate_backward_s': backward_s, 'migrate_forward_s': forward_s,
+                'before': before, 'after': after, 'results_match': matches,
+            }, f, indent=2)
+    if not matches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
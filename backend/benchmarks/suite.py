@@ -0,0 +1,405 @@
+"""
+End-to-end benchmark suite: syncs against a local fake Plaid and timed reads
+of a synthetic ledger, with results comparable across commits.
+
+Everything runs in this process against a fresh SQLite database in a temporary
+directory (or --db), with benchmarks/fake_plaid.py standing in for Plaid and
+benchmarks/ledger.py generating the data:
+
+- setup: --users users sharing --transactions transactions are bulk-loaded;
+- initial_backfill: --sync-items new items, each with --sync-transactions
+  transactions, are synced from scratch through sync.sync_item, --workers at
+  a time;
+- incremental_sync: --rounds rounds of a few added, modified and removed
+  transactions per item, each followed by a sync of every item;
+- get_transactions: the full ledger and the first feed page of the largest
+  loaded user, through the test client with the response cache cleared;
+- analytics: the analytics, monthly spending and forecast endpoints, plus
+  the time to build the user's columnar snapshot;
+- refresh_all: `manage.py refresh_transactions` over every item.
+
+Latencies are reported as p50/p95 of --repeat runs. With --json the results,
+tagged with the git commit, are written to a file; --compare reads such a file
+and flags every timing that got more than --threshold percent worse, exiting
+with status 1 if any did.
+
+    python benchmarks/suite.py
+    python benchmarks/suite.py --transactions 2000000 --users 20 --json results.json
+    python benchmarks/suite.py --scenarios get_transactions analytics --compare results.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks import ledger  # noqa: E402
+from benchmarks.fake_plaid import FakeItem, FakePlaidState, start_fake_plaid  # noqa: E402
+
+SCENARIOS = ['initial_backfill', 'incremental_sync', 'get_transactions', 'analytics', 'refresh_all']
+# Millisecond timings moving by less than this are noise, whatever the percentage
+NOISE_MS = 1.0
+READ_ENDPOINTS = {
+    'get_transactions': [
+        ('transactions', '/api/get_transactions/'),
+        ('transactions_compact', '/api/get_transactions/?format=compact'),
+        ('transactions_compact_gzip', '/api/get_transactions/?format=compact', {'Accept-Encoding': 'gzip'}),
+        ('transaction_feed', '/api/get_transaction_feed/?limit=100'),
+    ],
+    'analytics': [
+        ('analytics_category', '/api/analytics/category/'),
+        ('analytics_category_monthly', '/api/analytics/category/?granularity=month'),
+        ('analytics_merchant', '/api/analytics/merchant/'),
+        ('monthly_spending', '/api/monthly_spending/'),
+        ('forecast', '/api/forecast/'),
+    ],
+}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def latency(samples_ms):
+    return {'p50_ms': percentile(samples_ms, 50), 'p95_ms': percentile(samples_ms, 95), 'runs': len(samples_ms)}
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain'], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(dirty)
+
+
+def setup_django(args, tmp, plaid_url):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+    # db_methods logs every page it applies; keep the output readable
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['DB_NAME'] = args.db or os.path.join(tmp, 'bench.sqlite3')
+    os.environ['SNAPSHOT_DIR'] = '' if args.no_snapshots else os.path.join(tmp, 'snapshots')
+    os.environ['PLAID_HOST'] = plaid_url
+    os.environ.setdefault('PLAID_ENV', 'sandbox')
+    os.environ.setdefault('PLAID_CLIENT_ID', 'bench')
+    os.environ.setdefault('PLAID_SECRET_SANDBOX', 'bench')
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+
+    if not args.plaid_rate_limits:
+        # The fake server has no quotas; leave the client's own limits out of the timings
+        from app.plaid_client import client
+        client.endpoint_rates = dict.fromkeys(client.endpoint_rates, 1e6)
+        client.default_rate = client.item_rate = client.item_burst = 1e6
+
+
+def plaid_calls():
+    from app.plaid_client import client
+    return sum(counters['calls'] for counters in client.metrics.snapshot()['endpoints'].values())
+
+
+def sync_all(items, workers):
+    """Sync every (access_token, user) concurrently; returns timing and row totals."""
+    from django.db import connection
+    from app import sync
+
+    def sync_one(access_token, user):
+        started = time.perf_counter()
+        try:
+            return sync.sync_item(access_token, user), time.perf_counter() - started
+        finally:
+            connection.close()
+
+    calls = plaid_calls()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda item: sync_one(*item), items))
+    elapsed = time.perf_counter() - started
+    totals = Counter()
+    for summary, _ in results:
+        totals.update(summary)
+    rows = totals['added'] + totals['updated'] + totals['removed']
+    return {
+        'seconds': elapsed,
+        'items': len(items),
+        'pages': totals['pages'],
+        'rows_added': totals['added'],
+        'rows_updated': totals['updated'],
+        'rows_removed': totals['removed'],
+        'rows_per_second': rows / elapsed if elapsed else None,
+        'item_p50_ms': percentile([seconds * 1000 for _, seconds in results], 50),
+        'item_p95_ms': percentile([seconds * 1000 for _, seconds in results], 95),
+        'plaid_calls': plaid_calls() - calls,
+    }
+
+
+def create_sync_items(args, state):
+    """New users, each with an item on the fake server holding --sync-transactions transactions."""
+    from app.models import User
+
+    items = []
+    for i in range(args.sync_items):
+        access_token = f'access-sync-{i}'
+        item = FakeItem(access_token, ledger.household_accounts(access_token, args.accounts))
+        household = ledger.Household(args.seed * 100003 + 50000 + i)
+        for transaction in ledger.household_transactions(household, access_token, item.accounts, args.sync_transactions, days=args.days):
+            item.add(transaction)
+        state.items[access_token] = item
+        items.append((access_token, User.objects.create(username=f'sync-{i}')))
+    return items
+
+
+def incremental_sync(args, state, items):
+    rng = random.Random(args.seed)
+    rounds = []
+    for round_number in range(args.rounds):
+        for i, (access_token, _) in enumerate(items):
+            item = state.items[access_token]
+            household = ledger.Household(args.seed * 100003 + 70000 + i * 1000 + round_number)
+            for transaction in household.transactions(
+                item.accounts[-1]['account_id'], args.increment_added, days=1, prefix=f'{access_token}-r{round_number}', recurring=False,
+            ):
+                item.add(transaction)
+            item.churn(rng, modified=args.increment_modified, removed=args.increment_removed)
+        rounds.append(sync_all(items, args.workers))
+    round_ms = [r['seconds'] * 1000 for r in rounds]
+    return {
+        'rounds': len(rounds),
+        'round_p50_ms': percentile(round_ms, 50),
+        'round_p95_ms': percentile(round_ms, 95),
+        'item_p50_ms': percentile([r['item_p50_ms'] for r in rounds], 50),
+        'item_p95_ms': max(r['item_p95_ms'] for r in rounds),
+        'rows_added': sum(r['rows_added'] for r in rounds),
+        'rows_updated': sum(r['rows_updated'] for r in rounds),
+        'rows_removed': sum(r['rows_removed'] for r in rounds),
+        'plaid_calls': sum(r['plaid_calls'] for r in rounds),
+    }
+
+
+def read_endpoints(args, user, endpoints):
+    """Time each endpoint cold (response cache cleared) --repeat times, then once cached."""
+    from django.test import Client
+    from app import cache
+
+    client = Client()
+    client.force_login(user)
+    results = {}
+    for name, url, *headers in endpoints:
+        headers = headers[0] if headers else {}
+        samples = []
+        for _ in range(args.repeat):
+            cache.get_backend().clear()
+            started = time.perf_counter()
+            response = client.get(url, headers=headers)
+            samples.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f'{url} returned {response.status_code}: {response.content[:200]!r}')
+        started = time.perf_counter()
+        client.get(url, headers=headers)
+        results[name] = dict(latency(samples), cached_ms=(time.perf_counter() - started) * 1000, response_bytes=len(response.content))
+    return results
+
+
+def get_transactions(args, user):
+    from app.models import Transaction
+    results = read_endpoints(args, user, READ_ENDPOINTS['get_transactions'])
+    results['rows'] = Transaction.objects.filter(account__user=user).count()
+    return results
+
+
+def analytics(args, user):
+    from app import snapshot
+    results = {}
+    if snapshot.enabled():
+        started = time.perf_counter()
+        snapshot.refresh(user, rebuild=True)
+        results['snapshot_build_ms'] = (time.perf_counter() - started) * 1000
+    results.update(read_endpoints(args, user, READ_ENDPOINTS['analytics']))
+    return results
+
+
+def refresh_all(args, state):
+    from django.core.management import call_command
+
+    samples = []
+    calls = plaid_calls()
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        call_command('refresh_transactions', workers=args.workers, stdout=io.StringIO())
+        samples.append((time.perf_counter() - started) * 1000)
+    return dict(latency(samples), items=len(state.items), plaid_calls=(plaid_calls() - calls) // len(samples))
+
+
+def run(args):
+    state = FakePlaidState(page_size=args.page_size, latency=args.plaid_latency, seed=args.seed)
+    server, url = start_fake_plaid(state)
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(args, tmp, url)
+        from django.core.management import call_command
+        from django.db import connection
+        import django
+
+        call_command('migrate', verbosity=0)
+        print(f'Loading {args.transactions} transactions for {args.users} users...', flush=True)
+        started = time.perf_counter()
+        loaded = ledger.load(args.users, args.transactions, args.accounts, args.days, args.seed)
+        load_seconds = time.perf_counter() - started
+        for _, access_token, accounts in loaded:
+            # Loaded items are already in sync: empty logs on the fake server
+            state.items[access_token] = FakeItem(access_token, accounts)
+        # The first user has the largest share of the transactions
+        reader = loaded[0][0]
+
+        scenarios = {}
+        for name in SCENARIOS:
+            # incremental_sync needs the backfilled items
+            needed = name == 'initial_backfill' and 'incremental_sync' in args.scenarios
+            if name not in args.scenarios and not needed:
+                continue
+            print(f'Running {name}...', flush=True)
+            if name == 'initial_backfill':
+                sync_items = create_sync_items(args, state)
+                result = sync_all(sync_items, args.workers)
+            elif name == 'incremental_sync':
+                result = incremental_sync(args, state, sync_items)
+            elif name == 'get_transactions':
+                result = get_transactions(args, reader)
+            elif name == 'analytics':
+                result = analytics(args, reader)
+            else:
+                result = refresh_all(args, state)
+            if name in args.scenarios:
+                scenarios[name] = result
+
+        commit, dirty = git_commit()
+        meta = {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'load_seconds': load_seconds,
+            'load_rows_per_second': args.transactions / load_seconds if load_seconds else None,
+        }
+        connection.close()
+    server.shutdown()
+    config = {key: value for key, value in vars(args).items() if key not in ('json', 'compare', 'threshold', 'db')}
+    return {'meta': meta, 'config': config, 'scenarios': scenarios}
+
+
+def flatten(results, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}, numbers only."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def lower_is_better(metric):
+    """True/False for timings and throughputs, None for counts that are only context."""
+    if metric.endswith(('_ms', '_seconds')) or metric.endswith('.seconds'):
+        return True
+    if metric.endswith('_per_second'):
+        return False
+    return None
+
+
+def comparable(config):
+    # Runs of different scenarios still time the common ones the same way
+    return {key: value for key, value in config.items() if key != 'scenarios'}
+
+
+def compare(baseline, results, threshold):
+    """Print how every timing moved against the baseline; returns the regressed metrics."""
+    before, after = flatten(baseline['scenarios']), flatten(results['scenarios'])
+    print(f"\nAgainst {(baseline['meta'].get('commit') or 'unknown')[:10]} (threshold {threshold:.0f}%):")
+    regressions = []
+    for metric in sorted(before.keys() & after.keys()):
+        direction = lower_is_better(metric)
+        if direction is None or not before[metric]:
+            continue
+        change = (after[metric] - before[metric]) / before[metric] * 100
+        worse = change > threshold if direction else change < -threshold
+        if metric.endswith('_ms') and abs(after[metric] - before[metric]) < NOISE_MS:
+            worse = False
+        if worse:
+            regressions.append(metric)
+        flag = '  REGRESSION' if worse else ''
+        print(f'  {metric:<55} {before[metric]:12.2f} -> {after[metric]:12.2f}  {change:+7.1f}%{flag}')
+    return regressions
+
+
+def report(results):
+    meta = results['meta']
+    print(f"\nCommit {(meta['commit'] or 'unknown')[:10]}{' (dirty)' if meta['dirty'] else ''}, "
+          f"{meta['database']}, loaded {meta['load_rows_per_second']:.0f} rows/s")
+    for name, metrics in results['scenarios'].items():
+        print(name)
+        for key, value in flatten(metrics).items():
+            print(f'  {key:<45} {value:12.2f}' if isinstance(value, float) else f'  {key:<45} {value:12}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--transactions', type=int, default=200000, help='Transactions loaded up front, across all users')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--accounts', type=int, default=2, help='Accounts per user or item')
+    parser.add_argument('--days', type=int, default=730, help='Days of history')
+    parser.add_argument('--sync-items', type=int, default=8, help='Items synced by initial_backfill and incremental_sync')
+    parser.add_argument('--sync-transactions', type=int, default=5000, help='Transactions per synced item')
+    parser.add_argument('--rounds', type=int, default=3, help='incremental_sync rounds')
+    parser.add_argument('--increment-added', type=int, default=20, help='Transactions added per item per round')
+    parser.add_argument('--increment-modified', type=int, default=5)
+    parser.add_argument('--increment-removed', type=int, default=2)
+    parser.add_argument('--page-size', type=int, default=500, help='Transactions per fake /transactions/sync page')
+    parser.add_argument('--plaid-latency', type=float, default=0.0, help='Seconds the fake Plaid adds to every response')
+    parser.add_argument('--plaid-rate-limits', action='store_true', help="Keep the Plaid client's own rate limits")
+    parser.add_argument('--workers', type=int, default=4, help='Items synced concurrently')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per timed read')
+    parser.add_argument('--no-snapshots', action='store_true', help='Serve analytics from the database instead of snapshots')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help='SQLite file to use instead of a temporary one; must not exist yet')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent a timing may worsen before it counts as a regression')
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if comparable(baseline.get('config', {})) != comparable(results['config']):
+            print('\nWarning: the baseline ran with different options; timings may not be comparable')
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,11 @@ cd "$(dirname "$0")"
 source myenv/bin/activate
 
 # Run the management command
-python3 manage.py refresh_transactions
+# Webhooks trigger syncs of changed items; this catches any item not synced in a day
+python3 manage.py refresh_transactions --stale-hours 24
+
+# Full re-detection of recurring streams; syncs only re-detect the merchants they touched
+python3 manage.py detect_recurring
 
 # Deactivate virtual environment
 deactivate 
\ No newline at end of file
@@ -2,6 +2,8 @@
 ASGI config for server project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with e.g. ``uvicorn server.asgi:application``; the Plaid-bound views
+are async (see app/aio.py) and only run concurrently under ASGI.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
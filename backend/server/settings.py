@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover every other middleware (see app/instrumentation.py)
+    'app.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -77,13 +80,128 @@ WSGI_APPLICATION = 'server.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE=postgresql for production; SQLite stays the zero-setup default.
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite3')
+
+if DB_ENGINE == 'postgresql':
+    # psycopg's pool keeps connections open across requests; without it, CONN_MAX_AGE
+    # keeps one persistent connection per worker thread instead
+    DB_POOL = os.getenv('DB_POOL', '1') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'finance'),
+            'USER': os.getenv('DB_USER', 'postgres'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            # Django refuses persistent connections on top of a pool
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+                    # Seconds a request waits for a free connection
+                    'timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),
+                },
+            } if DB_POOL else {},
+        }
     }
+elif DB_ENGINE == 'sqlite3':
+    # SQLITE_TUNED=0 restores SQLite's defaults (rollback journal, deferred transactions),
+    # e.g. to compare them in benchmarks/db_concurrency_benchmark.py
+    SQLITE_TUNED = os.getenv('SQLITE_TUNED', '1') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # busy_timeout: seconds a connection waits for a lock before "database is locked"
+                'timeout': int(os.getenv('SQLITE_TIMEOUT', 20)),
+                # Take the write lock when a transaction begins, so concurrent writers queue on
+                # busy_timeout instead of failing when a read lock cannot be upgraded
+                'transaction_mode': 'IMMEDIATE',
+                # WAL lets readers run while a sync writes; synchronous=NORMAL is durable in WAL
+                # mode except for the last commits on power loss, and skips an fsync per commit
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA temp_store=MEMORY;'
+                    f"PRAGMA cache_size=-{int(os.getenv('SQLITE_CACHE_KB', 65536))};"
+                ),
+            } if SQLITE_TUNED else {},
+        }
+    }
+else:
+    raise ValueError(f'Unsupported DB_ENGINE: {DB_ENGINE}')
+
+
+# Rows written per statement when applying a Plaid /transactions/sync page
+SYNC_BATCH_SIZE = int(os.getenv('SYNC_BATCH_SIZE', 1000))
+# Statement rows deduplicated and inserted per chunk by app/statements.py
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 5000))
+# Merchant name -> Merchant id entries each process keeps (see app/merchants.py)
+MERCHANT_CACHE_SIZE = int(os.getenv('MERCHANT_CACHE_SIZE', 10000))
+# Per-user columnar transaction snapshots read by analytics and forecasts (see app/snapshot.py);
+# an empty SNAPSHOT_DIR makes them query the database instead
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', str(BASE_DIR / 'snapshots'))
+
+# Background jobs: 'app.jobs.DatabaseBackend' needs a `manage.py run_jobs` worker,
+# 'app.jobs.ImmediateBackend' runs jobs inline in the request
+JOB_BACKEND = os.getenv('JOB_BACKEND', 'app.jobs.DatabaseBackend')
+# Seconds a running job may hold its lock before another worker requeues it
+JOB_LOCK_TIMEOUT = int(os.getenv('JOB_LOCK_TIMEOUT', 600))
+# Seconds to wait after linking an item before its first sync, so Plaid can gather transactions
+INITIAL_SYNC_DELAY = int(os.getenv('INITIAL_SYNC_DELAY', 30))
+# Seconds a webhook-triggered sync waits, so a burst of webhooks for one item shares a sync
+WEBHOOK_SYNC_DELAY = int(os.getenv('WEBHOOK_SYNC_DELAY', 10))
+
+# Cache for per-user read endpoints (see app/cache.py). Use 'app.cache.DjangoCacheBackend'
+# to share entries between worker processes through CACHES.
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'app.cache.LRUCacheBackend')
+RESPONSE_CACHE = {
+    'BACKEND': RESPONSE_CACHE_BACKEND,
+    'OPTIONS': (
+        {
+            'max_entries': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+            # Total bytes of cached content, and the largest single response worth caching
+            'max_bytes': int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            'max_entry_bytes': int(os.getenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', 2 * 1024 * 1024)),
+        }
+        if RESPONSE_CACHE_BACKEND == 'app.cache.LRUCacheBackend' else {}
+    ),
+}
+
+# Logging: LOG_FORMAT 'json' writes one JSON object per line with the request id
+# and any extra fields; 'text' is easier to read in a terminal
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request': {'()': 'app.instrumentation.RequestContextFilter'},
+    },
+    'formatters': {
+        'json': {'()': 'app.instrumentation.JsonFormatter'},
+        'text': {'format': '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': LOG_FORMAT, 'filters': ['request']},
+    },
+    'root': {'handlers': ['console'], 'level': LOG_LEVEL},
+    'loggers': {
+        'django': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
 }
 
+# Bearer token Prometheus scrapes /metrics with; without one only staff sessions may read it
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Let requests with ?profile=1 run under cProfile, dumping stats to PROFILE_DIR. Not for production.
+PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', '0') == '1'
+PROFILE_DIR = os.getenv('PROFILE_DIR', str(BASE_DIR / 'profiles'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
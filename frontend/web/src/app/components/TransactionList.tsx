@@ -1,5 +1,5 @@
 import { useEffect, useState } from 'react';
-import { getTransactions } from '@services';
+import { getTransactions, waitForJobs } from '@services';
 import { 
   List, 
   ListItem, 
@@ -250,6 +250,10 @@ export default function TransactionList({ onAddAccount }: TransactionListProps)
         throw new Error('Failed to sync transactions');
       }
 
+      // Syncs run in the background; wait for them before refetching
+      const { jobs = [] } = await response.json();
+      await waitForJobs(jobs.map((job: { id: number }) => job.id));
+
       // Refetch transactions after sync
       const data = await getTransactions();
       const sortedTransactions = data.sort((a: Transaction, b: Transaction) => 
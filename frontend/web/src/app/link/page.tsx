@@ -4,6 +4,7 @@ import { useState, useEffect } from 'react';
 import { useRouter } from 'next/navigation';
 import { Container, Box, Typography, Button, CircularProgress } from '@mui/material';
 import { usePlaidLink, PlaidLinkOptions } from 'react-plaid-link';
+import { waitForJobs } from '@services';
 
 export default function LinkPage() {
   const router = useRouter();
@@ -56,6 +57,12 @@ export default function LinkPage() {
         throw new Error('Failed to exchange token');
       }
 
+      // The exchange runs on a background worker; wait for it so a failed link
+      // is reported here. It schedules the item's first sync, which the
+      // dashboard picks up.
+      const { job } = await response.json();
+      await waitForJobs([job.id]);
+
       router.push('/dashboard');
     } catch (error) {
       console.error('Failed to exchange public token:', error);
@@ -82,18 +82,84 @@ export const checkHasAccounts = async () => {
     return data.hasAccounts;
 }
 
+// The compact layout sends rows as arrays, each account once and amounts in cents;
+// expand it into the transaction objects the components use
 export const getTransactions = async () => {
-    const response = await fetch(`${apiUrl}/api/get_transactions/`, {
+    const response = await fetch(`${apiUrl}/api/get_transactions/?format=compact`, {
         method: 'GET',
         credentials: 'include',
     });
-    
+
     if (!response.ok) {
         throw new Error('Failed to fetch transactions');
     }
+
+    const data = await response.json();
+    if (!data.fields) {
+        // No accounts linked yet
+        return data.transactions;
+    }
+    const column: Record<string, number> = Object.fromEntries(data.fields.map((name: string, i: number) => [name, i]));
+    return data.transactions.map((row: any[]) => ({
+        transaction_id: row[column.transaction_id],
+        amount: row[column.amount_cents] / 100,
+        description: row[column.description],
+        merchant_name: row[column.merchant_name],
+        datetime: new Date(row[column.timestamp] * 1000).toISOString(),
+        transaction_type: row[column.transaction_type],
+        payment_channel: row[column.payment_channel],
+        account: data.accounts[row[column.account]],
+    }));
+}
+
+export const getTransactionFeed = async (params: Record<string, string> = {}) => {
+    const query = new URLSearchParams(params).toString();
+    const response = await fetch(`${apiUrl}/api/get_transaction_feed/?${query}`, {
+        method: 'GET',
+        credentials: 'include',
+    });
+    
+    if (!response.ok) {
+        throw new Error('Failed to fetch transaction feed');
+    }
     
     const data = await response.json();
-    return data.transactions;
+    return { transactions: data.transactions, nextCursor: data.next_cursor };
+}
+
+// Link target for downloading the full ledger; the browser streams it straight to disk
+export const getTransactionExportUrl = (format: 'csv' | 'ndjson', params: Record<string, string> = {}) => {
+    const query = new URLSearchParams(params).toString();
+    return `${apiUrl}/api/export_transactions/${format}/?${query}`;
+}
+
+// dimension: 'category' | 'merchant' | 'payment_channel' | 'account'
+export const getAnalytics = async (dimension: string, params: Record<string, string> = {}) => {
+    const query = new URLSearchParams(params).toString();
+    const response = await fetch(`${apiUrl}/api/analytics/${dimension}/?${query}`, {
+        method: 'GET',
+        credentials: 'include',
+    });
+    
+    if (!response.ok) {
+        throw new Error('Failed to fetch analytics');
+    }
+    
+    return await response.json();
+}
+
+export const getForecast = async (months = 6, scenarios = 500) => {
+    const query = new URLSearchParams({ months: String(months), scenarios: String(scenarios) }).toString();
+    const response = await fetch(`${apiUrl}/api/forecast/?${query}`, {
+        method: 'GET',
+        credentials: 'include',
+    });
+    
+    if (!response.ok) {
+        throw new Error('Failed to fetch forecast');
+    }
+    
+    return await response.json();
 }
 
 export const getAccounts = async () => {
@@ -111,6 +177,68 @@ export const getAccounts = async () => {
     return data.accounts;
 }
 
+// Upload a CSV or OFX statement into an account; a new account_id creates a manual account
+export const importStatement = async (file: File, accountId: string, accountName?: string) => {
+    const form = new FormData();
+    form.append('file', file);
+    form.append('account_id', accountId);
+    if (accountName) {
+        form.append('account_name', accountName);
+    }
+    const csrfToken = await getCsrfToken();
+    const response = await fetch(`${apiUrl}/api/import_statement/`, {
+        method: 'POST',
+        headers: {
+            'X-CSRFToken': csrfToken,
+        },
+        credentials: 'include',
+        body: form,
+    });
+    
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || 'Failed to import statement');
+    }
+    return data.summary;
+}
+
+export const getJob = async (jobId: number) => {
+    const response = await fetch(`${apiUrl}/api/jobs/${jobId}/`, {
+        method: 'GET',
+        credentials: 'include',
+    });
+    
+    if (!response.ok) {
+        throw new Error('Failed to fetch job status');
+    }
+    
+    const data = await response.json();
+    return data.job;
+}
+
+// Poll background jobs until none of them is queued or running. Throws if a job
+// fails or the jobs are still pending after timeoutMs.
+export const waitForJobs = async (jobIds: number[], intervalMs = 2000, timeoutMs = 120000) => {
+    const deadline = Date.now() + timeoutMs;
+    let pending = [...jobIds];
+    while (pending.length > 0) {
+        const jobs = await Promise.all(pending.map(getJob));
+        const failed = jobs.find((job) => job.status === 'failed');
+        if (failed) {
+            throw new Error(failed.error || `Job ${failed.id} failed`);
+        }
+        pending = jobs
+            .filter((job) => job.status === 'queued' || job.status === 'running')
+            .map((job) => job.id);
+        if (pending.length > 0) {
+            if (Date.now() + intervalMs > deadline) {
+                throw new Error('Timed out waiting for background jobs');
+            }
+            await new Promise((resolve) => setTimeout(resolve, intervalMs));
+        }
+    }
+}
+
 export const createUser = async () => {
     const response = await fetch(`${apiUrl}/api/create_user/`, {
         method: 'POST',